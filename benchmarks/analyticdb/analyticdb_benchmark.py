@@ -0,0 +1,176 @@
+import argparse
+import asyncio
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from benchmarks.hnsw.hnsw_benchmark import generate_embeddings
+from datastore.providers import analyticdb_datastore
+from datastore.providers.analyticdb_datastore import PG_CONFIG, AnalyticDBDataStore
+from datastore.providers.local_datastore import normalize_embeddings
+from models.models import DocumentChunk, DocumentChunkMetadata, QueryWithEmbedding
+
+
+class StandInDataStore(AnalyticDBDataStore):
+    """
+    AnalyticDB datastore on a plain Postgres server, where the ann index is replaced by SQL definitions of the
+    l2_distance function and the <-> operator on real arrays, so that the statements of the datastore run as is.
+    """
+
+    def _initialize_db(self):
+        conn = self.connection_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp"')
+                cur.execute(
+                    """
+                    CREATE OR REPLACE FUNCTION l2_distance(a real[], b real[]) RETURNS real AS $$
+                        SELECT sqrt(sum((x - y) * (x - y)))::real FROM unnest(a, b) AS t(x, y)
+                    $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE
+                    """
+                )
+                cur.execute(
+                    "SELECT 1 FROM pg_operator WHERE oprname = '<->' "
+                    "AND oprleft = 'real[]'::regtype AND oprright = 'real[]'::regtype"
+                )
+                if not cur.fetchone():
+                    cur.execute(
+                        "CREATE OPERATOR <-> (LEFTARG = real[], RIGHTARG = real[], FUNCTION = l2_distance)"
+                    )
+                self._create_table(cur)
+                conn.commit()
+        finally:
+            self.connection_pool.putconn(conn)
+
+
+def make_chunks(embeddings: np.ndarray, chunks_per_document: int) -> Dict[str, List[DocumentChunk]]:
+    chunks: Dict[str, List[DocumentChunk]] = {}
+    for row, embedding in enumerate(embeddings):
+        document_id = f"document-{row // chunks_per_document}"
+        chunks.setdefault(document_id, []).append(
+            DocumentChunk(
+                id=f"{document_id}_{row % chunks_per_document}",
+                text="lorem ipsum " * 80,
+                metadata=DocumentChunkMetadata(
+                    document_id=document_id, author="benchmark", created_at="2023-01-01"
+                ),
+                embedding=embedding.tolist(),
+            )
+        )
+    return chunks
+
+
+async def time_upsert(
+    datastore: AnalyticDBDataStore, chunks: Dict[str, List[DocumentChunk]], upsert_size: int
+) -> float:
+    """
+    Upserts the chunks upsert_size documents at a time, like requests of the API, and returns the elapsed time.
+    """
+    document_ids = list(chunks)
+    start = time.perf_counter()
+    for batch_start in range(0, len(document_ids), upsert_size):
+        await datastore._upsert(
+            {
+                document_id: chunks[document_id]
+                for document_id in document_ids[batch_start : batch_start + upsert_size]
+            }
+        )
+    return time.perf_counter() - start
+
+
+async def time_queries(
+    datastore: AnalyticDBDataStore, queries: List[QueryWithEmbedding], batch_size: int
+) -> float:
+    """
+    Runs the queries batch_size at a time, like requests of the API, and returns the mean latency of a request.
+    """
+    latencies = []
+    for start in range(0, len(queries), batch_size):
+        request_start = time.perf_counter()
+        await datastore._query(queries[start : start + batch_size])
+        latencies.append(time.perf_counter() - request_start)
+    return float(np.mean(latencies))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_vectors", default=2000, type=int)
+    parser.add_argument("--dimension", default=1536, type=int)
+    parser.add_argument("--num_queries", default=20, type=int)
+    parser.add_argument("--top_k", default=10, type=int)
+    parser.add_argument(
+        "--chunks_per_document", default=10, type=int, help="The number of chunks of a document"
+    )
+    parser.add_argument(
+        "--upsert_size",
+        default=50,
+        type=int,
+        help="The number of documents of an upsert request",
+    )
+    parser.add_argument(
+        "--batch_size", default=10, type=int, help="The number of queries of a request"
+    )
+    parser.add_argument(
+        "--pool_size", default=8, type=int, help="The size of the connection pool"
+    )
+    parser.add_argument(
+        "--collection",
+        default="benchmark_chunks",
+        help="The table to write to, which is dropped at the end",
+    )
+    parser.add_argument(
+        "--stand_in",
+        default=True,
+        type=lambda value: value.lower() == "true",
+        help="Whether the server is a plain Postgres server rather than AnalyticDB",
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    basis = normalize_embeddings(rng.normal(size=(64, args.dimension)).astype(np.float32))
+    embeddings = generate_embeddings(args.num_vectors, args.dimension, 64, rng, basis)
+    queries = [
+        QueryWithEmbedding(query=str(i), embedding=embedding.tolist(), top_k=args.top_k)
+        for i, embedding in enumerate(
+            generate_embeddings(args.num_queries, args.dimension, 64, rng, basis)
+        )
+    ]
+
+    datastore_class = StandInDataStore if args.stand_in else AnalyticDBDataStore
+    config = {**PG_CONFIG, "collection": args.collection}
+    datastore = datastore_class(config, pool_size=args.pool_size)
+    try:
+        # One chunk per transaction, like the upserts before they were batched
+        batch_size = analyticdb_datastore.UPSERT_BATCH_SIZE
+        analyticdb_datastore.UPSERT_BATCH_SIZE = 1
+        elapsed = await time_upsert(
+            datastore, make_chunks(embeddings, args.chunks_per_document), args.upsert_size
+        )
+        print(f"upsert, one chunk per transaction: {args.num_vectors / elapsed:.0f} chunks/s")
+        await datastore.delete(delete_all=True)
+        analyticdb_datastore.UPSERT_BATCH_SIZE = batch_size
+        elapsed = await time_upsert(
+            datastore, make_chunks(embeddings, args.chunks_per_document), args.upsert_size
+        )
+        print(
+            f"upsert, {batch_size} chunks per transaction: {args.num_vectors / elapsed:.0f} chunks/s"
+        )
+
+        sequential = datastore_class(config, pool_size=1)
+        await time_queries(sequential, queries[: args.batch_size], args.batch_size)
+        latency = await time_queries(sequential, queries, args.batch_size)
+        print(f"query of {args.batch_size}, one connection: {latency * 1000:.1f}ms per request")
+        latency = await time_queries(datastore, queries, args.batch_size)
+        print(
+            f"query of {args.batch_size}, {args.pool_size} connections: {latency * 1000:.1f}ms per request"
+        )
+        sequential.connection_pool.closeall()
+    finally:
+        await datastore._run(lambda cur: cur.execute(f"DROP TABLE {args.collection}"))
+        datastore.connection_pool.closeall()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,107 @@
+import argparse
+import random
+import time
+from typing import List, Optional
+
+from services.chunks import (
+    CHUNK_SIZE,
+    MAX_NUM_CHUNKS,
+    MIN_CHUNK_LENGTH_TO_EMBED,
+    MIN_CHUNK_SIZE_CHARS,
+    get_text_chunks,
+    tokenizer,
+)
+
+WORDS = [
+    "the", "retrieval", "plugin", "stores", "document", "chunks", "as", "vectors",
+    "and", "queries", "them", "by", "similarity", "naïve", "café", "東京", "données",
+]
+PUNCTUATION = ["", "", "", ",", ".", ".", "?", "!", ".\n", "\n\n"]
+
+
+def get_text_chunks_reference(text: str, chunk_token_size: Optional[int]) -> List[str]:
+    """
+    The previous implementation of get_text_chunks, which re-slices the remaining tokens for every chunk.
+    """
+    if not text or text.isspace():
+        return []
+    tokens = tokenizer.encode(text, disallowed_special=())
+    chunks = []
+    chunk_size = chunk_token_size or CHUNK_SIZE
+    num_chunks = 0
+    while tokens and num_chunks < MAX_NUM_CHUNKS:
+        chunk = tokens[:chunk_size]
+        chunk_text = tokenizer.decode(chunk)
+        if not chunk_text or chunk_text.isspace():
+            tokens = tokens[len(chunk) :]
+            continue
+        last_punctuation = max(
+            chunk_text.rfind("."),
+            chunk_text.rfind("?"),
+            chunk_text.rfind("!"),
+            chunk_text.rfind("\n"),
+        )
+        if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
+            chunk_text = chunk_text[: last_punctuation + 1]
+        chunk_text_to_append = chunk_text.replace("\n", " ").strip()
+        if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
+            chunks.append(chunk_text_to_append)
+        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+        num_chunks += 1
+    if tokens:
+        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
+        if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
+            chunks.append(remaining_text)
+    return chunks
+
+
+def generate_document(size_bytes: int, seed: int = 0) -> str:
+    """
+    Generate a prose-like document of about size_bytes bytes.
+    """
+    rng = random.Random(seed)
+    parts: List[str] = []
+    size = 0
+    while size < size_bytes:
+        part = rng.choice(WORDS) + rng.choice(PUNCTUATION) + " "
+        parts.append(part)
+        size += len(part.encode("utf-8"))
+    return "".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes_mb",
+        default="1,10,100",
+        help="A comma-separated list of document sizes to benchmark, in megabytes",
+    )
+    parser.add_argument(
+        "--reference_max_mb",
+        default=1,
+        type=float,
+        help="Only time and compare the previous implementation for documents up to this size",
+    )
+    args = parser.parse_args()
+
+    for size_mb in [float(size) for size in args.sizes_mb.split(",")]:
+        text = generate_document(int(size_mb * 1024 * 1024))
+
+        start = time.perf_counter()
+        chunks = get_text_chunks(text, None)
+        elapsed = time.perf_counter() - start
+        print(f"{size_mb:g}MB: {len(chunks)} chunks in {elapsed:.2f}s")
+
+        if size_mb <= args.reference_max_mb:
+            start = time.perf_counter()
+            reference_chunks = get_text_chunks_reference(text, None)
+            reference_elapsed = time.perf_counter() - start
+            assert chunks == reference_chunks, "chunks differ from the previous implementation"
+            print(
+                f"{size_mb:g}MB: previous implementation took {reference_elapsed:.2f}s "
+                f"({reference_elapsed / elapsed:.1f}x slower), output is identical"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from datastore.hnsw import DEFAULT_EF_CONSTRUCTION, DEFAULT_M, HNSWIndex
+from datastore.providers.local_datastore import normalize_embeddings, select_top_k
+
+
+def generate_embeddings(
+    count: int, dimension: int, rank: int, rng: np.random.Generator, basis: np.ndarray
+) -> np.ndarray:
+    """
+    Generate unit vectors close to a random subspace of the given rank, since text embeddings have a much lower
+    intrinsic dimension than their number of dimensions, with some noise in every dimension.
+    """
+    embeddings = np.empty((count, dimension), dtype=np.float32)
+    for start in range(0, count, 10000):
+        end = min(start + 10000, count)
+        embeddings[start:end] = rng.normal(size=(end - start, rank)).astype(
+            np.float32
+        ) @ basis + 0.05 * rng.normal(size=(end - start, dimension)).astype(np.float32)
+    return normalize_embeddings(embeddings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_vectors", default=20000, type=int)
+    parser.add_argument("--dimension", default=1536, type=int)
+    parser.add_argument("--num_queries", default=200, type=int)
+    parser.add_argument("--k", default=10, type=int, help="Recall is measured at k")
+    parser.add_argument("--m", default=DEFAULT_M, type=int)
+    parser.add_argument("--ef_construction", default=DEFAULT_EF_CONSTRUCTION, type=int)
+    parser.add_argument(
+        "--ef_search",
+        default="10,20,40,80,160,320",
+        help="A comma-separated list of ef values to search with",
+    )
+    parser.add_argument(
+        "--rank", default=64, type=int, help="Intrinsic dimension of the embeddings"
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument(
+        "--index_path",
+        default=None,
+        help="Load the index from this file if it exists, otherwise build it and save it there",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    basis = normalize_embeddings(
+        rng.normal(size=(args.rank, args.dimension)).astype(np.float32)
+    )
+    embeddings = generate_embeddings(
+        args.num_vectors, args.dimension, args.rank, rng, basis
+    )
+    queries = generate_embeddings(args.num_queries, args.dimension, args.rank, rng, basis)
+
+    if args.index_path and os.path.exists(args.index_path):
+        index = HNSWIndex.load(args.index_path)
+        print(f"Loaded the index of {len(index)} vectors from {args.index_path}")
+    else:
+        index = HNSWIndex(
+            args.dimension, m=args.m, ef_construction=args.ef_construction, seed=args.seed
+        )
+        start = time.perf_counter()
+        index.add(embeddings, np.arange(args.num_vectors))
+        elapsed = time.perf_counter() - start
+        print(
+            f"Built the index of {args.num_vectors} vectors with m={args.m}, "
+            f"ef_construction={args.ef_construction} in {elapsed:.1f}s "
+            f"({args.num_vectors / elapsed:.0f} inserts/s)"
+        )
+        if args.index_path:
+            index.save(args.index_path)
+
+    # Exact search, one query at a time like the index, for both the ground truth and the baseline latency
+    start = time.perf_counter()
+    truth = [
+        select_top_k((embeddings @ query)[np.newaxis], args.k)[0][0]
+        for query in queries
+    ]
+    exact_ms = (time.perf_counter() - start) / args.num_queries * 1000
+    print(f"exact: {exact_ms:.2f}ms per query")
+
+    for ef in [int(ef) for ef in args.ef_search.split(",")]:
+        start = time.perf_counter()
+        results = [index.search(query, args.k, ef=ef)[0] for query in queries]
+        elapsed_ms = (time.perf_counter() - start) / args.num_queries * 1000
+        recall = np.mean(
+            [
+                len(set(result.tolist()) & set(expected.tolist())) / args.k
+                for result, expected in zip(results, truth)
+            ]
+        )
+        print(
+            f"ef={ef}: recall@{args.k} {recall:.3f}, {elapsed_ms:.2f}ms per query "
+            f"({exact_ms / elapsed_ms:.1f}x exact)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+from benchmarks.hnsw.hnsw_benchmark import generate_embeddings
+from datastore.providers.local_datastore import normalize_embeddings
+from datastore.providers.segment_datastore import (
+    STRING_COLUMNS,
+    SegmentDataStore,
+    SegmentWriter,
+)
+from models.models import QueryWithEmbedding
+
+QUANTIZED_FILES = {
+    "none": ["embeddings.npy"],
+    "int8": ["embeddings.int8.npy", "embeddings.scales.npy"],
+    "binary": ["embeddings.binary.npy"],
+}
+
+
+def write_datastore(
+    path: str, embeddings: np.ndarray, quantization: str, segment_size: int
+) -> SegmentDataStore:
+    """
+    Write the embeddings to a segment datastore directly, without creating a chunk for each of them.
+    """
+    datastore = SegmentDataStore(path=path, quantization=quantization)
+    names = []
+    for start in range(0, len(embeddings), segment_size):
+        block = embeddings[start : start + segment_size]
+        name = f"segment-{start}"
+        writer = SegmentWriter(
+            datastore._segment_path(name), len(block), block.shape[1], quantization
+        )
+        ids = [str(row) for row in range(start, start + len(block))]
+        strings = {column: [None] * len(block) for column in STRING_COLUMNS}
+        strings.update(id=ids, document_id=ids, text=[""] * len(block))
+        writer.append(block, np.full(len(block), np.nan), strings)  # type: ignore
+        writer.close()
+        names.append(name)
+    datastore._write_manifest(names)
+    datastore._refresh()
+    return datastore
+
+
+def scored_bytes(path: str, quantization: str) -> int:
+    """
+    Return the size of the files that every query reads, which should fit in memory.
+    """
+    return sum(
+        os.path.getsize(os.path.join(path, segment, name))
+        for segment in os.listdir(path)
+        if segment.startswith("segment-")
+        for name in QUANTIZED_FILES[quantization]
+    )
+
+
+async def run_queries(
+    datastore: SegmentDataStore, queries: List[QueryWithEmbedding], batch_size: int
+) -> List[List[str]]:
+    results = []
+    for start in range(0, len(queries), batch_size):
+        for result in await datastore._query(queries[start : start + batch_size]):
+            results.append([chunk.id for chunk in result.results])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_vectors", default=100000, type=int)
+    parser.add_argument("--dimension", default=1536, type=int)
+    parser.add_argument("--num_queries", default=100, type=int)
+    parser.add_argument("--k", default=10, type=int, help="Recall is measured at k")
+    parser.add_argument(
+        "--rescore_factors",
+        default="1,2,4,8,16",
+        help="A comma-separated list of rescore factors to query with",
+    )
+    parser.add_argument(
+        "--batch_size", default=10, type=int, help="The number of queries of a request"
+    )
+    parser.add_argument("--segment_size", default=50000, type=int)
+    parser.add_argument(
+        "--rank", default=64, type=int, help="Intrinsic dimension of the embeddings"
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument(
+        "--directory",
+        default=None,
+        help="Directory to write the datastores to, a temporary directory by default",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    basis = normalize_embeddings(
+        rng.normal(size=(args.rank, args.dimension)).astype(np.float32)
+    )
+    embeddings = generate_embeddings(
+        args.num_vectors, args.dimension, args.rank, rng, basis
+    )
+    queries = [
+        QueryWithEmbedding(query=str(i), embedding=embedding.tolist(), top_k=args.k)
+        for i, embedding in enumerate(
+            generate_embeddings(args.num_queries, args.dimension, args.rank, rng, basis)
+        )
+    ]
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        exact: List[List[str]] = []
+        for quantization in ["none", "int8", "binary"]:
+            path = os.path.join(directory, quantization)
+            datastore = write_datastore(
+                path, embeddings, quantization, args.segment_size
+            )
+            size = scored_bytes(path, quantization)
+            print(
+                f"{quantization}: {size / args.num_vectors:.0f} bytes per vector scored "
+                f"({size / 2**20:.1f}MB)"
+            )
+            factors = (
+                [1]
+                if quantization == "none"
+                else [int(factor) for factor in args.rescore_factors.split(",")]
+            )
+            for factor in factors:
+                datastore._rescore_factor = factor
+                # A first run to read the files into the page cache
+                asyncio.run(run_queries(datastore, queries, args.batch_size))
+                start = time.perf_counter()
+                results = asyncio.run(run_queries(datastore, queries, args.batch_size))
+                elapsed_ms = (time.perf_counter() - start) / args.num_queries * 1000
+                if quantization == "none":
+                    exact = results
+                    print(f"  exact: {elapsed_ms:.2f}ms per query")
+                    continue
+                recall = np.mean(
+                    [
+                        len(set(result) & set(expected)) / args.k
+                        for result, expected in zip(results, exact)
+                    ]
+                )
+                print(
+                    f"  rescore_factor={factor}: recall@{args.k} {recall:.3f}, "
+                    f"{elapsed_ms:.2f}ms per query"
+                )
+
+
+if __name__ == "__main__":
+    main()
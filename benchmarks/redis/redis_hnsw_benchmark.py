@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import time
+from typing import List
+
+import numpy as np
+
+from benchmarks.hnsw.hnsw_benchmark import generate_embeddings
+from benchmarks.redis.redis_storage_benchmark import make_chunks
+from datastore.providers.local_datastore import normalize_embeddings
+from datastore.providers.redis_datastore import (
+    REDIS_HNSW_EF_CONSTRUCTION,
+    REDIS_HNSW_M,
+    RedisDataStore,
+)
+from models.models import QueryAccuracy, QueryWithEmbedding
+
+
+async def search(
+    datastore: RedisDataStore, queries: List[QueryWithEmbedding]
+) -> List[List[str]]:
+    """
+    Search the queries one at a time, and return the ids of the results of each.
+    """
+    results = []
+    for query in queries:
+        result = (await datastore._query([query]))[0]
+        results.append([chunk.id for chunk in result.results])
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_vectors", default=20000, type=int)
+    parser.add_argument("--dimension", default=1536, type=int)
+    parser.add_argument("--num_queries", default=200, type=int)
+    parser.add_argument("--k", default=10, type=int, help="Recall is measured at k")
+    parser.add_argument("--m", default=REDIS_HNSW_M, type=int)
+    parser.add_argument(
+        "--ef_construction", default=REDIS_HNSW_EF_CONSTRUCTION, type=int
+    )
+    parser.add_argument(
+        "--ef_runtime",
+        default="10,20,40,80,160,320",
+        help="A comma-separated list of EF_RUNTIME values to search with",
+    )
+    parser.add_argument(
+        "--storage_type", default="hash", help="The storage type of the chunks"
+    )
+    parser.add_argument(
+        "--rank", default=64, type=int, help="Intrinsic dimension of the embeddings"
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    basis = normalize_embeddings(
+        rng.normal(size=(args.rank, args.dimension)).astype(np.float32)
+    )
+    embeddings = generate_embeddings(
+        args.num_vectors, args.dimension, args.rank, rng, basis
+    )
+    queries = [
+        QueryWithEmbedding(
+            query=str(i),
+            embedding=embedding.tolist(),
+            top_k=args.k,
+            accuracy=QueryAccuracy.balanced,
+        )
+        for i, embedding in enumerate(
+            generate_embeddings(args.num_queries, args.dimension, args.rank, rng, basis)
+        )
+    ]
+
+    prefix = "benchmark_hnsw"
+    hnsw = await RedisDataStore.init(
+        dim=args.dimension,
+        storage_type=args.storage_type,
+        index_name="benchmark_hnsw",
+        doc_prefix=prefix,
+        index_type="HNSW",
+        hnsw_m=args.m,
+        hnsw_ef_construction=args.ef_construction,
+        initial_cap=args.num_vectors,
+    )
+    # A flat index of the same keys, for the exact results
+    flat = await RedisDataStore.init(
+        dim=args.dimension,
+        storage_type=args.storage_type,
+        index_name="benchmark_flat",
+        doc_prefix=prefix,
+        index_type="FLAT",
+        initial_cap=args.num_vectors,
+    )
+    client = hnsw.client
+    try:
+        # One chunk per document, so that the ids of the results identify the chunks
+        chunks = make_chunks(embeddings, 1)
+        document_ids = list(chunks)
+        start = time.perf_counter()
+        for batch_start in range(0, len(document_ids), 100):
+            await hnsw._upsert(
+                {
+                    document_id: chunks[document_id]
+                    for document_id in document_ids[batch_start : batch_start + 100]
+                }
+            )
+        while int((await client.ft("benchmark_hnsw").info())["indexing"]):
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+        print(
+            f"Indexed {args.num_vectors} vectors with M={args.m}, "
+            f"EF_CONSTRUCTION={args.ef_construction} in {elapsed:.1f}s "
+            f"({args.num_vectors / elapsed:.0f} inserts/s, with the flat index)"
+        )
+
+        await search(flat, queries[:10])
+        start = time.perf_counter()
+        truth = await search(flat, queries)
+        exact_ms = (time.perf_counter() - start) / args.num_queries * 1000
+        print(f"flat: {exact_ms:.2f}ms per query")
+
+        for ef in [int(ef) for ef in args.ef_runtime.split(",")]:
+            hnsw._hnsw_ef_runtime = ef
+            start = time.perf_counter()
+            results = await search(hnsw, queries)
+            elapsed_ms = (time.perf_counter() - start) / args.num_queries * 1000
+            recall = np.mean(
+                [
+                    len(set(result) & set(expected)) / args.k
+                    for result, expected in zip(results, truth)
+                ]
+            )
+            print(
+                f"EF_RUNTIME={ef}: recall@{args.k} {recall:.3f}, {elapsed_ms:.2f}ms per query "
+                f"({exact_ms / elapsed_ms:.1f}x flat)"
+            )
+    finally:
+        await client.ft("benchmark_flat").dropindex()
+        await client.ft("benchmark_hnsw").dropindex(delete_documents=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,162 @@
+import argparse
+import asyncio
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from benchmarks.hnsw.hnsw_benchmark import generate_embeddings
+from datastore.providers.local_datastore import normalize_embeddings
+from datastore.providers.redis_datastore import RedisDataStore
+from models.models import (
+    DocumentChunk,
+    DocumentChunkMetadata,
+    QueryWithEmbedding,
+    Source,
+)
+
+
+def make_chunks(embeddings: np.ndarray, chunks_per_document: int) -> Dict[str, List[DocumentChunk]]:
+    """
+    Make chunks of about the size of real ones, grouped by document like the upsert of the datastore expects.
+    """
+    chunks: Dict[str, List[DocumentChunk]] = {}
+    for row, embedding in enumerate(embeddings):
+        document_id = f"document-{row // chunks_per_document}"
+        chunks.setdefault(document_id, []).append(
+            DocumentChunk(
+                id=f"{document_id}_{row % chunks_per_document}",
+                text="lorem ipsum " * 80,
+                metadata=DocumentChunkMetadata(
+                    document_id=document_id,
+                    source=Source.file,
+                    author="benchmark",
+                    created_at="2023-01-01",
+                ),
+                embedding=embedding.tolist(),
+            )
+        )
+    return chunks
+
+
+async def benchmark(
+    storage_type: str,
+    embeddings: np.ndarray,
+    queries: List[QueryWithEmbedding],
+    args: argparse.Namespace,
+) -> None:
+    datastore = await RedisDataStore.init(
+        dim=embeddings.shape[1],
+        storage_type=storage_type,
+        index_name=f"benchmark_{storage_type}",
+        doc_prefix=f"benchmark_{storage_type}",
+    )
+    client = datastore.client
+    try:
+        used_memory = (await client.info("memory"))["used_memory"]
+        chunks = make_chunks(embeddings, args.chunks_per_document)
+        document_ids = list(chunks)
+        start = time.perf_counter()
+        for batch_start in range(0, len(document_ids), args.upsert_batch_size):
+            await datastore._upsert(
+                {
+                    document_id: chunks[document_id]
+                    for document_id in document_ids[
+                        batch_start : batch_start + args.upsert_batch_size
+                    ]
+                }
+            )
+        elapsed = time.perf_counter() - start
+        print(
+            f"{storage_type}: upserted {len(embeddings)} chunks in {elapsed:.1f}s "
+            f"({len(embeddings) / elapsed:.0f} chunks/s)"
+        )
+
+        # Wait for the index to catch up before measuring its size
+        while int((await client.ft(datastore._index_name).info())["indexing"]):
+            await asyncio.sleep(0.1)
+        info = await client.ft(datastore._index_name).info()
+        sample = np.random.default_rng(0).choice(
+            len(embeddings), min(100, len(embeddings)), replace=False
+        )
+        key_bytes = [
+            await client.memory_usage(
+                datastore._redis_key(
+                    f"document-{row // args.chunks_per_document}",
+                    f"document-{row // args.chunks_per_document}_{row % args.chunks_per_document}",
+                )
+            )
+            for row in sample
+        ]
+        used_memory = (await client.info("memory"))["used_memory"] - used_memory
+        print(
+            f"  {np.mean(key_bytes):.0f} bytes per chunk key, "
+            f"vector index {float(info['vector_index_sz_mb']):.1f}MB, "
+            f"used memory +{used_memory / 2**20:.1f}MB "
+            f"({used_memory / len(embeddings):.0f} bytes per chunk)"
+        )
+
+        # A first run to warm up the connection and the index
+        await datastore._query(queries[: args.query_batch_size])
+        latencies = []
+        for batch_start in range(0, len(queries), args.query_batch_size):
+            start = time.perf_counter()
+            await datastore._query(
+                queries[batch_start : batch_start + args.query_batch_size]
+            )
+            latencies.append(time.perf_counter() - start)
+        latencies_ms = np.array(latencies) * 1000
+        print(
+            f"  query of {args.query_batch_size}: p50 {np.percentile(latencies_ms, 50):.2f}ms, "
+            f"p95 {np.percentile(latencies_ms, 95):.2f}ms"
+        )
+    finally:
+        await client.ft(datastore._index_name).dropindex(delete_documents=True)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_vectors", default=20000, type=int)
+    parser.add_argument("--dimension", default=1536, type=int)
+    parser.add_argument("--num_queries", default=200, type=int)
+    parser.add_argument("--top_k", default=10, type=int)
+    parser.add_argument(
+        "--chunks_per_document", default=10, type=int, help="The number of chunks of a document"
+    )
+    parser.add_argument(
+        "--upsert_batch_size",
+        default=10,
+        type=int,
+        help="The number of documents of an upsert",
+    )
+    parser.add_argument(
+        "--query_batch_size",
+        default=1,
+        type=int,
+        help="The number of queries of a request",
+    )
+    parser.add_argument(
+        "--storage_types",
+        default="json,hash",
+        help="A comma-separated list of the storage types to benchmark",
+    )
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    basis = normalize_embeddings(
+        rng.normal(size=(64, args.dimension)).astype(np.float32)
+    )
+    embeddings = generate_embeddings(args.num_vectors, args.dimension, 64, rng, basis)
+    queries = [
+        QueryWithEmbedding(query=str(i), embedding=embedding.tolist(), top_k=args.top_k)
+        for i, embedding in enumerate(
+            generate_embeddings(args.num_queries, args.dimension, 64, rng, basis)
+        )
+    ]
+    for storage_type in args.storage_types.split(","):
+        await benchmark(storage_type, embeddings, queries, args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
 from typing import Dict, List, Optional
 import asyncio
+import os
+
+from loguru import logger
 
 from models.models import (
     Document,
@@ -10,19 +13,58 @@ from models.models import (
     QueryResult,
     QueryWithEmbedding,
 )
-from services.chunks import get_document_chunks
-from services.openai import get_embeddings
+from services.chunks import (
+    create_documents_chunks,
+    embed_document_chunks,
+    get_chunk_content_hash,
+    get_document_chunks,
+)
+from services.embedding_cache import get_embedding_cache, get_query_embedding_cache
+from services.openai import aget_embeddings
+
+# Only write the chunks that changed since a document was last upserted, on providers that support it
+INCREMENTAL_UPSERT = os.environ.get("INCREMENTAL_UPSERT", "false").lower() == "true"
 
 
 class DataStore(ABC):
+    # Whether the provider implements _get_chunk_hashes and _delete_chunks
+    supports_incremental_upsert: bool = False
+
+    @property
+    def upserts_incrementally(self) -> bool:
+        """
+        Whether upserts only embed and write the new or changed chunks of the documents, with INCREMENTAL_UPSERT.
+        """
+        return INCREMENTAL_UPSERT and self.supports_incremental_upsert
+
     async def upsert(
         self, documents: List[Document], chunk_token_size: Optional[int] = None
     ) -> List[str]:
         """
         Takes in a list of documents and inserts them into the database.
         First deletes all the existing vectors with the document id (if necessary, depends on the vector db), then inserts the new ones.
+        With INCREMENTAL_UPSERT, only new or changed chunks are embedded and written instead, see _incremental_upsert.
+        Return a list of document ids.
+        """
+        if self.upserts_incrementally:
+            return await self._incremental_upsert(documents, chunk_token_size)
+
+        chunks = await get_document_chunks(documents, chunk_token_size)
+
+        return await self.upsert_chunks(documents, chunks)
+
+    async def upsert_chunks(
+        self, documents: List[Document], chunks: Dict[str, List[DocumentChunk]]
+    ) -> List[str]:
+        """
+        Takes in a list of documents and their chunks, already created and embedded, and inserts the chunks into the database
+        in place of the stored chunks of the documents. This is what upsert does once it has chunked and embedded the documents.
+        With INCREMENTAL_UPSERT, only new or changed chunks are written instead, see _incremental_upsert.
         Return a list of document ids.
         """
+        if self.upserts_incrementally:
+            return await self._upsert_changed_chunks(documents, chunks)
+
         # Delete any existing vectors for documents with the input document ids
         await asyncio.gather(
             *[
@@ -37,10 +79,90 @@ class DataStore(ABC):
             ]
         )
 
-        chunks = get_document_chunks(documents, chunk_token_size)
-
         return await self._upsert(chunks)
 
+    async def _incremental_upsert(
+        self, documents: List[Document], chunk_token_size: Optional[int] = None
+    ) -> List[str]:
+        """
+        Takes in a list of documents and only embeds and inserts the chunks whose content hash changed since they were last upserted.
+        Chunks of a document that no longer exist are deleted afterwards, so the document stays searchable throughout.
+        Return a list of document ids.
+        """
+        chunks: Dict[str, List[DocumentChunk]] = {}
+        for doc_chunks, doc_id in await create_documents_chunks(
+            documents, chunk_token_size
+        ):
+            chunks[doc_id] = doc_chunks
+        return await self._upsert_changed_chunks(documents, chunks)
+
+    async def _upsert_changed_chunks(
+        self, documents: List[Document], chunks: Dict[str, List[DocumentChunk]]
+    ) -> List[str]:
+        """
+        Takes in a list of documents and their chunks, and only inserts the chunks whose content hash changed, embedding
+        those that are not embedded yet. Chunks of a document that no longer exist are then deleted.
+        Return a list of document ids.
+        """
+        for doc_chunks in chunks.values():
+            for chunk in doc_chunks:
+                chunk.content_hash = get_chunk_content_hash(chunk)
+
+        # Only documents with an id given by the caller can already be stored
+        existing_hashes = await self._get_chunk_hashes(
+            [document.id for document in documents if document.id]
+        )
+
+        changed_chunks: Dict[str, List[DocumentChunk]] = {}
+        orphaned_chunk_ids: Dict[str, List[str]] = {}
+        for doc_id, doc_chunks in chunks.items():
+            stored = existing_hashes.get(doc_id, {})
+            changed = [
+                chunk for chunk in doc_chunks if stored.get(chunk.id) != chunk.content_hash  # type: ignore
+            ]
+            if changed:
+                changed_chunks[doc_id] = changed
+            chunk_ids = {chunk.id for chunk in doc_chunks}
+            orphaned = [chunk_id for chunk_id in stored if chunk_id not in chunk_ids]
+            if orphaned:
+                orphaned_chunk_ids[doc_id] = orphaned
+
+        logger.info(
+            f"Upserting {sum(len(v) for v in changed_chunks.values())} changed chunks "
+            f"and deleting {sum(len(v) for v in orphaned_chunk_ids.values())} orphaned chunks "
+            f"of {len(chunks)} documents"
+        )
+
+        if changed_chunks:
+            await embed_document_chunks(
+                [
+                    chunk
+                    for doc_chunks in changed_chunks.values()
+                    for chunk in doc_chunks
+                    if chunk.embedding is None
+                ]
+            )
+            await self._upsert(changed_chunks)
+        if orphaned_chunk_ids:
+            await self._delete_chunks(orphaned_chunk_ids)
+
+        return list(chunks.keys())
+
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Takes in a list of document ids and returns, for each stored document, a dict from chunk id to the content hash of the chunk.
+        Chunks stored without a content hash map to None.
+        """
+        raise NotImplementedError
+
+    async def _delete_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        """
+        Takes in a dict from document id to the ids of chunks of that document and removes those chunks.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
         """
@@ -56,7 +178,12 @@ class DataStore(ABC):
         """
         # get a list of of just the queries from the Query list
         query_texts = [query.query for query in queries]
-        query_embeddings = get_embeddings(query_texts)
+        # repeated queries are served from the query embedding cache first, then
+        # from the embedding cache, before calling the embeddings API
+        query_embeddings = await get_query_embedding_cache().get_or_embed(
+            query_texts,
+            lambda texts: get_embedding_cache().get_or_embed(texts, aget_embeddings),
+        )
         # hydrate the queries with embeddings
         queries_with_embeddings = [
             QueryWithEmbedding(**query.dict(), embedding=embedding)
@@ -7,15 +7,22 @@ async def get_datastore() -> DataStore:
     assert datastore is not None
 
     match datastore:
-    
-				case "minio":
-				    from your_module import MinioDataStore  # Replace 'your_module' with the actual module name
-				    return MinioDataStore()  # Add any required arguments
-				
-				case "minio_langchain":
-				    from your_module import MinioLangchainDataStore  # Replace 'your_module' with the actual module name
-				    return MinioLangchainDataStore()  # Add any required arguments
+        case "minio":
+            from your_module import MinioDataStore  # Replace 'your_module' with the actual module name
 
+            return MinioDataStore()  # Add any required arguments
+        case "minio_langchain":
+            from your_module import MinioLangchainDataStore  # Replace 'your_module' with the actual module name
+
+            return MinioLangchainDataStore()  # Add any required arguments
+        case "local":
+            from datastore.providers.local_datastore import LocalDataStore
+
+            return LocalDataStore()
+        case "segments":
+            from datastore.providers.segment_datastore import SegmentDataStore
+
+            return SegmentDataStore()
         case "chroma":
             from datastore.providers.chroma_datastore import ChromaDataStore
 
@@ -74,5 +81,5 @@ async def get_datastore() -> DataStore:
         case _:
             raise ValueError(
                 f"Unsupported vector database: {datastore}. "
-                f"Try one of the following: llama, elasticsearch, pinecone, weaviate, milvus, zilliz, redis, azuresearch, or qdrant"
+                f"Try one of the following: local, segments, llama, elasticsearch, pinecone, weaviate, milvus, zilliz, redis, azuresearch, or qdrant"
             )
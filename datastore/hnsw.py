@@ -0,0 +1,531 @@
+"""
+Hierarchical navigable small world (HNSW) graph index for approximate nearest neighbor search.
+
+An implementation of Malkov and Yashunin, "Efficient and robust approximate nearest neighbor search
+using Hierarchical Navigable Small World graphs" (2016), in NumPy, for in-process datastores.
+Vectors are compared by inner product, so they should be unit vectors for the scores to be cosine similarities.
+
+Each vector is inserted with an integer label, which is what searches return. Inserting a label again replaces its vector,
+and removed labels are only marked deleted: their nodes stay in the graph to route searches, but are never returned,
+until compact drops them.
+"""
+
+import heapq
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_M = 16
+DEFAULT_EF_CONSTRUCTION = 100
+DEFAULT_EF_SEARCH = 64
+
+
+class HNSWIndex:
+    """
+    m is the number of neighbors each node is linked to on the upper layers, and 2 * m on the bottom layer:
+    larger values give a better recall, at the cost of memory and of slower inserts and searches.
+    ef_construction is the size of the candidate list when inserting, and ef_search the default size of the
+    candidate list when searching: the larger, the better the recall and the slower the insert or search.
+    """
+
+    def __init__(
+        self,
+        dimension: int,
+        m: int = DEFAULT_M,
+        ef_construction: int = DEFAULT_EF_CONSTRUCTION,
+        ef_search: int = DEFAULT_EF_SEARCH,
+        initial_capacity: int = 1024,
+        seed: Optional[int] = None,
+    ):
+        if m < 2:
+            raise ValueError("m must be at least 2")
+        self.dimension = dimension
+        self.m = m
+        self.m0 = 2 * m
+        self.ef_construction = max(ef_construction, m)
+        self.ef_search = ef_search
+        # Probability 1 / m for a node to also be on the next layer up
+        self._level_mult = 1 / math.log(m)
+        self._rng = np.random.default_rng(seed)
+
+        self._size = 0
+        self._vectors = np.zeros((max(1, initial_capacity), dimension), dtype=np.float32)
+        self._labels = np.zeros(len(self._vectors), dtype=np.int64)
+        self._levels = np.zeros(len(self._vectors), dtype=np.int32)
+        self._deleted = np.zeros(len(self._vectors), dtype=bool)
+        # The neighbors of every node on the bottom layer, in the first _counts[node] columns of its row. Rows
+        # have room for a quarter more links than m0, like the slack of the DiskANN graph: a node is pruned back
+        # to m0 links only once its row is full
+        self._links = np.zeros(
+            (len(self._vectors), self.m0 + max(1, self.m0 // 4)), dtype=np.int32
+        )
+        self._counts = np.zeros(len(self._vectors), dtype=np.int32)
+        # The neighbors on layers 1 and up, of the few nodes that are on them: _upper_links[node][level - 1]
+        self._upper_links: Dict[int, List[List[int]]] = {}
+        self._upper_capacity = self.m + max(1, self.m // 4)
+        self._label_nodes: Dict[int, int] = {}
+        # A node is visited by the current search when its mark is the current tag, so that the marks of
+        # every search need not be reset
+        self._visit_marks = np.zeros(len(self._vectors), dtype=np.int64)
+        self._visit_tag = 0
+        self._entry_point = -1
+        self._max_level = -1
+
+    def __len__(self) -> int:
+        return len(self._label_nodes)
+
+    @property
+    def deleted_count(self) -> int:
+        return self._size - len(self._label_nodes)
+
+    def _grow(self, count: int) -> None:
+        capacity = len(self._vectors)
+        if self._size + count <= capacity:
+            return
+        capacity = max(self._size + count, 2 * capacity)
+
+        def resized(array: np.ndarray) -> np.ndarray:
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[: self._size] = array[: self._size]
+            return grown
+
+        self._vectors = resized(self._vectors)
+        self._labels = resized(self._labels)
+        self._levels = resized(self._levels)
+        self._deleted = resized(self._deleted)
+        self._links = resized(self._links)
+        self._counts = resized(self._counts)
+        self._visit_marks = resized(self._visit_marks)
+
+    def _neighbors(self, node: int, level: int) -> np.ndarray:
+        if level == 0:
+            return self._links[node, : self._counts[node]]
+        return np.array(self._upper_links[node][level - 1], dtype=np.int32)
+
+    def _set_neighbors(self, node: int, level: int, neighbors: List[int]) -> None:
+        if level == 0:
+            self._links[node, : len(neighbors)] = neighbors
+            self._counts[node] = len(neighbors)
+        else:
+            self._upper_links[node][level - 1] = list(neighbors)
+
+    def _search_layer(
+        self,
+        query: np.ndarray,
+        entry_points: List[Tuple[float, int]],
+        ef: int,
+        level: int,
+        returnable_only: bool = False,
+        allowed: Optional[np.ndarray] = None,
+    ) -> List[Tuple[float, int]]:
+        """
+        Beam search of one layer from the entry points, as (score, node) pairs. Returns up to ef (score, node) pairs
+        of the best nodes found, unordered. If returnable_only, only the nodes that are not deleted and whose label
+        is allowed are returned, but the others are still expanded, so that they keep the graph connected.
+        """
+        self._visit_tag += 1
+        marks, tag = self._visit_marks, self._visit_tag
+        # A max-heap of the nodes to expand, and a min-heap of the best nodes found
+        candidates = [(-score, node) for score, node in entry_points]
+        heapq.heapify(candidates)
+        results: List[Tuple[float, int]] = []
+        for score, node in entry_points:
+            marks[node] = tag
+            if not returnable_only or self._returnable(
+                np.array([node]), allowed
+            ).all():
+                results.append((score, node))
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            negative_score, node = heapq.heappop(candidates)
+            if len(results) >= ef and -negative_score < results[0][0]:
+                break
+            neighbors = self._neighbors(node, level)
+            neighbors = neighbors[marks[neighbors] != tag]
+            if not len(neighbors):
+                continue
+            marks[neighbors] = tag
+            scores = self._vectors[neighbors] @ query
+            # Most neighbors are worse than the worst result, leave them out before looping over the others
+            if len(results) >= ef:
+                better = scores > results[0][0]
+                neighbors, scores = neighbors[better], scores[better]
+                if not len(neighbors):
+                    continue
+            if returnable_only:
+                returnable = self._returnable(neighbors, allowed).tolist()
+            else:
+                returnable = [True] * len(neighbors)
+            for neighbor, score, is_returnable in zip(
+                neighbors.tolist(), scores.tolist(), returnable
+            ):
+                if len(results) < ef or score > results[0][0]:
+                    heapq.heappush(candidates, (-score, neighbor))
+                    if is_returnable:
+                        heapq.heappush(results, (score, neighbor))
+                        if len(results) > ef:
+                            heapq.heappop(results)
+        return results
+
+    def _returnable(self, nodes: np.ndarray, allowed: Optional[np.ndarray]) -> np.ndarray:
+        returnable = ~self._deleted[nodes]
+        if allowed is not None:
+            # The labels of deleted nodes may be out of the range of allowed
+            returnable[returnable] = allowed[self._labels[nodes[returnable]]]
+        return returnable
+
+    def _select_neighbors(
+        self, candidates: List[Tuple[float, int]], count: int
+    ) -> List[int]:
+        """
+        Select up to count neighbors of a vector among the (score, node) candidates scored against it, with the
+        heuristic of the paper: a candidate is only kept if it is closer to the vector than to the neighbors kept
+        before it, which spreads the links in every direction instead of clustering them. Pruned candidates fill
+        the remaining links, if any.
+        """
+        candidates = sorted(candidates, reverse=True)
+        if len(candidates) <= count:
+            return [node for _, node in candidates]
+        nodes = [node for _, node in candidates]
+        scores = np.array([score for score, _ in candidates], dtype=np.float32)
+        vectors = self._vectors[nodes]
+        # blocked[j] once candidate j is closer to a selected neighbor than to the vector
+        blocked = np.zeros(len(nodes), dtype=bool)
+        selected: List[int] = []
+        for i in range(len(nodes)):
+            if len(selected) == count:
+                break
+            if not blocked[i]:
+                selected.append(i)
+                blocked[i + 1 :] |= vectors[i + 1 :] @ vectors[i] > scores[i + 1 :]
+        pruned = np.flatnonzero(blocked[: i + 1])[: count - len(selected)].tolist()
+        return [nodes[i] for i in selected + pruned]
+
+    def _prune(self, nodes: np.ndarray, candidates: np.ndarray, count: int) -> np.ndarray:
+        """
+        Select count neighbors of each node among the candidates of its row, with the same heuristic as
+        _select_neighbors, for all the nodes at once: the candidates of every row are compared with each other in
+        a single batched matrix multiplication, and the heuristic then loops over the columns rather than over the
+        nodes and candidates. Every row must have more than count candidates.
+        """
+        rows = np.arange(len(nodes))[:, np.newaxis]
+        vectors = self._vectors[candidates]
+        scores = np.einsum("nld,nd->nl", vectors, self._vectors[nodes])
+        order = np.argsort(-scores, axis=1, kind="stable")
+        candidates, scores, vectors = (
+            candidates[rows, order],
+            scores[rows, order],
+            vectors[rows, order],
+        )
+        # closer[r, i, j] when candidate j of row r is closer to candidate i than to the node
+        closer = vectors @ vectors.transpose(0, 2, 1) > scores[:, np.newaxis, :]
+
+        blocked = np.zeros(candidates.shape, dtype=bool)
+        selected = np.zeros(candidates.shape, dtype=bool)
+        counts = np.zeros(len(nodes), dtype=np.int64)
+        for i in range(candidates.shape[1]):
+            keep = ~blocked[:, i] & (counts < count)
+            selected[:, i] = keep
+            counts += keep
+            blocked[keep] |= closer[keep, i]
+        pruned = blocked & ~selected
+        selected |= pruned & (np.cumsum(pruned, axis=1) <= (count - counts)[:, np.newaxis])
+        # The selected candidates of every row, best first
+        return candidates[rows, np.argsort(~selected, axis=1, kind="stable")[:, :count]]
+
+    def _random_level(self) -> int:
+        return int(-math.log(1.0 - self._rng.random()) * self._level_mult)
+
+    def add(self, vectors: np.ndarray, labels: np.ndarray) -> None:
+        """
+        Insert the vectors with their labels. The vectors of labels that are already in the index are replaced.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        self._grow(len(vectors))
+        for vector, label in zip(vectors, np.asarray(labels).tolist()):
+            self.remove([label])
+            self._insert(vector, label)
+
+    def _insert(self, vector: np.ndarray, label: int) -> None:
+        node = self._size
+        self._size += 1
+        level = self._random_level()
+        self._vectors[node] = vector
+        self._labels[node] = label
+        self._levels[node] = level
+        self._deleted[node] = False
+        self._counts[node] = 0
+        if level:
+            self._upper_links[node] = [[] for _ in range(level)]
+        self._label_nodes[label] = node
+
+        if self._entry_point < 0:
+            self._entry_point, self._max_level = node, level
+            return
+
+        entry = self._entry_point
+        entry_points = [(float(self._vectors[entry] @ vector), entry)]
+        # Greedy descent through the layers above the node's own
+        for layer in range(self._max_level, level, -1):
+            entry_points = [max(self._greedy_search(vector, entry_points[0], layer))]
+
+        for layer in range(min(level, self._max_level), -1, -1):
+            # Deleted nodes are linked to as well, they still route searches
+            found = self._search_layer(vector, entry_points, self.ef_construction, layer)
+            neighbors = self._select_neighbors(found, self.m)
+            self._set_neighbors(node, layer, neighbors)
+            self._link(np.array(neighbors, dtype=np.int64), node, layer)
+            entry_points = found
+
+        if level > self._max_level:
+            self._entry_point, self._max_level = node, level
+
+    def _greedy_search(
+        self, vector: np.ndarray, start: Tuple[float, int], level: int
+    ) -> List[Tuple[float, int]]:
+        best_score, best = start
+        changed = True
+        while changed:
+            changed = False
+            neighbors = self._neighbors(best, level)
+            if not len(neighbors):
+                break
+            scores = self._vectors[neighbors] @ vector
+            i = int(np.argmax(scores))
+            if scores[i] > best_score:
+                best_score, best = float(scores[i]), int(neighbors[i])
+                changed = True
+        return [(best_score, best)]
+
+    def _link(self, nodes: np.ndarray, new_neighbor: int, level: int) -> None:
+        """
+        Link the nodes back to their new neighbor. A node only selects the best spread of its links once it has no
+        room left for the new one, and then keeps max_links of them, so that the selection runs once for every
+        few new links, rather than for each one.
+        """
+        max_links = self.m0 if level == 0 else self.m
+        if level == 0:
+            counts = self._counts[nodes]
+            room = counts < self._links.shape[1]
+            self._links[nodes[room], counts[room]] = new_neighbor
+            self._counts[nodes[room]] += 1
+            full = nodes[~room]
+            links = self._links[full]
+        else:
+            full_nodes = []
+            for node in nodes.tolist():
+                neighbors = self._upper_links[node][level - 1]
+                if len(neighbors) < self._upper_capacity:
+                    neighbors.append(new_neighbor)
+                else:
+                    full_nodes.append(node)
+            full = np.array(full_nodes, dtype=np.int64)
+            links = np.array(
+                [self._upper_links[node][level - 1] for node in full_nodes],
+                dtype=np.int64,
+            ).reshape(len(full_nodes), self._upper_capacity)
+        if not len(full):
+            return
+
+        candidates = np.concatenate(
+            [links, np.full((len(full), 1), new_neighbor, dtype=links.dtype)], axis=1
+        )
+        selected = self._prune(full, candidates, max_links)
+        if level == 0:
+            self._links[full, :max_links] = selected
+            self._counts[full] = max_links
+        else:
+            for node, neighbors in zip(full.tolist(), selected.tolist()):
+                self._upper_links[node][level - 1] = neighbors
+
+    def remove(self, labels) -> None:
+        """
+        Mark the labels deleted, ignoring the ones that are not in the index.
+        """
+        for label in labels:
+            node = self._label_nodes.pop(int(label), None)
+            if node is not None:
+                self._deleted[node] = True
+
+    def compact(self) -> None:
+        """
+        Drop the deleted nodes from the graph. As in FreshDiskANN, the nodes linked to deleted ones are relinked to
+        the best spread of their other neighbors and of the neighbors of the deleted ones, so that the searches
+        they routed still reach the same nodes.
+        """
+        size = self._size
+        deleted = self._deleted[:size]
+        if not deleted.any():
+            return
+        for node in np.flatnonzero(~deleted).tolist():
+            for level in range(int(self._levels[node]) + 1):
+                neighbors = self._neighbors(node, level)
+                if not deleted[neighbors].any():
+                    continue
+                candidates = set(neighbors[~deleted[neighbors]].tolist())
+                for removed in neighbors[deleted[neighbors]].tolist():
+                    second = self._neighbors(removed, level)
+                    candidates.update(second[~deleted[second]].tolist())
+                candidates.discard(node)
+                self._set_neighbors(node, level, self._relink(node, list(candidates), level))
+
+        # Renumber the live nodes from 0, in order
+        live = np.flatnonzero(~deleted)
+        new_nodes = np.full(size, -1, dtype=np.int64)
+        new_nodes[live] = np.arange(len(live))
+        if deleted[self._entry_point]:
+            self._entry_point = int(live[np.argmax(self._levels[live])]) if len(live) else -1
+            self._max_level = int(self._levels[self._entry_point]) if len(live) else -1
+        self._entry_point = int(new_nodes[self._entry_point]) if len(live) else -1
+        for array in [self._vectors, self._labels, self._levels, self._links, self._counts]:
+            array[: len(live)] = array[live]
+        links = self._links[: len(live)]
+        valid = np.arange(links.shape[1]) < self._counts[: len(live), np.newaxis]
+        links[valid] = new_nodes[links[valid]]
+        # The columns past the counts may hold nodes of before a previous compaction
+        links[~valid] = 0
+        self._deleted[:size] = False
+        self._upper_links = {
+            int(new_nodes[node]): [new_nodes[links].tolist() for links in layers]
+            for node, layers in self._upper_links.items()
+            if not deleted[node]
+        }
+        self._size = len(live)
+        self._label_nodes = dict(
+            zip(self._labels[: self._size].tolist(), range(self._size))
+        )
+
+    def _relink(self, node: int, candidates: List[int], level: int) -> List[int]:
+        max_links = self.m0 if level == 0 else self.m
+        if len(candidates) <= max_links:
+            return candidates
+        scores = self._vectors[candidates] @ self._vectors[node]
+        # Only the best candidates can be selected, leave the others out of the heuristic
+        found = heapq.nlargest(self.ef_construction, zip(scores.tolist(), candidates))
+        return self._select_neighbors(found, max_links)
+
+    def relabel(self, new_labels: np.ndarray) -> None:
+        """
+        Change every label l in the index to new_labels[l]. Labels mapped to a negative value are removed.
+        """
+        labels = self._labels[: self._size]
+        live = ~self._deleted[: self._size]
+        labels[live] = new_labels[labels[live]]
+        self._deleted[: self._size] |= labels < 0
+        live_nodes = np.flatnonzero(~self._deleted[: self._size])
+        self._label_nodes = dict(
+            zip(self._labels[live_nodes].tolist(), live_nodes.tolist())
+        )
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        ef: Optional[int] = None,
+        allowed: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the labels of the approximate k nearest neighbors of query, and their scores, best first.
+        ef is the size of the candidate list, ef_search by default, and is at least k. If allowed is given, it is
+        a boolean array indexed by label, and only the allowed labels are returned.
+        """
+        if k <= 0 or not self._label_nodes:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+        ef = max(ef or self.ef_search, k)
+
+        entry = self._entry_point
+        entry_points = [(float(self._vectors[entry] @ query), entry)]
+        for layer in range(self._max_level, 0, -1):
+            entry_points = self._greedy_search(query, entry_points[0], layer)
+        found = sorted(
+            self._search_layer(query, entry_points, ef, 0, True, allowed),
+            reverse=True,
+        )[:k]
+        nodes = np.array([node for _, node in found], dtype=np.int64)
+        return (
+            self._labels[nodes],
+            np.array([score for score, _ in found], dtype=np.float32),
+        )
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Return the index as arrays, to be saved with np.savez and read back with from_arrays.
+        """
+        upper_nodes = sorted(self._upper_links)
+        upper_lists = [
+            links for node in upper_nodes for links in self._upper_links[node]
+        ]
+        return {
+            "parameters": np.array(
+                [
+                    self.dimension,
+                    self.m,
+                    self.ef_construction,
+                    self.ef_search,
+                    self._entry_point,
+                    self._max_level,
+                ],
+                dtype=np.int64,
+            ),
+            "vectors": self._vectors[: self._size],
+            "labels": self._labels[: self._size],
+            "levels": self._levels[: self._size],
+            "deleted": self._deleted[: self._size],
+            "links": self._links[: self._size],
+            "counts": self._counts[: self._size],
+            "upper_nodes": np.array(upper_nodes, dtype=np.int64),
+            "upper_lengths": np.array(
+                [len(links) for links in upper_lists], dtype=np.int64
+            ),
+            "upper_links": np.array(
+                [node for links in upper_lists for node in links], dtype=np.int32
+            ),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "HNSWIndex":
+        dimension, m, ef_construction, ef_search, entry_point, max_level = arrays[
+            "parameters"
+        ].tolist()
+        size = len(arrays["labels"])
+        index = cls(dimension, m, ef_construction, ef_search, initial_capacity=size)
+        index._size = size
+        for name in ["vectors", "labels", "levels", "deleted", "counts"]:
+            getattr(index, "_" + name)[:size] = arrays[name]
+        # Indexes saved before the rows had room for more than m0 links have narrower rows
+        index._links[:size, : arrays["links"].shape[1]] = arrays["links"]
+
+        lengths = iter(arrays["upper_lengths"].tolist())
+        upper_links = arrays["upper_links"].tolist()
+        offset = 0
+        for node in arrays["upper_nodes"].tolist():
+            index._upper_links[node] = []
+            for _ in range(int(index._levels[node])):
+                length = next(lengths)
+                index._upper_links[node].append(upper_links[offset : offset + length])
+                offset += length
+        index._entry_point, index._max_level = entry_point, max_level
+        live_nodes = np.flatnonzero(~index._deleted[:size])
+        index._label_nodes = dict(
+            zip(index._labels[live_nodes].tolist(), live_nodes.tolist())
+        )
+        return index
+
+    def save(self, path: str) -> None:
+        """
+        Write the index to path, replacing any previous file atomically.
+        """
+        temp_path = path + ".tmp.npz"
+        np.savez(temp_path, **self.to_arrays())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "HNSWIndex":
+        with np.load(path) as data:
+            return cls.from_arrays({name: data[name] for name in data.files})
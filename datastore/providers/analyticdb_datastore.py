@@ -1,6 +1,7 @@
 import os
 import asyncio
-from typing import Dict, List, Optional, Tuple, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Any
 from datetime import datetime
 from loguru import logger
 
@@ -9,7 +10,7 @@ from psycopg2cffi import compat
 compat.register()
 import psycopg2
 from psycopg2.extras import DictCursor
-from psycopg2.pool import SimpleConnectionPool
+from psycopg2.pool import ThreadedConnectionPool
 
 from services.date import to_unix_timestamp
 from datastore.datastore import DataStore
@@ -31,10 +32,27 @@ PG_CONFIG = {
     "port": int(os.environ.get("PG_PORT", "5432")),
 }
 OUTPUT_DIM = 1536
+# Maximum number of connections, and of statements running at once
+PG_POOL_SIZE = int(os.environ.get("PG_POOL_SIZE", 10))
+# Number of chunks written per transaction by an upsert
+UPSERT_BATCH_SIZE = 500
+
+UPSERT_COLUMNS = [
+    "id",
+    "content",
+    "embedding",
+    "document_id",
+    "source",
+    "source_id",
+    "url",
+    "author",
+    "created_at",
+]
+UPSERT_PLACEHOLDERS = "(%s::text, %s::text, %s::real[], %s::text, %s::text, %s::text, %s::text, %s::text, %s::timestamp with time zone)"
 
 
 class AnalyticDBDataStore(DataStore):
-    def __init__(self, config: Dict[str, str] = PG_CONFIG):
+    def __init__(self, config: Dict[str, str] = PG_CONFIG, pool_size: int = PG_POOL_SIZE):
         self.collection_name = config["collection"]
         self.user = config["user"]
         self.password = config["password"]
@@ -42,18 +60,45 @@ class AnalyticDBDataStore(DataStore):
         self.host = config["host"]
         self.port = config["port"]
 
-        self.connection_pool = SimpleConnectionPool(
+        self.connection_pool = ThreadedConnectionPool(
             minconn=1,
-            maxconn=100,
+            maxconn=pool_size,
             dbname=self.database,
             user=self.user,
             password=self.password,
             host=self.host,
             port=self.port,
         )
+        # As many threads as connections, so that a statement never waits for a connection in its thread
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="analyticdb"
+        )
 
         self._initialize_db()
 
+    async def _run(self, function: Callable[..., Any], *args: Any) -> Any:
+        """
+        Runs the function with a cursor of a pooled connection and the given arguments in the executor, without
+        blocking the event loop, and commits its transaction.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._with_cursor, function, *args
+        )
+
+    def _with_cursor(self, function: Callable[..., Any], *args: Any) -> Any:
+        conn = self.connection_pool.getconn()
+        try:
+            with conn.cursor(cursor_factory=DictCursor) as cur:
+                result = function(cur, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.connection_pool.putconn(conn)
+
     def _initialize_db(self):
         conn = self.connection_pool.getconn()
         try:
@@ -99,7 +144,7 @@ class AnalyticDBDataStore(DataStore):
                 USING ann(embedding)
                 WITH (
                     distancemeasure=L2,
-                    dim=OUTPUT_DIM,
+                    dim={OUTPUT_DIM},
                     pq_segments=64,
                     hnsw_m=100,
                     pq_centers=2048
@@ -112,23 +157,32 @@ class AnalyticDBDataStore(DataStore):
         Takes in a dict of document_ids to list of document chunks and inserts them into the database.
         Return a list of document ids.
         """
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(None, self._upsert_chunk, chunk)
-            for document_chunks in chunks.values()
-            for chunk in document_chunks
-        ]
-        await asyncio.gather(*tasks)
+        # The last chunk of an id wins, since a statement can not update a row twice
+        rows = list(
+            {
+                chunk.id: self._chunk_row(chunk)
+                for document_chunks in chunks.values()
+                for chunk in document_chunks
+            }.values()
+        )
+        # Write the batches concurrently, each in a single transaction
+        await asyncio.gather(
+            *[
+                self._run(self._upsert_rows, rows[start : start + UPSERT_BATCH_SIZE])
+                for start in range(0, len(rows), UPSERT_BATCH_SIZE)
+            ]
+        )
 
         return list(chunks.keys())
 
-    def _upsert_chunk(self, chunk: DocumentChunk):
+    @staticmethod
+    def _chunk_row(chunk: DocumentChunk) -> Tuple[Any, ...]:
         created_at = (
             datetime.fromtimestamp(to_unix_timestamp(chunk.metadata.created_at))
             if chunk.metadata.created_at
             else None
         )
-        data = (
+        return (
             chunk.id,
             chunk.text,
             chunk.embedding,
@@ -140,124 +194,116 @@ class AnalyticDBDataStore(DataStore):
             created_at,
         )
 
-        conn = self.connection_pool.getconn()
-        try:
-            with conn.cursor() as cur:
-                # Construct the SQL query and data
-                query = f"""
-                        INSERT INTO {self.collection_name} (id, content, embedding, document_id, source, source_id, url, author, created_at)
-                        VALUES (%s::text, %s::text, %s::real[], %s::text, %s::text, %s::text, %s::text, %s::text, %s::timestamp with time zone)
-                        ON CONFLICT (id) DO UPDATE SET
-                            content = EXCLUDED.content,
-                            embedding = EXCLUDED.embedding,
-                            document_id = EXCLUDED.document_id,
-                            source = EXCLUDED.source,
-                            source_id = EXCLUDED.source_id,
-                            url = EXCLUDED.url,
-                            author = EXCLUDED.author,
-                            created_at = EXCLUDED.created_at;
-                """
-
-                # Execute the query
-                cur.execute(query, data)
-
-                # Commit the transaction
-                conn.commit()
-        finally:
-            self.connection_pool.putconn(conn)
+    def _upsert_rows(self, cur, rows: List[Tuple[Any, ...]]):
+        # A multi-row statement for the whole batch
+        query = f"""
+                INSERT INTO {self.collection_name} ({', '.join(UPSERT_COLUMNS)})
+                VALUES {', '.join([UPSERT_PLACEHOLDERS] * len(rows))}
+                ON CONFLICT (id) DO UPDATE SET
+                    content = EXCLUDED.content,
+                    embedding = EXCLUDED.embedding,
+                    document_id = EXCLUDED.document_id,
+                    source = EXCLUDED.source,
+                    source_id = EXCLUDED.source_id,
+                    url = EXCLUDED.url,
+                    author = EXCLUDED.author,
+                    created_at = EXCLUDED.created_at;
+        """
+        cur.execute(query, [value for row in rows for value in row])
 
     async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
         """
         Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
         """
-        query_results: List[QueryResult] = []
-
-        def generate_query(query: QueryWithEmbedding) -> Tuple[str, List[Any]]:
-            embedding = "[" + ", ".join(str(x) for x in query.embedding) + "]"
-            q = f"""
-                SELECT
-                    id,
-                    content,
-                    source,
-                    source_id,
-                    document_id,
-                    url,
-                    created_at,
-                    author,
-                    embedding,
-                    l2_distance(embedding,array{embedding}::real[]) AS similarity
-                FROM
-                    {self.collection_name}
-            """
-            where_clause, params = generate_where_clause(query.filter)
-            q += where_clause
-            q += f"ORDER BY embedding <-> array{embedding}::real[] LIMIT {query.top_k};"
-            return q, params
-
-        def generate_where_clause(
-            query_filter: Optional[DocumentMetadataFilter],
-        ) -> Tuple[str, List[Any]]:
-            if query_filter is None:
-                return "", []
-
-            conditions = [
-                ("document_id=%s", query_filter.document_id),
-                ("source_id=%s", query_filter.source_id),
-                ("source LIKE %s", query_filter.source),
-                ("author LIKE %s", query_filter.author),
-                ("created_at >= %s", query_filter.start_date),
-                ("created_at <= %s", query_filter.end_date),
-            ]
+        # Run the queries concurrently, each over a connection of the pool
+        return list(await asyncio.gather(*[self._query_one(query) for query in queries]))
 
-            where_clause = "WHERE " + " AND ".join(
-                [cond[0] for cond in conditions if cond[1] is not None]
-            )
+    async def _query_one(self, query: QueryWithEmbedding) -> QueryResult:
+        """
+        Returns the query result of a single query, without any result if the query fails.
+        """
+        try:
+            q, params = self._generate_query(query)
+            data = await self._run(self._fetch_data, q, params)
+            return QueryResult(query=query.query, results=self._create_results(data))
+        except Exception as e:
+            logger.error(e)
+            return QueryResult(query=query.query, results=[])
+
+    def _generate_query(self, query: QueryWithEmbedding) -> Tuple[str, List[Any]]:
+        # The embedding is a bound array parameter rather than an array literal in the statement
+        where_clause, params = self._generate_where_clause(query.filter)
+        q = f"""
+            SELECT
+                id,
+                content,
+                source,
+                source_id,
+                document_id,
+                url,
+                created_at,
+                author,
+                embedding,
+                l2_distance(embedding, %s::real[]) AS similarity
+            FROM
+                {self.collection_name}
+            {where_clause}
+            ORDER BY embedding <-> %s::real[] LIMIT %s;
+        """
+        return q, [query.embedding, *params, query.embedding, query.top_k]
 
-            values = [cond[1] for cond in conditions if cond[1] is not None]
-
-            return where_clause, values
-
-        def fetch_data(cur, q: str, params: List[Any]):
-            cur.execute(q, params)
-            return cur.fetchall()
-
-        def create_results(data):
-            results = []
-            for row in data:
-                document_chunk = DocumentChunkWithScore(
-                    id=row["id"],
-                    text=row["content"],
-                    score=float(row["similarity"]),
-                    metadata=DocumentChunkMetadata(
-                        source=row["source"],
-                        source_id=row["source_id"],
-                        document_id=row["document_id"],
-                        url=row["url"],
-                        created_at=str(row["created_at"]),
-                        author=row["author"],
-                    ),
-                )
-                results.append(document_chunk)
-            return results
+    @staticmethod
+    def _generate_where_clause(
+        query_filter: Optional[DocumentMetadataFilter],
+    ) -> Tuple[str, List[Any]]:
+        if query_filter is None:
+            return "", []
 
-        conn = self.connection_pool.getconn()
-        try:
-            for query in queries:
-                try:
-                    cur = conn.cursor(cursor_factory=DictCursor)
-                    for query in queries:
-                        q, params = generate_query(query)
-                        data = fetch_data(cur, q, params)
-                        results = create_results(data)
-                        query_results.append(
-                            QueryResult(query=query.query, results=results)
-                        )
-                except Exception as e:
-                    logger.error(e)
-                    query_results.append(QueryResult(query=query.query, results=[]))
-            return query_results
-        finally:
-            self.connection_pool.putconn(conn)
+        conditions = [
+            ("document_id=%s", query_filter.document_id),
+            ("source_id=%s", query_filter.source_id),
+            ("source LIKE %s", query_filter.source),
+            ("author LIKE %s", query_filter.author),
+            ("created_at >= %s", query_filter.start_date),
+            ("created_at <= %s", query_filter.end_date),
+        ]
+        conditions = [cond for cond in conditions if cond[1] is not None]
+        if not conditions:
+            return "", []
+
+        where_clause = "WHERE " + " AND ".join([cond[0] for cond in conditions])
+        values = [cond[1] for cond in conditions]
+
+        return where_clause, values
+
+    @staticmethod
+    def _fetch_data(cur, q: str, params: List[Any]):
+        cur.execute(q, params)
+        return cur.fetchall()
+
+    @staticmethod
+    def _execute(cur, q: str, params: Optional[List[Any]] = None):
+        cur.execute(q, params or None)
+
+    @staticmethod
+    def _create_results(data) -> List[DocumentChunkWithScore]:
+        results = []
+        for row in data:
+            document_chunk = DocumentChunkWithScore(
+                id=row["id"],
+                text=row["content"],
+                score=float(row["similarity"]),
+                metadata=DocumentChunkMetadata(
+                    source=row["source"],
+                    source_id=row["source_id"],
+                    document_id=row["document_id"],
+                    url=row["url"],
+                    created_at=str(row["created_at"]),
+                    author=row["author"],
+                ),
+            )
+            results.append(document_chunk)
+        return results
 
     async def delete(
         self,
@@ -266,20 +312,12 @@ class AnalyticDBDataStore(DataStore):
         delete_all: Optional[bool] = None,
     ) -> bool:
         async def execute_delete(query: str, params: Optional[List] = None) -> bool:
-            conn = self.connection_pool.getconn()
             try:
-                with conn.cursor() as cur:
-                    if params:
-                        cur.execute(query, params)
-                    else:
-                        cur.execute(query)
-                    self.conn.commit()
+                await self._run(self._execute, query, params)
                 return True
             except Exception as e:
                 logger.error(e)
                 return False
-            finally:
-                self.connection_pool.putconn(conn)
 
         if delete_all:
             query = f"DELETE FROM {self.collection_name} WHERE document_id LIKE %s;"
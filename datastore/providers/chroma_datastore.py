@@ -13,7 +13,7 @@ from typing import Dict, List, Optional
 
 import chromadb
 
-from datastore.datastore import DataStore
+from datastore.datastore import INCREMENTAL_UPSERT, DataStore
 from models.models import (
     Document,
     DocumentChunk,
@@ -24,7 +24,6 @@ from models.models import (
     QueryWithEmbedding,
     Source,
 )
-from services.chunks import get_document_chunks
 
 CHROMA_IN_MEMORY = os.environ.get("CHROMA_IN_MEMORY", "True")
 CHROMA_PERSISTENCE_DIR = os.environ.get("CHROMA_PERSISTENCE_DIR", "openai")
@@ -34,6 +33,8 @@ CHROMA_COLLECTION = os.environ.get("CHROMA_COLLECTION", "openaiembeddings")
 
 
 class ChromaDataStore(DataStore):
+    supports_incremental_upsert = True
+
     def __init__(
         self,
         in_memory: bool = CHROMA_IN_MEMORY,  # type: ignore
@@ -70,15 +71,16 @@ class ChromaDataStore(DataStore):
             embedding_function=None,
         )
 
-    async def upsert(
-        self, documents: List[Document], chunk_token_size: Optional[int] = None
+    async def upsert_chunks(
+        self, documents: List[Document], chunks: Dict[str, List[DocumentChunk]]
     ) -> List[str]:
         """
-        Takes in a list of documents and inserts them into the database. If an id already exists, the document is updated.
+        Takes in a list of documents and their chunks, already created and embedded, and inserts the chunks into the database.
+        If an id already exists, the chunk is updated.
         Return a list of document ids.
         """
-
-        chunks = get_document_chunks(documents, chunk_token_size)
+        if INCREMENTAL_UPSERT:
+            return await self._upsert_changed_chunks(documents, chunks)
 
         # Chroma has a true upsert, so we don't need to delete first
         return await self._upsert(chunks)
@@ -100,7 +102,7 @@ class ChromaDataStore(DataStore):
                 chunk.text for chunk_list in chunks.values() for chunk in chunk_list
             ],
             metadatas=[
-                self._process_metadata_for_storage(chunk.metadata)
+                self._process_metadata_for_storage(chunk.metadata, chunk.content_hash)
                 for chunk_list in chunks.values()
                 for chunk in chunk_list
             ],
@@ -143,8 +145,12 @@ class ChromaDataStore(DataStore):
 
         return output
 
-    def _process_metadata_for_storage(self, metadata: DocumentChunkMetadata) -> Dict:
+    def _process_metadata_for_storage(
+        self, metadata: DocumentChunkMetadata, content_hash: Optional[str] = None
+    ) -> Dict:
         stored_metadata = {}
+        if content_hash:
+            stored_metadata["content_hash"] = content_hash
         if metadata.source:
             stored_metadata["source"] = metadata.source.value
         if metadata.source_id:
@@ -174,6 +180,37 @@ class ChromaDataStore(DataStore):
             document_id=metadata.get("document_id", None),
         )
 
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Takes in a list of document ids and returns, for each stored document, a dict from chunk id to the content hash of the chunk.
+        """
+        hashes: Dict[str, Dict[str, Optional[str]]] = {}
+        if not document_ids:
+            return hashes
+
+        if len(document_ids) > 1:
+            where_clause = {"$or": [{"document_id": id_} for id_ in document_ids]}
+        else:
+            (id_,) = document_ids
+            where_clause = {"document_id": id_}
+
+        result = self._collection.get(where=where_clause, include=["metadatas"])
+        for id_, metadata in zip(result["ids"], result["metadatas"]):
+            hashes.setdefault(metadata["document_id"], {})[id_] = metadata.get(
+                "content_hash"
+            )
+        return hashes
+
+    async def _delete_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        """
+        Takes in a dict from document id to chunk ids and deletes those chunks.
+        """
+        self._collection.delete(
+            ids=[chunk_id for ids in chunk_ids.values() for chunk_id in ids]
+        )
+
     async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
         """
         Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
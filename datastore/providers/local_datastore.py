@@ -0,0 +1,727 @@
+"""
+Local datastore for the ChatGPT retrieval plugin.
+
+Keeps the embeddings in a contiguous float32 NumPy matrix and the metadata in columns, inside the plugin process,
+and answers queries with an exact search, or with an HNSW graph index when LOCAL_INDEX is set to hnsw.
+It needs no external service, which suits single-node deployments and tests.
+
+The datastore is only read and changed in a single thread of its own, so that searches and inserts don't block
+the event loop, and never see a change half made.
+"""
+
+import asyncio
+import glob
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from datastore.datastore import DataStore
+from datastore.hnsw import (
+    DEFAULT_EF_CONSTRUCTION,
+    DEFAULT_EF_SEARCH,
+    DEFAULT_M,
+    HNSWIndex,
+)
+from models.models import (
+    Document,
+    DocumentChunk,
+    DocumentChunkMetadata,
+    DocumentChunkWithScore,
+    DocumentMetadataFilter,
+    QueryResult,
+    QueryWithEmbedding,
+    Source,
+)
+from services.date import to_unix_timestamp
+
+LOCAL_PERSISTENCE_DIR = os.environ.get("LOCAL_PERSISTENCE_DIR")
+LOCAL_INITIAL_CAPACITY = int(os.environ.get("LOCAL_INITIAL_CAPACITY", 1024))
+LOCAL_INDEX = os.environ.get("LOCAL_INDEX", "exact")
+LOCAL_HNSW_M = int(os.environ.get("LOCAL_HNSW_M", DEFAULT_M))
+LOCAL_HNSW_EF_CONSTRUCTION = int(
+    os.environ.get("LOCAL_HNSW_EF_CONSTRUCTION", DEFAULT_EF_CONSTRUCTION)
+)
+LOCAL_HNSW_EF_SEARCH = int(os.environ.get("LOCAL_HNSW_EF_SEARCH", DEFAULT_EF_SEARCH))
+# Drop the deleted chunks from the HNSW graph once they are more than this fraction of its nodes
+LOCAL_HNSW_MAX_DELETED_RATIO = float(
+    os.environ.get("LOCAL_HNSW_MAX_DELETED_RATIO", 0.3)
+)
+# Rewrite the persisted datastore once its log holds more chunks than this fraction of the stored chunks
+LOCAL_LOG_COMPACT_RATIO = float(os.environ.get("LOCAL_LOG_COMPACT_RATIO", 0.5))
+
+INDEX_TYPES = ["exact", "hnsw"]
+# Queries whose filter leaves at most this many chunks to search are answered exactly even with an index:
+# scoring them all is then about as fast as searching the graph, and the results are exact
+HNSW_EXACT_MAX_ROWS = 10000
+
+DATASTORE_FILE = "datastore.npz"
+# The changes made since the datastore file of the same generation was written
+LOG_FILE = "datastore.{generation}.log"
+METADATA_COLUMNS = ["document_id", "source", "source_id", "url", "created_at", "author"]
+COLUMNS = ["id", "text", "content_hash"] + METADATA_COLUMNS
+
+
+# Set while a write operation runs, so that the writes it makes through other operations are persisted with it
+_write_operation: ContextVar[bool] = ContextVar("local_write_operation", default=False)
+
+
+def _object_array(values: Iterable, size: int) -> np.ndarray:
+    array = np.empty(size, dtype=object)
+    array[:] = list(values)
+    return array
+
+
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    # Unit vectors, so that the dot product of two of them is their cosine similarity
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def select_top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the columns of the k best scores of each row of scores, and those scores, best first.
+    The k best columns are selected in linear time with argpartition, then only those are sorted.
+    """
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+    return (
+        np.take_along_axis(candidates, order, axis=1),
+        np.take_along_axis(candidate_scores, order, axis=1),
+    )
+
+
+class LocalDataStore(DataStore):
+    supports_incremental_upsert = True
+
+    def __init__(
+        self,
+        persistence_dir: Optional[str] = LOCAL_PERSISTENCE_DIR,
+        initial_capacity: int = LOCAL_INITIAL_CAPACITY,
+        index: str = LOCAL_INDEX,
+        hnsw_m: int = LOCAL_HNSW_M,
+        hnsw_ef_construction: int = LOCAL_HNSW_EF_CONSTRUCTION,
+        hnsw_ef_search: int = LOCAL_HNSW_EF_SEARCH,
+        hnsw_max_deleted_ratio: float = LOCAL_HNSW_MAX_DELETED_RATIO,
+    ):
+        if index not in INDEX_TYPES:
+            raise ValueError(
+                f"Unsupported local index {index}, try one of {', '.join(INDEX_TYPES)}"
+            )
+        self._persistence_dir = persistence_dir
+        self._initial_capacity = max(1, initial_capacity)
+        self._index_type = index
+        self._hnsw_m = hnsw_m
+        self._hnsw_ef_construction = hnsw_ef_construction
+        self._hnsw_ef_search = hnsw_ef_search
+        self._hnsw_max_deleted_ratio = hnsw_max_deleted_ratio
+        # The changes not written to the log yet, the number of chunks the log holds, and the generation of the
+        # datastore file that the log applies to
+        self._pending: List[Tuple[Dict, Optional[np.ndarray]]] = []
+        self._logged_rows = 0
+        self._generation = 0
+        self._persist_lock = asyncio.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local")
+        self._clear()
+        if persistence_dir and (
+            os.path.exists(os.path.join(persistence_dir, DATASTORE_FILE))
+            or os.path.exists(self._log_path(0))
+        ):
+            self._load()
+
+    async def _run(self, function: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run function with the given arguments in the thread of the datastore, without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _clear(self) -> None:
+        # Rows [0, self._size) of the matrix and of the columns hold the stored chunks,
+        # the rows after them are spare capacity for the next upserts
+        self._size = 0
+        self._embeddings = np.zeros((0, 0), dtype=np.float32)
+        self._columns: Dict[str, np.ndarray] = {
+            name: np.empty(0, dtype=object) for name in COLUMNS
+        }
+        # created_at as unix timestamps for the date filters, nan when missing
+        self._timestamps = np.empty(0, dtype=np.float64)
+        self._rows: Dict[str, int] = {}
+        # The HNSW index of the embeddings, labelled by row, created with the first chunks
+        self._index: Optional[HNSWIndex] = None
+
+    def _new_index(self, dimension: int) -> Optional[HNSWIndex]:
+        if self._index_type != "hnsw":
+            return None
+        return HNSWIndex(
+            dimension,
+            m=self._hnsw_m,
+            ef_construction=self._hnsw_ef_construction,
+            ef_search=self._hnsw_ef_search,
+            initial_capacity=self._initial_capacity,
+        )
+
+    def _reserve(self, count: int, dimension: int) -> None:
+        """
+        Make room for count more rows, doubling the capacity so that appending stays amortized O(1).
+        """
+        if self._embeddings.shape[1] and self._embeddings.shape[1] != dimension:
+            raise ValueError(
+                f"Embedding dimension {dimension} does not match the stored dimension {self._embeddings.shape[1]}"
+            )
+        capacity = self._embeddings.shape[0]
+        if self._size + count <= capacity:
+            return
+
+        capacity = max(self._size + count, 2 * capacity, self._initial_capacity)
+        embeddings = np.zeros((capacity, dimension), dtype=np.float32)
+        if self._size:
+            embeddings[: self._size] = self._embeddings[: self._size]
+        self._embeddings = embeddings
+        for name, column in self._columns.items():
+            self._columns[name] = np.empty(capacity, dtype=object)
+            self._columns[name][: self._size] = column[: self._size]
+        timestamps = np.full(capacity, np.nan, dtype=np.float64)
+        timestamps[: self._size] = self._timestamps[: self._size]
+        self._timestamps = timestamps
+
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+        """
+        Takes in a list of list of document chunks and inserts them into the database.
+        Return a list of document ids.
+        """
+        flat_chunks = [chunk for doc_chunks in chunks.values() for chunk in doc_chunks]
+        async with self._write_operation():
+            if flat_chunks:
+                await self._run(self._write_chunks, flat_chunks)
+        return list(chunks.keys())
+
+    async def upsert(
+        self, documents: List[Document], chunk_token_size: Optional[int] = None
+    ) -> List[str]:
+        """
+        Takes in a list of documents and inserts them into the database, persisting the datastore once at the end
+        rather than after each of the deletes and inserts it makes.
+        Return a list of document ids.
+        """
+        async with self._write_operation():
+            return await super().upsert(documents, chunk_token_size)
+
+    async def upsert_chunks(
+        self, documents: List[Document], chunks: Dict[str, List[DocumentChunk]]
+    ) -> List[str]:
+        """
+        Takes in a list of documents and their chunks, already created and embedded, and inserts the chunks into the database
+        in place of the stored chunks of the documents, persisting the datastore once at the end.
+        Return a list of document ids.
+        """
+        async with self._write_operation():
+            return await super().upsert_chunks(documents, chunks)
+
+    def _write_chunks(self, chunks: List[DocumentChunk]) -> None:
+        embeddings = normalize_embeddings(
+            np.array([chunk.embedding for chunk in chunks], dtype=np.float32)
+        )
+        values = {
+            "id": [c.id for c in chunks],
+            "text": [c.text for c in chunks],
+            "content_hash": [c.content_hash for c in chunks],
+        }
+        for name in METADATA_COLUMNS:
+            values[name] = [getattr(c.metadata, name) for c in chunks]
+        values["source"] = [
+            c.metadata.source.value if c.metadata.source else None for c in chunks
+        ]
+        self._write_values(embeddings, values)
+        self._log({"op": "upsert", "values": values}, embeddings)
+
+    def _write_values(
+        self, embeddings: np.ndarray, values: Dict[str, List[Optional[str]]]
+    ) -> None:
+        """
+        Write unit-length embeddings and the values of their columns, overwriting the chunks with the same ids.
+        """
+        count = len(values["id"])
+        self._reserve(count, embeddings.shape[1])
+
+        # Chunks already stored are overwritten in place, the others are appended
+        rows = np.empty(count, dtype=np.int64)
+        for i, id_ in enumerate(values["id"]):
+            row = self._rows.get(id_)  # type: ignore
+            if row is None:
+                row = self._rows[id_] = self._size  # type: ignore
+                self._size += 1
+            rows[i] = row
+
+        self._embeddings[rows] = embeddings
+        for name in COLUMNS:
+            self._columns[name][rows] = _object_array(values[name], count)
+        self._timestamps[rows] = [
+            to_unix_timestamp(created_at) if created_at else np.nan
+            for created_at in values["created_at"]
+        ]
+        if self._index is None:
+            self._index = self._new_index(embeddings.shape[1])
+        if self._index is not None:
+            self._index.add(embeddings, rows)
+            self._compact_index()
+
+    def _compact_index(self) -> None:
+        """
+        Drop the deleted and overwritten chunks from the HNSW graph, once they are more than
+        LOCAL_HNSW_MAX_DELETED_RATIO of its nodes, so that they don't take memory and slow searches forever.
+        """
+        deleted = self._index.deleted_count  # type: ignore
+        if deleted > self._hnsw_max_deleted_ratio * (len(self._index) + deleted):  # type: ignore
+            logger.info(f"Dropping {deleted} deleted chunks from the HNSW index")
+            self._index.compact()  # type: ignore
+
+    def _filter_mask(self, filter: DocumentMetadataFilter) -> np.ndarray:
+        """
+        Return a boolean array of the stored rows that match the filter.
+        """
+        mask = np.ones(self._size, dtype=bool)
+        for name in ["document_id", "source_id", "author"]:
+            value = getattr(filter, name)
+            if value is not None:
+                mask &= self._columns[name][: self._size] == value
+        if filter.source:
+            mask &= self._columns["source"][: self._size] == filter.source.value
+        # Comparisons with nan are false, so chunks without a date never match a date filter
+        if filter.start_date:
+            mask &= self._timestamps[: self._size] >= to_unix_timestamp(
+                filter.start_date
+            )
+        if filter.end_date:
+            mask &= self._timestamps[: self._size] <= to_unix_timestamp(
+                filter.end_date
+            )
+        return mask
+
+    def _document_mask(self, document_ids: Iterable[str]) -> np.ndarray:
+        ids = set(document_ids)
+        return np.fromiter(
+            (id_ in ids for id_ in self._columns["document_id"][: self._size]),
+            dtype=bool,
+            count=self._size,
+        )
+
+    def _chunk_mask(self, chunk_ids: Iterable[str]) -> np.ndarray:
+        mask = np.zeros(self._size, dtype=bool)
+        mask[[self._rows[id_] for id_ in chunk_ids if id_ in self._rows]] = True
+        return mask
+
+    def _chunk_from_row(self, row: int, score: float) -> DocumentChunkWithScore:
+        source = self._columns["source"][row]
+        return DocumentChunkWithScore(
+            id=self._columns["id"][row],
+            text=self._columns["text"][row],
+            score=score,
+            metadata=DocumentChunkMetadata(
+                document_id=self._columns["document_id"][row],
+                source=Source(source) if source else None,
+                source_id=self._columns["source_id"][row],
+                url=self._columns["url"][row],
+                created_at=self._columns["created_at"][row],
+                author=self._columns["author"][row],
+            ),
+        )
+
+    async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        """
+        Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
+        """
+        return await self._run(self._search, queries)
+
+    def _search(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        """
+        The queries answered exactly are scored with a single matrix multiplication, and their top k rows selected
+        at once. With an HNSW index, the other queries search the graph one after the other.
+        """
+        top_ks = [min(query.top_k or 0, self._size) for query in queries]
+        k = max(top_ks, default=0)
+        if k == 0:
+            return [QueryResult(query=query.query, results=[]) for query in queries]
+
+        query_embeddings = normalize_embeddings(
+            np.array([query.embedding for query in queries], dtype=np.float32)
+        )
+
+        # Queries often share a filter, so compute the mask of each distinct filter once
+        masks: Dict[str, np.ndarray] = {}
+        query_masks: List[Optional[np.ndarray]] = []
+        for query in queries:
+            mask = None
+            if query.filter:
+                key = query.filter.json()
+                if key not in masks:
+                    masks[key] = self._filter_mask(query.filter)
+                mask = masks[key]
+            query_masks.append(mask)
+
+        exact = [
+            i
+            for i, mask in enumerate(query_masks)
+            if self._index is None
+            or (self._size if mask is None else np.count_nonzero(mask))
+            <= HNSW_EXACT_MAX_ROWS
+        ]
+        top: List[Tuple[np.ndarray, np.ndarray]] = [None] * len(queries)  # type: ignore
+        if exact:
+            # Cosine similarity of every query with every stored chunk
+            scores = query_embeddings[exact] @ self._embeddings[: self._size].T
+            for j, i in enumerate(exact):
+                if query_masks[i] is not None:
+                    scores[j, ~query_masks[i]] = -np.inf
+            top_rows, top_scores = select_top_k(scores, k)
+            for j, i in enumerate(exact):
+                top[i] = (top_rows[j, : top_ks[i]], top_scores[j, : top_ks[i]])
+        for i, (query_embedding, mask) in enumerate(zip(query_embeddings, query_masks)):
+            if top[i] is None:
+                top[i] = self._index.search(  # type: ignore
+                    query_embedding, top_ks[i], allowed=mask
+                )
+
+        results = []
+        for query, (rows, row_scores) in zip(queries, top):
+            results.append(
+                QueryResult(
+                    query=query.query,
+                    results=[
+                        self._chunk_from_row(row, float(score))
+                        for row, score in zip(rows, row_scores)
+                        # Rows excluded by the filter
+                        if score != -np.inf
+                    ],
+                )
+            )
+        return results
+
+    def _remove(self, mask: np.ndarray) -> None:
+        """
+        Remove the rows selected by mask, compacting the remaining rows to the front.
+        """
+        if not mask.any():
+            return
+        keep = ~mask
+        size = int(keep.sum())
+        if self._index is not None:
+            # The index is labelled by row, give the kept rows their new row
+            new_rows = np.cumsum(keep) - 1
+            new_rows[mask] = -1
+            self._index.relabel(new_rows)
+            self._compact_index()
+        self._embeddings[:size] = self._embeddings[: self._size][keep]
+        for column in self._columns.values():
+            column[:size] = column[: self._size][keep]
+            # Release the strings of the removed rows
+            column[size : self._size] = None
+        self._timestamps[:size] = self._timestamps[: self._size][keep]
+        self._size = size
+        self._rows = {id_: row for row, id_ in enumerate(self._columns["id"][:size])}
+
+    async def delete(
+        self,
+        ids: Optional[List[str]] = None,
+        filter: Optional[DocumentMetadataFilter] = None,
+        delete_all: Optional[bool] = None,
+    ) -> bool:
+        """
+        Removes vectors by ids, filter, or everything in the datastore.
+        Multiple parameters can be used at once.
+        Returns whether the operation was successful.
+        """
+        async with self._write_operation():
+            await self._run(self._delete, ids, filter, delete_all)
+        return True
+
+    def _delete(
+        self,
+        ids: Optional[List[str]],
+        filter: Optional[DocumentMetadataFilter],
+        delete_all: Optional[bool],
+    ) -> None:
+        if delete_all:
+            self._clear()
+            self._log({"op": "clear"})
+            return
+
+        mask = np.zeros(self._size, dtype=bool)
+        if ids:
+            mask |= self._document_mask(ids)
+        # An empty filter would match everything, only delete_all does that
+        if filter and any(value is not None for value in filter.dict().values()):
+            mask |= self._filter_mask(filter)
+        self._delete_rows(mask)
+
+    def _delete_rows(self, mask: np.ndarray) -> None:
+        if mask.any():
+            self._log(
+                {"op": "delete", "ids": self._columns["id"][: self._size][mask].tolist()}
+            )
+            self._remove(mask)
+
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Takes in a list of document ids and returns, for each stored document, a dict from chunk id to the content hash of the chunk.
+        """
+        return await self._run(self._chunk_hashes, document_ids)
+
+    def _chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        hashes: Dict[str, Dict[str, Optional[str]]] = {}
+        for row in np.flatnonzero(self._document_mask(document_ids)):
+            hashes.setdefault(self._columns["document_id"][row], {})[
+                self._columns["id"][row]
+            ] = self._columns["content_hash"][row]
+        return hashes
+
+    async def _delete_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        """
+        Takes in a dict from document id to chunk ids and deletes those chunks.
+        """
+        async with self._write_operation():
+            await self._run(
+                lambda: self._delete_rows(
+                    self._chunk_mask(id_ for ids in chunk_ids.values() for id_ in ids)
+                )
+            )
+
+    @asynccontextmanager
+    async def _write_operation(self) -> AsyncIterator[None]:
+        """
+        Persist the changes made within the context once it exits. The deletes and inserts that an upsert makes
+        through other operations are persisted with it, in a single write.
+        """
+        if _write_operation.get():
+            yield
+            return
+        token = _write_operation.set(True)
+        try:
+            yield
+        finally:
+            _write_operation.reset(token)
+            await self._persist()
+
+    def _log(self, record: Dict, embeddings: Optional[np.ndarray] = None) -> None:
+        if not self._persistence_dir:
+            return
+        self._pending.append((record, embeddings))
+        if record["op"] == "upsert":
+            self._logged_rows += len(record["values"]["id"])
+        elif record["op"] == "delete":
+            self._logged_rows += len(record["ids"])
+        else:
+            # The datastore is empty after a clear, so this writes an empty datastore file instead
+            self._logged_rows += 1
+
+    def _log_path(self, generation: int) -> str:
+        return os.path.join(self._persistence_dir, LOG_FILE.format(generation=generation))  # type: ignore
+
+    async def _persist(self) -> None:
+        """
+        Write the pending changes to the persistence directory, if any. They are appended to the log, or, once the
+        log holds more than LOCAL_LOG_COMPACT_RATIO of the stored chunks, the whole datastore is written instead.
+        The files are written in another thread than that of the datastore, so that it keeps serving queries.
+        """
+        if not self._persistence_dir:
+            return
+        async with self._persist_lock:
+            records, snapshot, logged_rows, generation = await self._run(
+                self._take_pending
+            )
+            if not records:
+                return
+            try:
+                if snapshot is not None:
+                    # The snapshot includes the pending changes, and replaces the log with an empty one
+                    await asyncio.to_thread(self._write_snapshot, snapshot, generation + 1)
+                else:
+                    await asyncio.to_thread(self._append_log, records, generation)
+            except Exception:
+                # Keep the changes, to write them with the next operation
+                await self._run(self._restore_pending, records)
+                raise
+            if snapshot is not None:
+                await self._run(self._compacted, logged_rows)
+
+    def _take_pending(
+        self,
+    ) -> Tuple[
+        List[Tuple[Dict, Optional[np.ndarray]]], Optional[Dict[str, np.ndarray]], int, int
+    ]:
+        """
+        Take the pending changes, and a snapshot of the datastore if the log is to be compacted, along with the
+        number of chunks the log holds and its generation.
+        """
+        self._pending, records = [], self._pending
+        compact = bool(records) and self._logged_rows > LOCAL_LOG_COMPACT_RATIO * self._size
+        return (
+            records,
+            self._snapshot() if compact else None,
+            self._logged_rows,
+            self._generation,
+        )
+
+    def _restore_pending(self, records: List[Tuple[Dict, Optional[np.ndarray]]]) -> None:
+        self._pending[:0] = records
+
+    def _compacted(self, logged_rows: int) -> None:
+        self._generation += 1
+        # Changes made while the snapshot was written are in the next log
+        self._logged_rows -= logged_rows
+
+    def _snapshot(self) -> Dict[str, np.ndarray]:
+        """
+        Copy the arrays to write to the datastore file, so that it can be written while the datastore changes.
+        """
+        metadata = {
+            name: column[: self._size].tolist() for name, column in self._columns.items()
+        }
+        # The index is written in the same file, so that it always matches the chunks
+        index_arrays = (
+            {
+                "hnsw_" + name: array.copy()
+                for name, array in self._index.to_arrays().items()
+            }
+            if self._index is not None
+            else {}
+        )
+        return {
+            "embeddings": self._embeddings[: self._size].copy(),
+            "metadata": metadata,  # type: ignore
+            **index_arrays,
+        }
+
+    def _write_snapshot(self, snapshot: Dict[str, np.ndarray], generation: int) -> None:
+        """
+        Write the whole datastore to a temporary file, which then replaces the previous one atomically, and remove
+        the logs of the previous generations, which it includes.
+        """
+        os.makedirs(self._persistence_dir, exist_ok=True)  # type: ignore
+        metadata = json.dumps(snapshot.pop("metadata")).encode("utf-8")
+        path = os.path.join(self._persistence_dir, DATASTORE_FILE)  # type: ignore
+        temp_path = path + ".tmp.npz"
+        np.savez(
+            temp_path,
+            metadata=np.frombuffer(metadata, dtype=np.uint8),
+            generation=np.array(generation),
+            **snapshot,
+        )
+        os.replace(temp_path, path)
+        self._remove_stale_logs(generation)
+
+    def _remove_stale_logs(self, generation: int) -> None:
+        pattern = os.path.join(self._persistence_dir, LOG_FILE.format(generation="*"))  # type: ignore
+        for log_path in glob.glob(pattern):
+            if log_path != self._log_path(generation):
+                os.remove(log_path)
+
+    def _append_log(
+        self, records: List[Tuple[Dict, Optional[np.ndarray]]], generation: int
+    ) -> None:
+        """
+        Append changes to the log, each as a JSON header followed by the embeddings it writes, if any.
+        """
+        os.makedirs(self._persistence_dir, exist_ok=True)  # type: ignore
+        with open(self._log_path(generation), "ab") as log_file:
+            start = log_file.tell()
+            try:
+                for record, embeddings in records:
+                    np.save(
+                        log_file,
+                        np.frombuffer(json.dumps(record).encode("utf-8"), dtype=np.uint8),
+                    )
+                    if embeddings is not None:
+                        np.save(log_file, embeddings)
+                log_file.flush()
+                os.fsync(log_file.fileno())
+            except Exception:
+                # Don't leave a partial record for the next changes to be appended after
+                log_file.truncate(start)
+                raise
+
+    def _replay_log(self) -> None:
+        """
+        Apply the changes of the log to the datastore loaded from the file of its generation.
+        A record cut short by a crash while it was appended is dropped.
+        """
+        log_path = self._log_path(self._generation)
+        if not os.path.exists(log_path):
+            return
+        replayed = 0
+        with open(log_path, "rb") as log_file:
+            while True:
+                end = log_file.tell()
+                try:
+                    record = json.loads(np.load(log_file).tobytes().decode("utf-8"))
+                    embeddings = np.load(log_file) if record["op"] == "upsert" else None
+                except (EOFError, ValueError, OSError):
+                    break
+                if record["op"] == "upsert":
+                    self._write_values(embeddings, record["values"])  # type: ignore
+                    self._logged_rows += len(record["values"]["id"])
+                elif record["op"] == "delete":
+                    self._remove(self._chunk_mask(record["ids"]))
+                    self._logged_rows += len(record["ids"])
+                else:
+                    self._clear()
+                replayed += 1
+        if end < os.path.getsize(log_path):
+            logger.warning(f"Dropping an incomplete record at the end of {log_path}")
+            os.truncate(log_path, end)
+        logger.info(f"Replayed {replayed} changes from {log_path}")
+
+    def _load(self) -> None:
+        path = os.path.join(self._persistence_dir, DATASTORE_FILE)  # type: ignore
+        if not os.path.exists(path):
+            # Only a log was written so far
+            self._replay_log()
+            return
+        with np.load(path) as data:
+            embeddings = data["embeddings"]
+            metadata = json.loads(data["metadata"].tobytes().decode("utf-8"))
+            # Files written before the log existed have no generation
+            self._generation = int(data["generation"]) if "generation" in data.files else 0
+            index_arrays = {
+                name[len("hnsw_") :]: data[name]
+                for name in data.files
+                if name.startswith("hnsw_")
+            }
+
+        size = embeddings.shape[0]
+        self._reserve(size, embeddings.shape[1])
+        self._embeddings[:size] = embeddings
+        for name in COLUMNS:
+            self._columns[name][:size] = _object_array(metadata[name], size)
+        self._timestamps[:size] = [
+            to_unix_timestamp(created_at) if created_at else np.nan
+            for created_at in metadata["created_at"]
+        ]
+        self._size = size
+        self._rows = {id_: row for row, id_ in enumerate(metadata["id"])}
+        logger.info(f"Loaded {size} chunks from {path}")
+
+        if self._index_type == "hnsw" and size:
+            if index_arrays:
+                self._index = HNSWIndex.from_arrays(index_arrays)
+                self._index.ef_search = self._hnsw_ef_search
+            else:
+                logger.info(f"Building the HNSW index of {size} chunks")
+                self._index = self._new_index(embeddings.shape[1])
+                self._index.add(embeddings, np.arange(size))  # type: ignore
+        self._replay_log()
+        self._remove_stale_logs(self._generation)
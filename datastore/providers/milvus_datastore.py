@@ -1,9 +1,10 @@
 import json
 import os
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 from loguru import logger
-from typing import Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 from pymilvus import (
     Collection,
     connections,
@@ -38,8 +39,21 @@ MILVUS_USE_SECURITY = False if MILVUS_PASSWORD is None else True
 MILVUS_INDEX_PARAMS = os.environ.get("MILVUS_INDEX_PARAMS")
 MILVUS_SEARCH_PARAMS = os.environ.get("MILVUS_SEARCH_PARAMS")
 MILVUS_CONSISTENCY_LEVEL = os.environ.get("MILVUS_CONSISTENCY_LEVEL")
-
-UPSERT_BATCH_SIZE = 100
+# Number of blocking calls to the server running at once
+MILVUS_MAX_WORKERS = int(os.environ.get("MILVUS_MAX_WORKERS", 4))
+# Bounds of an insert request, in rows and in approximate bytes, to stay well under the gRPC message size limit
+MILVUS_UPSERT_BATCH_SIZE = int(os.environ.get("MILVUS_UPSERT_BATCH_SIZE", 1000))
+MILVUS_UPSERT_BATCH_BYTES = int(os.environ.get("MILVUS_UPSERT_BATCH_BYTES", 16 * 2**20))
+# Flush the collection after this many rows were inserted or deleted, and compact it after this many rows
+# were deleted, 0 to leave both to the server
+MILVUS_FLUSH_ROWS = int(os.environ.get("MILVUS_FLUSH_ROWS", 0))
+MILVUS_COMPACT_ROWS = int(os.environ.get("MILVUS_COMPACT_ROWS", 0))
+# Field that new collections are partitioned by, so that searches filtered on it only scan its partition
+MILVUS_PARTITION_KEY = os.environ.get("MILVUS_PARTITION_KEY")
+MILVUS_NUM_PARTITIONS = int(os.environ.get("MILVUS_NUM_PARTITIONS", 64))
+
+# Number of document ids in a delete expression
+DELETE_BATCH_SIZE = 100
 OUTPUT_DIM = 1536
 EMBEDDING_FIELD = "embedding"
 
@@ -101,12 +115,95 @@ SCHEMA_V1 = [
 SCHEMA_V2 = SCHEMA_V1[1:]
 SCHEMA_V2[4][1].is_primary = True
 
+# The fields that can partition a V2 collection: the string metadata that filters match exactly
+PARTITION_KEY_FIELDS = ["document_id", "source_id", "source", "author"]
+
+
+def create_schema(partition_key: Optional[str] = None) -> CollectionSchema:
+    """Create the V2 schema of a new collection, partitioned by the partition_key field if any.
+
+    Raises:
+        ValueError: If the field can't partition the collection, or the installed pymilvus doesn't support
+            partition keys (before 2.2.9).
+    """
+    fields = [field[1] for field in SCHEMA_V2]
+    if partition_key is not None:
+        if partition_key not in PARTITION_KEY_FIELDS:
+            raise ValueError(
+                f"Invalid partition key {partition_key}, expected one of {PARTITION_KEY_FIELDS}"
+            )
+        fields = [
+            FieldSchema(
+                name=field.name, dtype=field.dtype, is_partition_key=True, **field.params
+            )
+            if field.name == partition_key
+            else field
+            for field in fields
+        ]
+        if not any(getattr(field, "is_partition_key", False) for field in fields):
+            raise ValueError("Partition keys require pymilvus 2.2.9 or later")
+    return CollectionSchema(fields)
+
+
+def get_partition_key(col: Collection) -> Optional[str]:
+    """Return the name of the partition key field of a collection, None if it isn't partitioned by one."""
+    for field in col.schema.fields:
+        if getattr(field, "is_partition_key", False):
+            return field.name
+    return None
+
+
+def row_size(row: List[Any]) -> int:
+    """Approximate the number of bytes a row takes in an insert request."""
+    size = 0
+    for value in row:
+        if isinstance(value, str):
+            size += len(value.encode("utf-8"))
+        elif isinstance(value, list):
+            # Embeddings are sent as float32
+            size += 4 * len(value)
+        else:
+            size += 8
+    return size
+
+
+def batch_rows(rows: List[List[Any]]) -> List[List[List[Any]]]:
+    """Split rows into batches of at most MILVUS_UPSERT_BATCH_SIZE rows and MILVUS_UPSERT_BATCH_BYTES bytes.
+
+    A row larger than the byte bound on its own is sent in a batch by itself.
+    """
+    batches: List[List[List[Any]]] = []
+    batch: List[List[Any]] = []
+    batch_bytes = 0
+    for row in rows:
+        size = row_size(row)
+        if batch and (
+            len(batch) >= MILVUS_UPSERT_BATCH_SIZE
+            or batch_bytes + size > MILVUS_UPSERT_BATCH_BYTES
+        ):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(row)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
 
 class MilvusDataStore(DataStore):
+    # Whether the server deletes by any expression, Milvus before 2.3 only deletes by primary key
+    _delete_by_expression = True
+    # The field to partition a new collection by
+    _partition_key: Optional[str] = None
+    # Rows written and deleted since the last flush, and deleted since the last compaction
+    _rows_since_flush = 0
+    _rows_since_compaction = 0
+
     def __init__(
         self,
         create_new: Optional[bool] = False,
         consistency_level: str = "Bounded",
+        partition_key: Optional[str] = None,
     ):
         """Create a Milvus DataStore.
 
@@ -117,9 +214,15 @@ class MilvusDataStore(DataStore):
             consistency_level(str, optional): Specify the collection consistency level.
                                                 Defaults to "Bounded" for search performance.
                                                 Set to "Strong" in test cases for result validation.
+            partition_key(Optional[str], optional): The field to partition a new collection by.
+                                                Defaults to MILVUS_PARTITION_KEY, or no partition key.
         """
         # Overwrite the default consistency level by MILVUS_CONSISTENCY_LEVEL
         self._consistency_level = MILVUS_CONSISTENCY_LEVEL or consistency_level
+        self._partition_key = partition_key or MILVUS_PARTITION_KEY
+        self._executor = ThreadPoolExecutor(
+            max_workers=MILVUS_MAX_WORKERS, thread_name_prefix="milvus"
+        )
         self._create_connection()
 
         self._create_collection(MILVUS_COLLECTION, create_new)  # type: ignore
@@ -128,6 +231,13 @@ class MilvusDataStore(DataStore):
     def _get_schema(self):
         return SCHEMA_V1 if self._schema_ver == "V1" else SCHEMA_V2
 
+    async def _run(self, function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run a blocking call of the Milvus client in the executor, without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: function(*args, **kwargs)
+        )
+
     def _create_connection(self):
         try:
             self.alias = ""
@@ -172,18 +282,22 @@ class MilvusDataStore(DataStore):
             # Check if the collection doesnt exist
             if utility.has_collection(collection_name, using=self.alias) is False:
                 # If it doesnt exist use the field params from init to create a new schem
-                schema = [field[1] for field in SCHEMA_V2]
-                schema = CollectionSchema(schema)
+                schema = create_schema(self._partition_key)
+                # With a partition key, entities are hashed to MILVUS_NUM_PARTITIONS partitions by its value,
+                # and searches whose expression matches it exactly only scan its partition
+                partitions = {} if self._partition_key is None else {"num_partitions": MILVUS_NUM_PARTITIONS}
                 # Use the schema to create a new collection
                 self.col = Collection(
                     collection_name,
                     schema=schema,
                     using=self.alias,
                     consistency_level=self._consistency_level,
+                    **partitions,
                 )
                 self._schema_ver = "V2"
-                logger.info("Create Milvus collection '{}' with schema {} and consistency level {}"
-                                 .format(collection_name, self._schema_ver, self._consistency_level))
+                logger.info("Create Milvus collection '{}' with schema {}, consistency level {} and partition key {}"
+                                 .format(collection_name, self._schema_ver, self._consistency_level,
+                                         self._partition_key))
             else:
                 # If the collection exists, point to it
                 self.col = Collection(
@@ -196,6 +310,12 @@ class MilvusDataStore(DataStore):
                         break
                 logger.info("Milvus collection '{}' already exists with schema {}"
                                  .format(collection_name, self._schema_ver))
+                # The partition key of a collection is fixed when it is created
+                partition_key = get_partition_key(self.col)
+                if self._partition_key is not None and partition_key != self._partition_key:
+                    logger.warning("Milvus collection '{}' is partitioned by {} instead of {}, migrate it with "
+                                   "scripts/migrate_milvus_partition_key".format(collection_name, partition_key,
+                                                                                 self._partition_key))
         except Exception as e:
             logger.error("Failed to create collection '{}', error: {}".format(collection_name, e))
 
@@ -284,9 +404,8 @@ class MilvusDataStore(DataStore):
         try:
             # The doc id's to return for the upsert
             doc_ids: List[str] = []
-            # List to collect all the insert data, skip the "pk" for schema V1
-            offset = 1 if self._schema_ver == "V1" else 0
-            insert_data = [[] for _ in range(len(self._get_schema()) - offset)]
+            # List to collect the rows to insert
+            rows = []
 
             # Go through each document chunklist and grab the data
             for doc_id, chunk_list in chunks.items():
@@ -298,34 +417,49 @@ class MilvusDataStore(DataStore):
                     list_of_data = self._get_values(chunk)
                     # Check if the data is valid
                     if list_of_data is not None:
-                        # Append each field to the insert_data
-                        for x in range(len(insert_data)):
-                            insert_data[x].append(list_of_data[x])
-            # Slice up our insert data into batches
-            batches = [
-                insert_data[i : i + UPSERT_BATCH_SIZE]
-                for i in range(0, len(insert_data), UPSERT_BATCH_SIZE)
-            ]
+                        rows.append(list_of_data)
 
-            # Attempt to insert each batch into our collection
+            # Insert the batches of rows concurrently, at most MILVUS_MAX_WORKERS at a time
             # batch data can work with both V1 and V2 schema
-            for batch in batches:
-                if len(batch[0]) != 0:
-                    try:
-                        logger.info(f"Upserting batch of size {len(batch[0])}")
-                        self.col.insert(batch)
-                        logger.info(f"Upserted batch successfully")
-                    except Exception as e:
-                        logger.error(f"Failed to insert batch records, error: {e}")
-                        raise e
-
-            # This setting perfoms flushes after insert. Small insert == bad to use
-            # self.col.flush()
+            await asyncio.gather(
+                *[self._insert_batch(batch) for batch in batch_rows(rows)]
+            )
+            await self._maintain(written=len(rows))
             return doc_ids
         except Exception as e:
             logger.error("Failed to insert records, error: {}".format(e))
             return []
 
+    async def _insert_batch(self, rows: List[List[Any]]) -> None:
+        """Insert a batch of rows, converted to the column-major data that Milvus takes."""
+        try:
+            logger.info(f"Upserting batch of size {len(rows)}")
+            await self._run(self.col.insert, [list(column) for column in zip(*rows)])
+            logger.info(f"Upserted batch successfully")
+        except Exception as e:
+            logger.error(f"Failed to insert batch records, error: {e}")
+            raise e
+
+    async def _maintain(self, written: int = 0, deleted: int = 0) -> None:
+        """Flush and compact the collection once enough rows were written or deleted, if configured to.
+
+        Milvus seals and flushes growing segments by itself, but a large ingest or delete leaves many
+        small growing segments and deleted rows that are still searched until then.
+        """
+        self._rows_since_flush += written + deleted
+        self._rows_since_compaction += deleted
+        try:
+            if MILVUS_FLUSH_ROWS > 0 and self._rows_since_flush >= MILVUS_FLUSH_ROWS:
+                self._rows_since_flush = 0
+                logger.info("Flush the collection {}".format(self.col.name))
+                await self._run(self.col.flush)
+            if MILVUS_COMPACT_ROWS > 0 and self._rows_since_compaction >= MILVUS_COMPACT_ROWS:
+                self._rows_since_compaction = 0
+                logger.info("Compact the collection {}".format(self.col.name))
+                # Compaction runs in the background of the server, don't wait for it
+                await self._run(self.col.compact)
+        except Exception as e:
+            logger.error("Failed to flush or compact the collection, error: {}".format(e))
 
     def _get_values(self, chunk: DocumentChunk) -> List[any] | None:  # type: ignore
         """Convert the chunk into a list of values to insert whose indexes align with fields.
@@ -378,63 +512,94 @@ class MilvusDataStore(DataStore):
         Returns:
             List[QueryResult]: Results for each search.
         """
-        # Async to perform the query, adapted from pinecone implementation
-        async def _single_query(query: QueryWithEmbedding) -> QueryResult:
-            try:
-                filter = None
-                # Set the filter to expression that is valid for Milvus
-                if query.filter is not None:
-                    # Either a valid filter or None will be returned
-                    filter = self._get_filter(query.filter)
-
-                # Perform our search
-                return_from = 2 if self._schema_ver == "V1" else 1
-                res = self.col.search(
-                    data=[query.embedding],
-                    anns_field=EMBEDDING_FIELD,
-                    param=self.search_params,
-                    limit=query.top_k,
-                    expr=filter,
-                    output_fields=[
-                        field[0] for field in self._get_schema()[return_from:]
-                    ],  # Ignoring pk, embedding
-                )
-                # Results that will hold our DocumentChunkWithScores
-                results = []
-                # Parse every result for our search
-                for hit in res[0]:  # type: ignore
-                    # The distance score for the search result, falls under DocumentChunkWithScore
-                    score = hit.score
-                    # Our metadata info, falls under DocumentChunkMetadata
-                    metadata = {}
-                    # Grab the values that correspond to our fields, ignore pk and embedding.
-                    for x in [field[0] for field in self._get_schema()[return_from:]]:
-                        metadata[x] = hit.entity.get(x)
-                    # If the source isn't valid, convert to None
-                    if metadata["source"] not in Source.__members__:
-                        metadata["source"] = None
-                    # Text falls under the DocumentChunk
-                    text = metadata.pop("text")
-                    # Id falls under the DocumentChunk
-                    ids = metadata.pop("id")
-                    chunk = DocumentChunkWithScore(
-                        id=ids,
-                        score=score,
-                        text=text,
-                        metadata=DocumentChunkMetadata(**metadata),
-                    )
-                    results.append(chunk)
+        # Group the queries by filter expression, so that each group is a single search of several vectors
+        groups: Dict[Optional[str], List[int]] = {}
+        for i, query in enumerate(queries):
+            # Set the filter to expression that is valid for Milvus, None or empty for no filter
+            filter = self._get_filter(query.filter) if query.filter is not None else None
+            groups.setdefault(filter or None, []).append(i)
+
+        results: List[QueryResult] = [
+            QueryResult(query=query.query, results=[]) for query in queries
+        ]
+        searches = await asyncio.gather(
+            *[
+                self._search([queries[i] for i in indexes], filter)
+                for filter, indexes in groups.items()
+            ]
+        )
+        # Map the results of each search back to the position of its queries
+        for indexes, search_results in zip(groups.values(), searches):
+            for i, query_results in zip(indexes, search_results):
+                results[i] = query_results
+        return results
+
+    async def _search(
+        self, queries: List[QueryWithEmbedding], filter: Optional[str]
+    ) -> List[QueryResult]:
+        """Search the embeddings of queries that share a filter expression in a single request.
 
-                # TODO: decide on doing queries to grab the embedding itself, slows down performance as double query occurs
+        Args:
+            queries (List[QueryWithEmbedding]): The searches to perform.
+            filter (Optional[str]): The filter expression of all of them.
 
-                return QueryResult(query=query.query, results=results)
-            except Exception as e:
-                logger.error("Failed to query, error: {}".format(e))
-                return QueryResult(query=query.query, results=[])
+        Returns:
+            List[QueryResult]: Results for each search, without results if the request fails.
+        """
+        try:
+            # Perform our search, with the largest top_k of the queries
+            return_from = 2 if self._schema_ver == "V1" else 1
+            output_fields = [field[0] for field in self._get_schema()[return_from:]]
+            res = await self._run(
+                self.col.search,
+                data=[query.embedding for query in queries],
+                anns_field=EMBEDDING_FIELD,
+                param=self.search_params,
+                limit=max(query.top_k or 3 for query in queries),
+                expr=filter,
+                output_fields=output_fields,  # Ignoring pk, embedding
+            )
+            return [
+                QueryResult(
+                    query=query.query,
+                    results=self._get_results(hits, output_fields)[: query.top_k],
+                )
+                for query, hits in zip(queries, res)  # type: ignore
+            ]
+        except Exception as e:
+            logger.error("Failed to query, error: {}".format(e))
+            return [QueryResult(query=query.query, results=[]) for query in queries]
+
+    def _get_results(self, hits, output_fields: List[str]) -> List[DocumentChunkWithScore]:
+        """Convert the hits of the search of a query to DocumentChunkWithScores."""
+        # Results that will hold our DocumentChunkWithScores
+        results = []
+        # Parse every result for our search
+        for hit in hits:
+            # The distance score for the search result, falls under DocumentChunkWithScore
+            score = hit.score
+            # Our metadata info, falls under DocumentChunkMetadata
+            metadata = {}
+            # Grab the values that correspond to our fields, ignore pk and embedding.
+            for x in output_fields:
+                metadata[x] = hit.entity.get(x)
+            # If the source isn't valid, convert to None
+            if metadata["source"] not in Source.__members__:
+                metadata["source"] = None
+            # Text falls under the DocumentChunk
+            text = metadata.pop("text")
+            # Id falls under the DocumentChunk
+            ids = metadata.pop("id")
+            chunk = DocumentChunkWithScore(
+                id=ids,
+                score=score,
+                text=text,
+                metadata=DocumentChunkMetadata(**metadata),
+            )
+            results.append(chunk)
+
+        # TODO: decide on doing queries to grab the embedding itself, slows down performance as double query occurs
 
-        results: List[QueryResult] = await asyncio.gather(
-            *[_single_query(query) for query in queries]
-        )
         return results
 
     async def delete(
@@ -463,68 +628,66 @@ class MilvusDataStore(DataStore):
             self._create_index()
             return True
 
+        expressions = []
+        # Delete the chunks of the documents, batch by batch(avoid too long expression)
+        if (ids is not None) and len(ids) > 0:
+            # Add quotation marks around the string format id
+            ids = [json.dumps(str(id)) for id in ids]
+            expressions.extend(
+                f"document_id in [{','.join(ids[i : i + DELETE_BATCH_SIZE])}]"
+                for i in range(0, len(ids), DELETE_BATCH_SIZE)
+            )
+        # Convert filter to milvus expression, check if there is anything to filter
+        filter_expression = self._get_filter(filter) if filter is not None else None
+        if filter_expression:
+            expressions.append(filter_expression)
+
+        counts = await asyncio.gather(
+            *[self._delete_expression(expression) for expression in expressions]
+        )
         # Keep track of how many we have deleted for later printing
-        delete_count = 0
-        batch_size = 100
-        pk_name = "pk" if self._schema_ver == "V1" else "id"
-        try:
-            # According to the api design, the ids is a list of document_id,
-            # document_id is not primary key, use query+delete to workaround,
-            # in future version we can delete by expression
-            if (ids is not None) and len(ids) > 0:
-                # Add quotation marks around the string format id
-                ids = ['"' + str(id) + '"' for id in ids]
-                # Query for the pk's of entries that match id's
-                ids = self.col.query(f"document_id in [{','.join(ids)}]")
-                # Convert to list of pks
-                pks = [str(entry[pk_name]) for entry in ids]  # type: ignore
-                # for schema V2, the "id" is varchar, rewrite the expression
-                if self._schema_ver != "V1":
-                    pks = ['"' + pk + '"' for pk in pks]
-
-                # Delete by ids batch by batch(avoid too long expression)
-                logger.info("Apply {:d} deletions to schema {:s}".format(len(pks), self._schema_ver))
-                while len(pks) > 0:
-                    batch_pks = pks[:batch_size]
-                    pks = pks[batch_size:]
-                    # Delete the entries batch by batch
-                    res = self.col.delete(f"{pk_name} in [{','.join(batch_pks)}]")
-                    # Increment our deleted count
-                    delete_count += int(res.delete_count)  # type: ignore
-        except Exception as e:
-            logger.error("Failed to delete by ids, error: {}".format(e))
+        delete_count = sum(counts)
+        logger.info("{:d} records deleted".format(delete_count))
+        await self._maintain(deleted=delete_count)
 
+        return True
+
+    async def _delete_expression(self, expression: str) -> int:
+        """Delete the entities matching an expression, returning how many were deleted."""
         try:
-            # Check if empty filter
-            if filter is not None:
-                # Convert filter to milvus expression
-                filter = self._get_filter(filter)  # type: ignore
-                # Check if there is anything to filter
-                if len(filter) != 0:  # type: ignore
-                    # Query for the pk's of entries that match filter
-                    res = self.col.query(filter)  # type: ignore
-                    # Convert to list of pks
-                    pks = [str(entry[pk_name]) for entry in res]  # type: ignore
-                    # for schema V2, the "id" is varchar, rewrite the expression
-                    if self._schema_ver != "V1":
-                        pks = ['"' + pk + '"' for pk in pks]
-                    # Check to see if there are valid pk's to delete, delete batch by batch(avoid too long expression)
-                    while len(pks) > 0:  # type: ignore
-                        batch_pks = pks[:batch_size]
-                        pks = pks[batch_size:]
-                        # Delete the entries batch by batch
-                        res = self.col.delete(f"{pk_name} in [{','.join(batch_pks)}]")  # type: ignore
-                        # Increment our delete count
-                        delete_count += int(res.delete_count)  # type: ignore
+            if self._delete_by_expression:
+                try:
+                    res = await self._run(self.col.delete, expression)
+                    return int(res.delete_count)  # type: ignore
+                except MilvusException as e:
+                    # Servers before Milvus 2.3 only delete by primary key, query for them instead from now on
+                    logger.info("Delete by primary keys, the server can't delete by expression: {}".format(e))
+                    self._delete_by_expression = False
+            return await self._delete_by_pks(expression)
         except Exception as e:
-            logger.error("Failed to delete by filter, error: {}".format(e))
+            logger.error("Failed to delete by expression {}, error: {}".format(expression, e))
+            return 0
 
-        logger.info("{:d} records deleted".format(delete_count))
-
-        # This setting performs flushes after delete. Small delete == bad to use
-        # self.col.flush()
-
-        return True
+    async def _delete_by_pks(self, expression: str) -> int:
+        """Delete the entities matching an expression by querying for their primary keys first."""
+        pk_name = "pk" if self._schema_ver == "V1" else "id"
+        # Query for the pk's of entries that match the expression
+        res = await self._run(self.col.query, expression)
+        # Convert to list of pks, for schema V2 the "id" is varchar, rewrite the expression
+        pks = [
+            str(entry[pk_name]) if self._schema_ver == "V1" else json.dumps(entry[pk_name])
+            for entry in res  # type: ignore
+        ]
+        delete_count = 0
+        # Delete the entries batch by batch(avoid too long expression)
+        for i in range(0, len(pks), DELETE_BATCH_SIZE):
+            res = await self._run(
+                self.col.delete,
+                f"{pk_name} in [{','.join(pks[i : i + DELETE_BATCH_SIZE])}]",
+            )
+            # Increment our deleted count
+            delete_count += int(res.delete_count)  # type: ignore
+        return delete_count
 
     def _get_filter(self, filter: DocumentMetadataFilter) -> Optional[str]:
         """Converts a DocumentMetdataFilter to the expression that Milvus takes.
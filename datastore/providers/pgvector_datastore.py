@@ -1,3 +1,4 @@
+import asyncio
 from abc import ABC, abstractmethod
 from typing import Any, Dict, List, Optional
 from datetime import datetime
@@ -9,12 +10,29 @@ from models.models import (
     DocumentChunk,
     DocumentChunkMetadata,
     DocumentMetadataFilter,
+    QueryAccuracy,
     QueryResult,
     QueryWithEmbedding,
     DocumentChunkWithScore,
 )
 
 
+# Number of rows written per transaction by an upsert
+UPSERT_BATCH_SIZE = 500
+
+
+def group_rows_by_columns(rows: List[dict[str, Any]]) -> List[List[dict[str, Any]]]:
+    """
+    Groups rows that have the same columns, so that each group can be written by a single multi-row statement,
+    keeping the last row of each id.
+    """
+    rows_by_id = {row["id"]: row for row in rows}
+    groups: Dict[tuple, List[dict[str, Any]]] = {}
+    for row in rows_by_id.values():
+        groups.setdefault(tuple(row.keys()), []).append(row)
+    return list(groups.values())
+
+
 # interface for Postgres client to implement pg based Datastore providers
 class PGClient(ABC):
     @abstractmethod
@@ -24,10 +42,33 @@ class PGClient(ABC):
         """
         raise NotImplementedError
 
+    async def bulk_upsert(self, table: str, rows: List[dict[str, Any]]) -> None:
+        """
+        Inserts or updates the rows in the table. Clients should override this to write all the rows in one
+        transaction or request.
+        """
+        for row in rows:
+            await self.upsert(table, row)
+
     @abstractmethod
-    async def rpc(self, function_name: str, params: dict[str, Any]) -> Any:
+    async def rpc(
+        self,
+        function_name: str,
+        params: dict[str, Any],
+        accuracy: Optional[QueryAccuracy] = None,
+    ) -> Any:
         """
         Calls a stored procedure in the database with the given parameters.
+        The accuracy hint tunes the approximate index searched by the procedure, when the client supports it.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def select_in(
+        self, table: str, columns: List[str], column: str, ids: List[str]
+    ) -> List[dict[str, Any]]:
+        """
+        Returns the given columns of rows in the table that match the ids.
         """
         raise NotImplementedError
 
@@ -57,6 +98,8 @@ class PGClient(ABC):
 
 # abstract class for Postgres based Datastore providers that implements DataStore interface
 class PgVectorDataStore(DataStore):
+    supports_incremental_upsert = True
+
     def __init__(self):
         self.client = self.create_db_client()
 
@@ -75,6 +118,7 @@ class PgVectorDataStore(DataStore):
         Takes in a dict of document_ids to list of document chunks and inserts them into the database.
         Return a list of document ids.
         """
+        rows = []
         for document_id, document_chunks in chunks.items():
             for chunk in document_chunks:
                 json = {
@@ -87,70 +131,109 @@ class PgVectorDataStore(DataStore):
                     "url": chunk.metadata.url,
                     "author": chunk.metadata.author,
                 }
+                if chunk.content_hash:
+                    json["content_hash"] = chunk.content_hash
                 if chunk.metadata.created_at:
-                    json["created_at"] = (
-                        datetime.fromtimestamp(
-                            to_unix_timestamp(chunk.metadata.created_at)
-                        ),
+                    json["created_at"] = datetime.fromtimestamp(
+                        to_unix_timestamp(chunk.metadata.created_at)
                     )
-                await self.client.upsert("documents", json)
+                rows.append(json)
+
+        # Write the batches concurrently, each in a single transaction or request
+        await asyncio.gather(
+            *[
+                self.client.bulk_upsert("documents", rows[start : start + UPSERT_BATCH_SIZE])
+                for start in range(0, len(rows), UPSERT_BATCH_SIZE)
+            ]
+        )
 
         return list(chunks.keys())
 
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Takes in a list of document ids and returns, for each stored document, a dict from chunk id to the content hash of the chunk.
+        """
+        hashes: Dict[str, Dict[str, Optional[str]]] = {}
+        if not document_ids:
+            return hashes
+
+        rows = await self.client.select_in(
+            "documents", ["id", "document_id", "content_hash"], "document_id", document_ids
+        )
+        for row in rows:
+            hashes.setdefault(row["document_id"], {})[row["id"]] = row["content_hash"]
+        return hashes
+
+    async def _delete_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        """
+        Takes in a dict from document id to chunk ids and deletes those chunks.
+        """
+        await self.client.delete_in(
+            "documents", "id", [chunk_id for ids in chunk_ids.values() for chunk_id in ids]
+        )
+
     async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
         """
         Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
         """
-        query_results: List[QueryResult] = []
-        for query in queries:
-            # get the top 3 documents with the highest cosine similarity using rpc function in the database called "match_page_sections"
-            params = {
-                "in_embedding": query.embedding,
-            }
-            if query.top_k:
-                params["in_match_count"] = query.top_k
-            if query.filter:
-                if query.filter.document_id:
-                    params["in_document_id"] = query.filter.document_id
-                if query.filter.source:
-                    params["in_source"] = query.filter.source.value
-                if query.filter.source_id:
-                    params["in_source_id"] = query.filter.source_id
-                if query.filter.author:
-                    params["in_author"] = query.filter.author
-                if query.filter.start_date:
-                    params["in_start_date"] = datetime.fromtimestamp(
-                        to_unix_timestamp(query.filter.start_date)
-                    )
-                if query.filter.end_date:
-                    params["in_end_date"] = datetime.fromtimestamp(
-                        to_unix_timestamp(query.filter.end_date)
-                    )
-            try:
-                data = await self.client.rpc("match_page_sections", params=params)
-                results: List[DocumentChunkWithScore] = []
-                for row in data:
-                    document_chunk = DocumentChunkWithScore(
-                        id=row["id"],
-                        text=row["content"],
-                        # TODO: add embedding to the response ?
-                        # embedding=row["embedding"],
-                        score=float(row["similarity"]),
-                        metadata=DocumentChunkMetadata(
-                            source=row["source"],
-                            source_id=row["source_id"],
-                            document_id=row["document_id"],
-                            url=row["url"],
-                            created_at=row["created_at"],
-                            author=row["author"],
-                        ),
-                    )
-                    results.append(document_chunk)
-                query_results.append(QueryResult(query=query.query, results=results))
-            except Exception as e:
-                logger.error(e)
-                query_results.append(QueryResult(query=query.query, results=[]))
-        return query_results
+        # Run the queries concurrently, each over a connection of the client
+        return list(await asyncio.gather(*[self._query_one(query) for query in queries]))
+
+    async def _query_one(self, query: QueryWithEmbedding) -> QueryResult:
+        """
+        Returns the query result of a single query, without any result if the query fails.
+        """
+        # get the top 3 documents with the highest cosine similarity using rpc function in the database called "match_page_sections"
+        params = {
+            "in_embedding": query.embedding,
+        }
+        if query.top_k:
+            params["in_match_count"] = query.top_k
+        if query.filter:
+            if query.filter.document_id:
+                params["in_document_id"] = query.filter.document_id
+            if query.filter.source:
+                params["in_source"] = query.filter.source.value
+            if query.filter.source_id:
+                params["in_source_id"] = query.filter.source_id
+            if query.filter.author:
+                params["in_author"] = query.filter.author
+            if query.filter.start_date:
+                params["in_start_date"] = datetime.fromtimestamp(
+                    to_unix_timestamp(query.filter.start_date)
+                )
+            if query.filter.end_date:
+                params["in_end_date"] = datetime.fromtimestamp(
+                    to_unix_timestamp(query.filter.end_date)
+                )
+        try:
+            data = await self.client.rpc(
+                "match_page_sections", params=params, accuracy=query.accuracy
+            )
+            results: List[DocumentChunkWithScore] = []
+            for row in data:
+                document_chunk = DocumentChunkWithScore(
+                    id=row["id"],
+                    text=row["content"],
+                    # TODO: add embedding to the response ?
+                    # embedding=row["embedding"],
+                    score=float(row["similarity"]),
+                    metadata=DocumentChunkMetadata(
+                        source=row["source"],
+                        source_id=row["source_id"],
+                        document_id=row["document_id"],
+                        url=row["url"],
+                        created_at=row["created_at"],
+                        author=row["author"],
+                    ),
+                )
+                results.append(document_chunk)
+            return QueryResult(query=query.query, results=results)
+        except Exception as e:
+            logger.error(e)
+            return QueryResult(query=query.query, results=[])
 
     async def delete(
         self,
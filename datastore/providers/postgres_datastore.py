@@ -1,16 +1,25 @@
+import asyncio
+import math
 import os
-from typing import Any, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
 from datetime import datetime
 import numpy as np
+from loguru import logger
 
-from psycopg2 import connect
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from pgvector.psycopg2 import register_vector
 
 from services.date import to_unix_timestamp
-from datastore.providers.pgvector_datastore import PGClient, PgVectorDataStore
+from datastore.providers.pgvector_datastore import (
+    PGClient,
+    PgVectorDataStore,
+    group_rows_by_columns,
+)
 from models.models import (
     DocumentMetadataFilter,
+    QueryAccuracy,
 )
 
 PG_HOST = os.environ.get("PG_HOST", "localhost")
@@ -18,94 +27,338 @@ PG_PORT = int(os.environ.get("PG_PORT", 5432))
 PG_DB = os.environ.get("PG_DB", "postgres")
 PG_USER = os.environ.get("PG_USER", "postgres")
 PG_PASSWORD = os.environ.get("PG_PASSWORD", "postgres")
+# Maximum number of connections, and of statements running at once
+PG_POOL_SIZE = int(os.environ.get("PG_POOL_SIZE", 10))
+# Milliseconds after which the server cancels a statement, 0 to never cancel
+PG_STATEMENT_TIMEOUT = int(os.environ.get("PG_STATEMENT_TIMEOUT", 0))
+# Size of the candidate list of HNSW searches, and number of lists searched by IVFFlat searches
+PG_HNSW_EF_SEARCH = int(os.environ.get("PG_HNSW_EF_SEARCH", 40))
+PG_IVFFLAT_PROBES = int(os.environ.get("PG_IVFFLAT_PROBES", 1))
+# Whether to warn on startup when vector searches do not use an index
+PG_CHECK_QUERY_PLAN = os.environ.get("PG_CHECK_QUERY_PLAN", "true").lower() == "true"
+
+INDEX_METHODS = ("hnsw", "ivfflat")
+# Multipliers of PG_HNSW_EF_SEARCH and PG_IVFFLAT_PROBES for the accuracy hint of a query
+PG_SEARCH_FACTORS = {
+    QueryAccuracy.fast: 0.5,
+    QueryAccuracy.balanced: 1,
+    QueryAccuracy.accurate: 4,
+}
+# Maximum hnsw.ef_search of pgvector
+PG_MAX_EF_SEARCH = 1000
+# Estimated number of rows under which a sequential scan is as fast as an index, and is not worth a warning
+PG_SEQ_SCAN_WARNING_ROWS = 10000
+
+
+def default_ivfflat_lists(rows: int) -> int:
+    """
+    Returns the number of lists of an IVFFlat index recommended by pgvector for the number of rows.
+    """
+    if rows <= 1000000:
+        return max(rows // 1000, 10)
+    return int(math.sqrt(rows))
 
 
 # class that implements the DataStore interface for Postgres Datastore provider
 class PostgresDataStore(PgVectorDataStore):
     def create_db_client(self):
-        return PostgresClient()
+        client = PostgresClient()
+        if PG_CHECK_QUERY_PLAN:
+            try:
+                client._with_connection(client._check_query_plan, "documents")
+            except Exception as e:
+                logger.warning(f"Could not check the plan of vector searches: {e}")
+        return client
+
+
+class VectorConnectionPool(ThreadedConnectionPool):
+    """
+    Connection pool that registers the vector type on the connections it opens.
+    """
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        register_vector(conn)
+        conn.commit()
+        return conn
 
 
 class PostgresClient(PGClient):
-    def __init__(self) -> None:
+    def __init__(
+        self, pool_size: int = PG_POOL_SIZE, statement_timeout: int = PG_STATEMENT_TIMEOUT
+    ) -> None:
         super().__init__()
-        self.client = connect(
-            dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, host=PG_HOST, port=PG_PORT
+        self.pool = VectorConnectionPool(
+            minconn=1,
+            maxconn=pool_size,
+            dbname=PG_DB,
+            user=PG_USER,
+            password=PG_PASSWORD,
+            host=PG_HOST,
+            port=PG_PORT,
+            options=f"-c statement_timeout={statement_timeout}",
+        )
+        # As many threads as connections, so that a statement never waits for a connection in its thread
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="postgres"
         )
-        register_vector(self.client)
 
     def __del__(self):
-        # close the connection when the client is destroyed
-        self.client.close()
+        # close the connections when the client is destroyed
+        self._executor.shutdown(wait=False)
+        self.pool.closeall()
+
+    async def _run(self, function: Callable[..., Any], *args: Any) -> Any:
+        """
+        Runs the function with a connection of the pool and the given arguments in the executor, without blocking
+        the event loop, and commits its transaction.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._with_connection, function, *args
+        )
+
+    def _with_connection(self, function: Callable[..., Any], *args: Any) -> Any:
+        conn = self.pool.getconn()
+        try:
+            result = function(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
 
     async def upsert(self, table: str, json: dict[str, Any]):
         """
         Takes in a list of documents and inserts them into the table.
         """
-        with self.client.cursor() as cur:
+        await self._run(self._upsert, table, json)
+
+    def _upsert(self, conn, table: str, json: dict[str, Any]):
+        with conn.cursor() as cur:
             if not json.get("created_at"):
                 json["created_at"] = datetime.now()
             json["embedding"] = np.array(json["embedding"])
+            columns = list(json.keys())
+            updates = ", ".join(
+                f"{column} = EXCLUDED.{column}" for column in columns if column != "id"
+            )
             cur.execute(
-                f"INSERT INTO {table} (id, content, embedding, document_id, source, source_id, url, author, created_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (id) DO UPDATE SET content = %s, embedding = %s, document_id = %s, source = %s, source_id = %s, url = %s, author = %s, created_at = %s",
-                (
-                    json["id"],
-                    json["content"],
-                    json["embedding"],
-                    json["document_id"],
-                    json["source"],
-                    json["source_id"],
-                    json["url"],
-                    json["author"],
-                    json["created_at"],
-                    json["content"],
-                    json["embedding"],
-                    json["document_id"],
-                    json["source"],
-                    json["source_id"],
-                    json["url"],
-                    json["author"],
-                    json["created_at"],
-                ),
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) ON CONFLICT (id) DO UPDATE SET {updates}",
+                [json[column] for column in columns],
             )
-            self.client.commit()
 
-    async def rpc(self, function_name: str, params: dict[str, Any]):
+    async def bulk_upsert(self, table: str, rows: List[dict[str, Any]]):
+        """
+        Inserts or updates the rows in the table in a single transaction, with a multi-row statement per set of
+        columns.
+        """
+        await self._run(self._bulk_upsert, table, rows)
+
+    def _bulk_upsert(self, conn, table: str, rows: List[dict[str, Any]]):
+        now = datetime.now()
+        rows = [
+            {
+                **row,
+                "created_at": row.get("created_at") or now,
+                "embedding": np.array(row["embedding"]),
+            }
+            for row in rows
+        ]
+        with conn.cursor() as cur:
+            for group in group_rows_by_columns(rows):
+                columns = list(group[0].keys())
+                updates = ", ".join(
+                    f"{column} = EXCLUDED.{column}" for column in columns if column != "id"
+                )
+                execute_values(
+                    cur,
+                    f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s ON CONFLICT (id) DO UPDATE SET {updates}",
+                    [[row[column] for column in columns] for row in group],
+                    page_size=len(group),
+                )
+
+    async def rpc(
+        self,
+        function_name: str,
+        params: dict[str, Any],
+        accuracy: Optional[QueryAccuracy] = None,
+    ):
         """
         Calls a stored procedure in the database with the given parameters.
+        The accuracy hint scales hnsw.ef_search and ivfflat.probes for this call only.
         """
-        data = []
         params["in_embedding"] = np.array(params["in_embedding"])
-        with self.client.cursor(cursor_factory=DictCursor) as cur:
+        return await self._run(self._rpc, function_name, params, accuracy)
+
+    def _rpc(
+        self,
+        conn,
+        function_name: str,
+        params: dict[str, Any],
+        accuracy: Optional[QueryAccuracy] = None,
+    ):
+        data = []
+        factor = PG_SEARCH_FACTORS[accuracy or QueryAccuracy.balanced]
+        # An HNSW search returns at most ef_search rows
+        ef_search = max(round(PG_HNSW_EF_SEARCH * factor), params.get("in_match_count", 3))
+        probes = max(round(PG_IVFFLAT_PROBES * factor), 1)
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            # Settings local to the transaction of the call
+            cur.execute(
+                "SELECT set_config('hnsw.ef_search', %s, true), set_config('ivfflat.probes', %s, true)",
+                (str(min(ef_search, PG_MAX_EF_SEARCH)), str(probes)),
+            )
             cur.callproc(function_name, params)
             rows = cur.fetchall()
-            self.client.commit()
             for row in rows:
                 row["created_at"] = to_unix_timestamp(row["created_at"])
                 data.append(dict(row))
         return data
 
-    async def delete_like(self, table: str, column: str, pattern: str):
+    async def select_in(
+        self, table: str, columns: List[str], column: str, ids: List[str]
+    ) -> List[dict[str, Any]]:
         """
-        Deletes rows in the table that match the pattern.
+        Returns the given columns of rows in the table that match the ids.
         """
-        with self.client.cursor() as cur:
+        return await self._run(self._select_in, table, columns, column, ids)
+
+    def _select_in(
+        self, conn, table: str, columns: List[str], column: str, ids: List[str]
+    ) -> List[dict[str, Any]]:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute(
-                f"DELETE FROM {table} WHERE {column} LIKE %s",
-                (f"%{pattern}%",),
+                f"SELECT {', '.join(columns)} FROM {table} WHERE {column} IN %s",
+                (tuple(ids),),
             )
-            self.client.commit()
+            rows = cur.fetchall()
+        return [dict(row) for row in rows]
+
+    async def delete_like(self, table: str, column: str, pattern: str):
+        """
+        Deletes rows in the table that match the pattern.
+        """
+        await self._run(
+            self._execute,
+            f"DELETE FROM {table} WHERE {column} LIKE %s",
+            (f"%{pattern}%",),
+        )
 
     async def delete_in(self, table: str, column: str, ids: List[str]):
         """
         Deletes rows in the table that match the ids.
         """
-        with self.client.cursor() as cur:
+        await self._run(
+            self._execute, f"DELETE FROM {table} WHERE {column} IN %s", (tuple(ids),)
+        )
+
+    def _execute(self, conn, statement: str, params: Any = None):
+        with conn.cursor() as cur:
+            cur.execute(statement, params)
+
+    async def create_index(
+        self,
+        table: str,
+        method: str,
+        m: int = 16,
+        ef_construction: int = 64,
+        lists: Optional[int] = None,
+        rebuild: bool = False,
+    ) -> str:
+        """
+        Creates an HNSW or IVFFlat index on the embeddings of the table, or rebuilds it, without locking writes,
+        then drops the index of the other method if any. lists defaults to the number recommended for the rows of
+        the table. Returns the name of the index.
+        """
+        if method not in INDEX_METHODS:
+            raise ValueError(f"Unknown index method {method}, expected one of {INDEX_METHODS}")
+        return await self._run(
+            self._create_index, table, method, m, ef_construction, lists, rebuild
+        )
+
+    def _create_index(
+        self,
+        conn,
+        table: str,
+        method: str,
+        m: int,
+        ef_construction: int,
+        lists: Optional[int],
+        rebuild: bool,
+    ) -> str:
+        name = f"{table}_embedding_{method}_idx"
+        # CREATE INDEX CONCURRENTLY can not run in a transaction, and building an index can take longer than
+        # the statement timeout. Switch before any statement, which would otherwise open a transaction
+        conn.autocommit = True
+        try:
+            if method == "hnsw":
+                options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+            else:
+                if lists is None:
+                    lists = default_ivfflat_lists(self._count_rows(conn, table))
+                options = f"lists = {int(lists)}"
+            with conn.cursor() as cur:
+                cur.execute("SET statement_timeout = 0")
+                cur.execute("SELECT to_regclass(%s)", (name,))
+                exists = cur.fetchone()[0] is not None
+                if exists and not rebuild:
+                    logger.info(f"Index {name} already exists")
+                else:
+                    # Build the new index next to the old one, so that searches keep using the old one meanwhile
+                    target = f"{name}_new" if exists else name
+                    logger.info(f"Creating index {target} with {options}")
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}_new")
+                    cur.execute(
+                        f"CREATE INDEX CONCURRENTLY {target} ON {table} "
+                        f"USING {method} (embedding vector_ip_ops) WITH ({options})"
+                    )
+                    if exists:
+                        cur.execute(f"DROP INDEX CONCURRENTLY {name}")
+                        cur.execute(f"ALTER INDEX {target} RENAME TO {name}")
+                for other in INDEX_METHODS:
+                    if other != method:
+                        cur.execute(
+                            f"DROP INDEX CONCURRENTLY IF EXISTS {table}_embedding_{other}_idx"
+                        )
+        finally:
+            if not conn.closed:
+                with conn.cursor() as cur:
+                    cur.execute("RESET statement_timeout")
+                conn.autocommit = False
+        return name
+
+    def _count_rows(self, conn, table: str) -> int:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT count(*) FROM {table}")
+            return cur.fetchone()[0]
+
+    async def check_query_plan(self, table: str) -> bool:
+        """
+        Explains a vector search of the table and warns if it scans the whole table instead of an index.
+        Returns whether the search uses an index.
+        """
+        return await self._run(self._check_query_plan, table)
+
+    def _check_query_plan(self, conn, table: str) -> bool:
+        with conn.cursor() as cur:
+            cur.execute("SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+            row = cur.fetchone()
+            rows = max(int(row[0]), 0) if row else 0
             cur.execute(
-                f"DELETE FROM {table} WHERE {column} IN %s",
-                (tuple(ids),),
+                f"EXPLAIN SELECT id FROM {table} "
+                f"ORDER BY embedding <#> (SELECT embedding FROM {table} LIMIT 1) LIMIT 10"
+            )
+            plan = "\n".join(line[0] for line in cur.fetchall())
+        uses_index = "Index Scan" in plan
+        if not uses_index and rows >= PG_SEQ_SCAN_WARNING_ROWS:
+            logger.warning(
+                f"Vector searches of the {rows} rows of {table} scan the whole table. "
+                "Create an HNSW or IVFFlat index with scripts/manage_pgvector_index. Plan:\n" + plan
             )
-            self.client.commit()
+        return uses_index
 
     async def delete_by_filters(self, table: str, filter: DocumentMetadataFilter):
         """
@@ -127,6 +380,4 @@ class PostgresClient(PGClient):
             filters += f" created_at <= '{filter.end_date}' AND"
         filters = filters[:-4]
 
-        with self.client.cursor() as cur:
-            cur.execute(f"DELETE FROM {table} {filters}")
-            self.client.commit()
+        await self._run(self._execute, f"DELETE FROM {table} {filters}")
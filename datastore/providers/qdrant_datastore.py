@@ -28,6 +28,7 @@ QDRANT_COLLECTION = os.environ.get("QDRANT_COLLECTION", "document_chunks")
 
 
 class QdrantDataStore(DataStore):
+    supports_incremental_upsert = True
     UUID_NAMESPACE = uuid.UUID("3896d314-1e95-4a3a-b45a-945f9f0b541d")
 
     def __init__(
@@ -128,6 +129,55 @@ class QdrantDataStore(DataStore):
         )
         return "COMPLETED" == response.status
 
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Takes in a list of document ids and returns, for each stored document,
+        a dict from chunk id to the content hash of the chunk.
+        """
+        hashes: Dict[str, Dict[str, Optional[str]]] = {}
+        if not document_ids:
+            return hashes
+
+        scroll_filter = self._convert_metadata_filter_to_qdrant_filter(
+            ids=document_ids
+        )
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection_name,
+                scroll_filter=scroll_filter,
+                limit=1000,
+                offset=offset,
+                with_payload=["id", "metadata", "content_hash"],
+                with_vectors=False,
+            )
+            for point in points:
+                payload = point.payload or {}
+                document_id = payload.get("metadata", {}).get("document_id")
+                hashes.setdefault(document_id, {})[payload.get("id")] = payload.get(
+                    "content_hash"
+                )
+            if offset is None:
+                break
+        return hashes
+
+    async def _delete_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        """
+        Takes in a dict from document id to chunk ids and deletes those chunks.
+        """
+        self.client.delete(
+            collection_name=self.collection_name,
+            points_selector=rest.PointIdsList(
+                points=[
+                    self._create_document_chunk_id(chunk_id)
+                    for ids in chunk_ids.values()
+                    for chunk_id in ids
+                ]
+            ),
+        )
+
     def _convert_document_chunk_to_point(
         self, document_chunk: DocumentChunk
     ) -> rest.PointStruct:
@@ -144,6 +194,7 @@ class QdrantDataStore(DataStore):
                 "text": document_chunk.text,
                 "metadata": document_chunk.metadata.dict(),
                 "created_at": created_at,
+                "content_hash": document_chunk.content_hash,
             },
         )
 
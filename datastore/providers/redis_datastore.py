@@ -18,11 +18,14 @@ from typing import Dict, List, Optional
 from datastore.datastore import DataStore
 from models.models import (
     DocumentChunk,
+    DocumentChunkMetadata,
     DocumentMetadataFilter,
     DocumentChunkWithScore,
     DocumentMetadataFilter,
+    QueryAccuracy,
     QueryResult,
     QueryWithEmbedding,
+    Source,
 )
 from services.date import to_unix_timestamp
 
@@ -35,17 +38,51 @@ REDIS_DOC_PREFIX = os.environ.get("REDIS_DOC_PREFIX", "doc")
 REDIS_DISTANCE_METRIC = os.environ.get("REDIS_DISTANCE_METRIC", "COSINE")
 REDIS_INDEX_TYPE = os.environ.get("REDIS_INDEX_TYPE", "FLAT")
 assert REDIS_INDEX_TYPE in ("FLAT", "HNSW")
+# Parameters of new HNSW indexes, and the default size of the candidate list of a search
+REDIS_HNSW_M = int(os.environ.get("REDIS_HNSW_M", 16))
+REDIS_HNSW_EF_CONSTRUCTION = int(os.environ.get("REDIS_HNSW_EF_CONSTRUCTION", 200))
+REDIS_HNSW_EF_RUNTIME = int(os.environ.get("REDIS_HNSW_EF_RUNTIME", 10))
+# Number of vectors a new index allocates memory for upfront
+REDIS_INITIAL_CAP = os.environ.get("REDIS_INITIAL_CAP")
+# Storage of the chunks of new indexes: "json" documents with FLOAT64 embeddings,
+# or "hash" fields with the embeddings packed as FLOAT32 bytes
+REDIS_STORAGE_TYPE = os.environ.get("REDIS_STORAGE_TYPE", "json").lower()
+assert REDIS_STORAGE_TYPE in ("json", "hash")
+# Size of the connection pool, which bounds the number of commands in flight at once
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 16))
+# Number of commands an upsert sends per pipeline round trip
+REDIS_PIPELINE_SIZE = int(os.environ.get("REDIS_PIPELINE_SIZE", 500))
 
 # OpenAI Ada Embeddings Dimension
 VECTOR_DIMENSION = 1536
 
 # RediSearch constants
-REDIS_REQUIRED_MODULES = [
-    {"name": "search", "ver": 20600},
-    {"name": "ReJSON", "ver": 20404}
-]
+REDIS_SEARCH_MODULE = {"name": "search", "ver": 20600}
+REDIS_JSON_MODULE = {"name": "ReJSON", "ver": 20404}
+REDIS_REQUIRED_MODULES = [REDIS_SEARCH_MODULE, REDIS_JSON_MODULE]
+
+# Sentinel stored for the metadata fields a chunk does not have
+REDIS_NULL_VALUE = "_null_"
+# Fields returned by searches of hash indexes, which leave out the embedding
+REDIS_HASH_RETURN_FIELDS = ["chunk_id", "text", "content_hash"] + list(
+    DocumentChunkMetadata.__fields__
+)
+
+# Number of document ids matched by a single search when deleting documents
+REDIS_DELETE_IDS_BATCH_SIZE = 100
+
+# Multipliers of REDIS_HNSW_EF_RUNTIME for the accuracy hint of a query
+REDIS_EF_RUNTIME_FACTORS = {
+    QueryAccuracy.fast: 0.5,
+    QueryAccuracy.balanced: 1,
+    QueryAccuracy.accurate: 4,
+}
 
 REDIS_DEFAULT_ESCAPED_CHARS = re.compile(r"[,.<>{}\[\]\\\"\':;!@#$%^&()\-+=~\/ ]")
+# Characters to escape in the exact phrase of a text field
+REDIS_PHRASE_ESCAPED_CHARS = re.compile(r"[\\\"]")
+# Authors are matched exactly as tags, split on a character that names don't have rather than on commas
+REDIS_AUTHOR_SEPARATOR = "|"
 
 # Helper functions
 def unpack_schema(d: dict):
@@ -66,13 +103,142 @@ async def _check_redis_module_exist(client: redis.Redis, modules: List[dict]):
             raise AttributeError(error_message)
 
 
+def _vector_attributes(
+    index_type: str,
+    vector_type: str,
+    dim: int,
+    hnsw_m: int = REDIS_HNSW_M,
+    hnsw_ef_construction: int = REDIS_HNSW_EF_CONSTRUCTION,
+    hnsw_ef_runtime: int = REDIS_HNSW_EF_RUNTIME,
+    initial_cap: Optional[int] = None,
+) -> dict:
+    """
+    Return the attributes of the vector field of an index.
+    """
+    attributes = {
+        "TYPE": vector_type,
+        "DIM": dim,
+        "DISTANCE_METRIC": REDIS_DISTANCE_METRIC,
+    }
+    if index_type == "HNSW":
+        attributes.update(
+            M=hnsw_m, EF_CONSTRUCTION=hnsw_ef_construction, EF_RUNTIME=hnsw_ef_runtime
+        )
+    if initial_cap is not None:
+        attributes["INITIAL_CAP"] = initial_cap
+    return attributes
+
+
+def _redisearch_schema(
+    storage_type: str, dim: int, index_type: str = REDIS_INDEX_TYPE, **kwargs
+) -> dict:
+    """
+    Return the RediSearch fields of the metadata and the embedding of the chunks, for JSON or hash storage.
+    The keyword arguments are the HNSW parameters and initial capacity of the vector field.
+    """
+    if storage_type == "hash":
+        return {
+            "metadata": {
+                "document_id": TagField("document_id"),
+                "source_id": TagField("source_id"),
+                "source": TagField("source"),
+                "author": TagField("author", separator=REDIS_AUTHOR_SEPARATOR),
+                "created_at": NumericField("created_at"),
+            },
+            "embedding": VectorField(
+                "embedding",
+                index_type,
+                _vector_attributes(index_type, "FLOAT32", dim, **kwargs),
+            ),
+        }
+    return {
+        "metadata": {
+            "document_id": TagField("$.metadata.document_id", as_name="document_id"),
+            "source_id": TagField("$.metadata.source_id", as_name="source_id"),
+            "source": TagField("$.metadata.source", as_name="source"),
+            "author": TagField(
+                "$.metadata.author", as_name="author", separator=REDIS_AUTHOR_SEPARATOR
+            ),
+            "created_at": NumericField("$.metadata.created_at", as_name="created_at"),
+        },
+        "embedding": VectorField(
+            "$.embedding",
+            index_type,
+            _vector_attributes(index_type, "FLOAT64", dim, **kwargs),
+            as_name="embedding",
+        ),
+    }
+
+
+def _index_storage_type(index_info: dict) -> str:
+    """
+    Return the storage type, "json" or "hash", of an existing index from its FT.INFO.
+    """
+    definition = [
+        item.decode() if isinstance(item, bytes) else item
+        for item in index_info["index_definition"]
+    ]
+    key_type = definition[definition.index("key_type") + 1]
+    return "json" if str(key_type).upper() == "JSON" else "hash"
+
+
+def _index_field_types(index_info: dict) -> Dict[str, str]:
+    """
+    Return the type, such as "TAG" or "TEXT", of each field of an existing index from its FT.INFO.
+    """
+    types = {}
+    for attribute in index_info.get("attributes", []):
+        attribute = [
+            item.decode() if isinstance(item, bytes) else item for item in attribute
+        ]
+        lowered = [str(item).lower() for item in attribute]
+        if "attribute" in lowered and "type" in lowered:
+            types[str(attribute[lowered.index("attribute") + 1])] = str(
+                attribute[lowered.index("type") + 1]
+            ).upper()
+    return types
+
+
+def _index_vector_algorithm(index_info: dict) -> Optional[str]:
+    """
+    Return the algorithm, "FLAT" or "HNSW", of the vector field of an existing index from its FT.INFO,
+    or None if this version of RediSearch does not report it.
+    """
+    for attribute in index_info.get("attributes", []):
+        attribute = [
+            item.decode() if isinstance(item, bytes) else item for item in attribute
+        ]
+        lowered = [str(item).lower() for item in attribute]
+        if "algorithm" in lowered:
+            return str(attribute[lowered.index("algorithm") + 1]).upper()
+    return None
+
+
 class RedisDataStore(DataStore):
-    def __init__(self, client: redis.Redis, redisearch_schema: dict):
+    supports_incremental_upsert = True
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        redisearch_schema: dict,
+        storage_type: str = REDIS_STORAGE_TYPE,
+        index_name: str = REDIS_INDEX_NAME,
+        doc_prefix: str = REDIS_DOC_PREFIX,
+        index_type: str = REDIS_INDEX_TYPE,
+        hnsw_ef_runtime: int = REDIS_HNSW_EF_RUNTIME,
+    ):
         self.client = client
         self._schema = redisearch_schema
+        self._storage_type = storage_type
+        self._index_name = index_name
+        self._doc_prefix = doc_prefix
+        self._index_type = index_type
+        self._hnsw_ef_runtime = hnsw_ef_runtime
+        # Embeddings are packed with the type of the vector field of the index
+        self._vector_dtype = np.float32 if storage_type == "hash" else np.float64
         # Init default metadata with sentinel values in case the document written has no metadata
         self._default_metadata = {
-            field: (0 if field == "created_at" else "_null_") for field in redisearch_schema["metadata"]
+            field: (0 if field == "created_at" else REDIS_NULL_VALUE) for field in redisearch_schema["metadata"]
         }
 
     ### Redis Helper Methods ###
@@ -81,69 +247,114 @@ class RedisDataStore(DataStore):
     async def init(cls, **kwargs):
         """
         Setup the index if it does not exist.
+
+        Keyword Args:
+            dim (int): Dimension of the embeddings of a new index.
+            storage_type (str): "json" or "hash", the storage of a new index. An existing index keeps its own.
+            index_name (str): Name of the RediSearch index.
+            doc_prefix (str): Prefix of the keys of the chunks.
+            index_type (str): "FLAT" or "HNSW", the vector index algorithm of a new index.
+            hnsw_m (int): Maximum number of edges of a node of a new HNSW index.
+            hnsw_ef_construction (int): Size of the candidate list when building a new HNSW index.
+            hnsw_ef_runtime (int): Default size of the candidate list of a search of an HNSW index.
+            initial_cap (int): Number of vectors a new index allocates memory for.
         """
+        storage_type = kwargs.get("storage_type", REDIS_STORAGE_TYPE)
+        index_name = kwargs.get("index_name", REDIS_INDEX_NAME)
+        doc_prefix = kwargs.get("doc_prefix", REDIS_DOC_PREFIX)
+        index_type = kwargs.get("index_type", REDIS_INDEX_TYPE)
+        hnsw_ef_runtime = kwargs.get("hnsw_ef_runtime", REDIS_HNSW_EF_RUNTIME)
+        initial_cap = kwargs.get(
+            "initial_cap", int(REDIS_INITIAL_CAP) if REDIS_INITIAL_CAP else None
+        )
         try:
             # Connect to the Redis Client
             logger.info("Connecting to Redis")
-            client = redis.Redis(
-                host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD
+            # Commands wait for a free connection instead of failing when the pool is exhausted
+            pool = redis.BlockingConnectionPool(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                password=REDIS_PASSWORD,
+                max_connections=REDIS_MAX_CONNECTIONS,
             )
+            client = redis.Redis(connection_pool=pool)
         except Exception as e:
             logger.error(f"Error setting up Redis: {e}")
             raise e
 
-        await _check_redis_module_exist(client, modules=REDIS_REQUIRED_MODULES)
-
         dim = kwargs.get("dim", VECTOR_DIMENSION)
-        redisearch_schema = {
-            "metadata": {
-                "document_id": TagField("$.metadata.document_id", as_name="document_id"),
-                "source_id": TagField("$.metadata.source_id", as_name="source_id"),
-                "source": TagField("$.metadata.source", as_name="source"),
-                "author": TextField("$.metadata.author", as_name="author"),
-                "created_at": NumericField("$.metadata.created_at", as_name="created_at"),
-            },
-            "embedding": VectorField(
-                "$.embedding",
-                REDIS_INDEX_TYPE,
-                {
-                    "TYPE": "FLOAT64",
-                    "DIM": dim,
-                    "DISTANCE_METRIC": REDIS_DISTANCE_METRIC,
-                },
-                as_name="embedding",
-            ),
-        }
         try:
             # Check for existence of RediSearch Index
-            await client.ft(REDIS_INDEX_NAME).info()
-            logger.info(f"RediSearch index {REDIS_INDEX_NAME} already exists")
+            index_info = await client.ft(index_name).info()
         except:
+            index_info = None
+        if index_info is not None:
+            existing_storage_type = _index_storage_type(index_info)
+            if existing_storage_type != storage_type:
+                logger.warning(
+                    f"RediSearch index {index_name} stores {existing_storage_type} documents, "
+                    f"using {existing_storage_type} storage instead of {storage_type}. "
+                    "See scripts/migrate_redis_to_hash to migrate it"
+                )
+            storage_type = existing_storage_type
+            # EF_RUNTIME is only valid for the searches of HNSW indexes
+            index_type = _index_vector_algorithm(index_info) or index_type
+
+        await _check_redis_module_exist(
+            client,
+            modules=REDIS_REQUIRED_MODULES if storage_type == "json" else [REDIS_SEARCH_MODULE],
+        )
+
+        redisearch_schema = _redisearch_schema(
+            storage_type,
+            dim,
+            index_type,
+            hnsw_m=kwargs.get("hnsw_m", REDIS_HNSW_M),
+            hnsw_ef_construction=kwargs.get(
+                "hnsw_ef_construction", REDIS_HNSW_EF_CONSTRUCTION
+            ),
+            hnsw_ef_runtime=hnsw_ef_runtime,
+            initial_cap=initial_cap,
+        )
+        if index_info is not None:
+            logger.info(f"RediSearch index {index_name} already exists")
+            if _index_field_types(index_info).get("author") == "TEXT":
+                # Indexes created before authors were tags match them as an exact phrase instead
+                redisearch_schema["metadata"]["author"] = TextField("author")
+        else:
             # Create the RediSearch Index
-            logger.info(f"Creating new RediSearch index {REDIS_INDEX_NAME}")
+            logger.info(f"Creating new RediSearch index {index_name} of {storage_type} documents")
             definition = IndexDefinition(
-                prefix=[REDIS_DOC_PREFIX], index_type=IndexType.JSON
+                prefix=[doc_prefix],
+                index_type=IndexType.JSON if storage_type == "json" else IndexType.HASH,
             )
             fields = list(unpack_schema(redisearch_schema))
             logger.info(f"Creating index with fields: {fields}")
-            await client.ft(REDIS_INDEX_NAME).create_index(
+            await client.ft(index_name).create_index(
                 fields=fields, definition=definition
             )
-        return cls(client, redisearch_schema)
+        return cls(
+            client,
+            redisearch_schema,
+            storage_type,
+            index_name,
+            doc_prefix,
+            index_type,
+            hnsw_ef_runtime,
+        )
 
-    @staticmethod
-    def _redis_key(document_id: str, chunk_id: str) -> str:
+    def _redis_key(self, document_id: str, chunk_id: str) -> str:
         """
-        Create the JSON key for document chunks in Redis.
+        Create the key for document chunks in Redis.
 
         Args:
             document_id (str): Document Identifier
             chunk_id (str): Chunk Identifier
 
         Returns:
-            str: JSON key string.
+            str: Key string.
         """
-        return f"doc:{document_id}:chunk:{chunk_id}"
+        return f"{self._doc_prefix}:{document_id}:chunk:{chunk_id}"
 
     @staticmethod
     def _escape(value: str) -> str:
@@ -174,9 +385,9 @@ class RedisDataStore(DataStore):
         Returns:
             dict: JSON object for storage in Redis.
         """
-        # Convert chunk -> dict
-        data = chunk.__dict__
-        metadata = chunk.metadata.__dict__
+        # Convert chunk -> dict, a copy so that retries of the upsert get the chunk unchanged
+        data = chunk.dict()
+        metadata = data["metadata"]
         data["chunk_id"] = data.pop("id")
 
         # Prep Redis Metadata
@@ -191,15 +402,52 @@ class RedisDataStore(DataStore):
         data["metadata"] = redis_metadata
         return data
 
-    def _get_redis_query(self, query: QueryWithEmbedding) -> RediSearchQuery:
+    @staticmethod
+    def _get_redis_hash(data: dict) -> dict:
         """
-        Convert a QueryWithEmbedding into a RediSearchQuery.
+        Flatten the JSON object of a chunk into the fields of a Redis hash,
+        with the embedding packed as float32 bytes.
 
         Args:
-            query (QueryWithEmbedding): Search query.
+            data (dict): JSON object of the chunk, as stored in Redis.
 
         Returns:
-            RediSearchQuery: Query for RediSearch.
+            dict: Mapping of the hash fields.
+        """
+        mapping = {
+            field: value.value if isinstance(value, Source) else value
+            for field, value in data["metadata"].items()
+            if value is not None
+        }
+        mapping["chunk_id"] = data["chunk_id"]
+        mapping["text"] = data["text"]
+        if data.get("content_hash"):
+            mapping["content_hash"] = data["content_hash"]
+        mapping["embedding"] = np.array(data["embedding"], dtype=np.float32).tobytes()
+        return mapping
+
+    @staticmethod
+    def _get_metadata(fields: dict) -> dict:
+        """
+        Drop the sentinel values of the missing metadata fields of a stored chunk.
+        """
+        return {
+            field: value
+            for field, value in fields.items()
+            if field in DocumentChunkMetadata.__fields__
+            and value not in (None, REDIS_NULL_VALUE)
+            and not (field == "created_at" and str(value) == "0")
+        }
+
+    def _get_filter_str(self, filter: Optional[DocumentMetadataFilter]) -> str:
+        """
+        Convert a DocumentMetadataFilter into a RediSearch query string.
+
+        Args:
+            filter (Optional[DocumentMetadataFilter]): Metadata filter.
+
+        Returns:
+            str: Query string matching the filter, "*" when it has no fields set.
         """
         filter_str: str = ""
 
@@ -208,19 +456,22 @@ class RedisDataStore(DataStore):
             if isinstance(typ, TagField):
                 return f"@{field}:{{{self._escape(value)}}} "
             elif isinstance(typ, TextField):
-                return f"@{field}:{value} "
+                # An exact phrase, rather than any text field matching any of its words
+                phrase = REDIS_PHRASE_ESCAPED_CHARS.sub(lambda match: f"\\{match.group(0)}", value)
+                return f'@{field}:"{phrase}" '
             elif isinstance(typ, NumericField):
+                # Both date bounds are ranges of the created_at field
                 num = to_unix_timestamp(value)
                 match field:
                     case "start_date":
-                        return f"@{field}:[{num} +inf] "
+                        return f"@created_at:[{num} +inf] "
                     case "end_date":
-                        return f"@{field}:[-inf {num}] "
+                        return f"@created_at:[-inf {num}] "
 
         # Build filter
-        if query.filter:
+        if filter:
             redisearch_schema = self._schema
-            for field, value in query.filter.__dict__.items():
+            for field, value in filter.__dict__.items():
                 if not value:
                     continue
                 if field in redisearch_schema:
@@ -238,18 +489,38 @@ class RedisDataStore(DataStore):
 
         # Postprocess filter string
         filter_str = filter_str.strip()
-        filter_str = filter_str if filter_str else "*"
+        return filter_str if filter_str else "*"
+
+    def _get_redis_query(self, query: QueryWithEmbedding) -> RediSearchQuery:
+        """
+        Convert a QueryWithEmbedding into a RediSearchQuery.
+
+        Args:
+            query (QueryWithEmbedding): Search query.
+
+        Returns:
+            RediSearchQuery: Query for RediSearch.
+        """
+        filter_str = self._get_filter_str(query.filter)
+
+        # Size the candidate list of HNSW searches from the accuracy hint of the query
+        ef_runtime = ""
+        if self._index_type == "HNSW" and query.accuracy:
+            ef = round(self._hnsw_ef_runtime * REDIS_EF_RUNTIME_FACTORS[query.accuracy])
+            ef_runtime = f" EF_RUNTIME {max(ef, query.top_k or 1)}"
 
         # Prepare query string
-        query_str = (
-            f"({filter_str})=>[KNN {query.top_k} @embedding $embedding as score]"
-        )
-        return (
+        query_str = f"({filter_str})=>[KNN {query.top_k} @embedding $embedding{ef_runtime} as score]"
+        redis_query = (
             RediSearchQuery(query_str)
             .sort_by("score")
             .paging(0, query.top_k)
             .dialect(2)
         )
+        if self._storage_type == "hash":
+            # Do not send the embeddings back
+            redis_query = redis_query.return_fields(*REDIS_HASH_RETURN_FIELDS, "score")
+        return redis_query
 
     async def _redis_delete(self, keys: List[str]):
         """
@@ -258,8 +529,12 @@ class RedisDataStore(DataStore):
         Args:
             keys (List[str]): List of keys to delete.
         """
-        # Delete the keys
-        await asyncio.gather(*[self.client.delete(key) for key in keys])
+        # Unlink the keys in pipelines of REDIS_PIPELINE_SIZE commands, freeing their memory in the background
+        async with self.client.pipeline(transaction=False) as pipe:
+            for start in range(0, len(keys), REDIS_PIPELINE_SIZE):
+                for key in keys[start : start + REDIS_PIPELINE_SIZE]:
+                    await pipe.unlink(key)
+                await pipe.execute()
 
     #######
 
@@ -271,18 +546,26 @@ class RedisDataStore(DataStore):
         # Initialize a list of ids to return
         doc_ids: List[str] = []
 
-        # Loop through the dict items
-        for doc_id, chunk_list in chunks.items():
+        # Write the chunks of all the documents in one pipeline, sent every REDIS_PIPELINE_SIZE commands
+        async with self.client.pipeline(transaction=False) as pipe:
+            pending = 0
+            for doc_id, chunk_list in chunks.items():
 
-            # Append the id to the ids list
-            doc_ids.append(doc_id)
+                # Append the id to the ids list
+                doc_ids.append(doc_id)
 
-            # Write chunks in a pipelines
-            async with self.client.pipeline(transaction=False) as pipe:
                 for chunk in chunk_list:
                     key = self._redis_key(doc_id, chunk.id)
                     data = self._get_redis_chunk(chunk)
-                    await pipe.json().set(key, "$", data)
+                    if self._storage_type == "hash":
+                        await pipe.hset(key, mapping=self._get_redis_hash(data))
+                    else:
+                        await pipe.json().set(key, "$", data)
+                    pending += 1
+                    if pending == REDIS_PIPELINE_SIZE:
+                        await pipe.execute()
+                        pending = 0
+            if pending:
                 await pipe.execute()
 
         return doc_ids
@@ -295,45 +578,130 @@ class RedisDataStore(DataStore):
         Takes in a list of queries with embeddings and filters and
         returns a list of query results with matching document chunks and scores.
         """
-        # Prepare query responses and results object
-        results: List[QueryResult] = []
-
-        # Gather query results in a pipeline
+        # Send the searches concurrently, bounded by the connection pool
         logger.info(f"Gathering {len(queries)} query results")
-        for query in queries:
+        responses = await asyncio.gather(
+            *[self._search(query) for query in queries]
+        )
+        return [
+            QueryResult(query=query.query, results=self._get_query_results(response))
+            for query, response in zip(queries, responses)
+        ]
 
-            logger.debug(f"Query: {query.query}")
-            query_results: List[DocumentChunkWithScore] = []
+    async def _search(self, query: QueryWithEmbedding):
+        """
+        Run the vector search of a query and return the RediSearch result.
+        """
+        logger.debug(f"Query: {query.query}")
 
-            # Extract Redis query
-            redis_query: RediSearchQuery = self._get_redis_query(query)
-            embedding = np.array(query.embedding, dtype=np.float64).tobytes()
+        # Extract Redis query
+        redis_query: RediSearchQuery = self._get_redis_query(query)
+        embedding = np.array(query.embedding, dtype=self._vector_dtype).tobytes()
 
-            # Perform vector search
-            query_response = await self.client.ft(REDIS_INDEX_NAME).search(
-                redis_query, {"embedding": embedding}
-            )
+        # Perform vector search
+        return await self.client.ft(self._index_name).search(
+            redis_query, {"embedding": embedding}
+        )
+
+    def _get_query_results(self, query_response) -> List[DocumentChunkWithScore]:
+        """
+        Convert the documents of a RediSearch result into document chunks with scores.
+        """
+        query_results: List[DocumentChunkWithScore] = []
 
-            # Iterate through the most similar documents
-            for doc in query_response.docs:
+        # Iterate through the most similar documents
+        for doc in query_response.docs:
+            if self._storage_type == "hash":
+                text, metadata = doc.text, self._get_metadata(doc.__dict__)
+            else:
                 # Load JSON data
                 doc_json = json.loads(doc.json)
-                # Create document chunk object with score
-                result = DocumentChunkWithScore(
-                    id=doc_json["metadata"]["document_id"],
-                    score=doc.score,
-                    text=doc_json["text"],
-                    metadata=doc_json["metadata"]
-                )
-                query_results.append(result)
+                text, metadata = doc_json["text"], self._get_metadata(doc_json["metadata"])
+            # Create document chunk object with score
+            result = DocumentChunkWithScore(
+                id=metadata.get("document_id"),
+                score=doc.score,
+                text=text,
+                metadata=metadata,
+            )
+            query_results.append(result)
+
+        return query_results
 
-            # Add to overall results
-            results.append(QueryResult(query=query.query, results=query_results))
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Takes in a list of document ids and returns, for each stored document,
+        a dict from chunk id to the content hash of the chunk.
+        """
+        page_size = 1000
+        hashes: Dict[str, Dict[str, Optional[str]]] = {}
+        for document_id in document_ids:
+            offset = 0
+            while True:
+                redis_query = (
+                    RediSearchQuery(f"@document_id:{{{self._escape(document_id)}}}")
+                    .paging(offset, page_size)
+                    .dialect(2)
+                )
+                if self._storage_type == "hash":
+                    redis_query = redis_query.return_fields("chunk_id", "content_hash")
+                else:
+                    redis_query = redis_query.return_field(
+                        "$.chunk_id", as_field="chunk_id"
+                    ).return_field("$.content_hash", as_field="content_hash")
+                response = await self.client.ft(self._index_name).search(redis_query)
+                for doc in response.docs:
+                    hashes.setdefault(document_id, {})[doc.chunk_id] = getattr(
+                        doc, "content_hash", None
+                    )
+                offset += page_size
+                if offset >= response.total:
+                    break
+        return hashes
 
-        return results
+    async def _delete_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        """
+        Takes in a dict from document id to chunk ids and deletes those chunks.
+        """
+        await self._redis_delete(
+            [
+                self._redis_key(document_id, chunk_id)
+                for document_id, ids in chunk_ids.items()
+                for chunk_id in ids
+            ]
+        )
 
-    async def _find_keys(self, pattern: str) -> List[str]:
-        return [key async for key in self.client.scan_iter(pattern)]
+    async def _find_keys(self, filter_str: str) -> List[str]:
+        """
+        Return the keys of the chunks that match a RediSearch query string, from the index rather than a scan
+        of the whole keyspace.
+        """
+        page_size = 1000
+        keys: List[str] = []
+        offset = 0
+        while True:
+            redis_query = (
+                RediSearchQuery(filter_str)
+                .no_content()
+                .paging(offset, page_size)
+                .dialect(2)
+            )
+            response = await self.client.ft(self._index_name).search(redis_query)
+            keys.extend(doc.id for doc in response.docs)
+            offset += page_size
+            if offset >= response.total:
+                break
+        return keys
+
+    def _document_ids_filter_str(self, document_ids: List[str]) -> str:
+        """
+        Return the RediSearch query string matching the chunks of any of the documents.
+        """
+        return "@document_id:{%s}" % " | ".join(
+            self._escape(document_id) for document_id in document_ids
+        )
 
     async def delete(
         self,
@@ -349,7 +717,7 @@ class RedisDataStore(DataStore):
         if delete_all:
             try:
                 logger.info(f"Deleting all documents from index")
-                await self.client.ft(REDIS_INDEX_NAME).dropindex(True)
+                await self.client.ft(self._index_name).dropindex(True)
                 logger.info(f"Deleted all documents successfully")
                 return True
             except Exception as e:
@@ -358,16 +726,15 @@ class RedisDataStore(DataStore):
 
         # Delete by filter
         if filter:
-            # TODO - extend this to work with other metadata filters?
-            if filter.document_id:
+            filter_str = self._get_filter_str(filter)
+            # An empty filter matches every chunk, which delete_all is for
+            if filter_str != "*":
                 try:
-                    keys = await self._find_keys(
-                        f"{REDIS_DOC_PREFIX}:{filter.document_id}:*"
-                    )
+                    keys = await self._find_keys(filter_str)
                     await self._redis_delete(keys)
-                    logger.info(f"Deleted document {filter.document_id} successfully")
+                    logger.info(f"Deleted {len(keys)} chunks matching {filter_str}")
                 except Exception as e:
-                    logger.error(f"Error deleting document {filter.document_id}: {e}")
+                    logger.error(f"Error deleting chunks matching {filter_str}: {e}")
                     raise e
 
         # Delete by explicit ids (Redis keys)
@@ -375,12 +742,15 @@ class RedisDataStore(DataStore):
             try:
                 logger.info(f"Deleting document ids {ids}")
                 keys = []
-                # find all keys associated with the document ids
-                for document_id in ids:
-                    doc_keys = await self._find_keys(
-                        pattern=f"{REDIS_DOC_PREFIX}:{document_id}:*"
+                # find all keys associated with the document ids, a batch of ids per search
+                for start in range(0, len(ids), REDIS_DELETE_IDS_BATCH_SIZE):
+                    keys.extend(
+                        await self._find_keys(
+                            self._document_ids_filter_str(
+                                ids[start : start + REDIS_DELETE_IDS_BATCH_SIZE]
+                            )
+                        )
                     )
-                    keys.extend(doc_keys)
                 # delete all keys
                 logger.info(f"Deleting {len(keys)} keys from Redis")
                 await self._redis_delete(keys)
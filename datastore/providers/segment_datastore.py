@@ -0,0 +1,791 @@
+"""
+Segment datastore for the ChatGPT retrieval plugin.
+
+Stores the chunks on local disk in immutable, memory-mapped segments, so that opening a datastore of tens of millions
+of chunks does not load it into memory, and the uvicorn workers of a server share the page cache instead of each
+holding a copy. Upserts write a new segment, deletes append the rows they remove to the tombstone file of their
+segment, and a background merge rewrites small segments, or segments with many deleted rows, into larger ones.
+
+A datastore directory holds:
+- manifest.json: the names of the live segments, replaced atomically on every change.
+- <segment>/embeddings.npy: the unit-length float32 embeddings of the rows of the segment.
+- <segment>/embeddings.int8.npy and <segment>/embeddings.scales.npy: with int8 quantization, the embeddings scaled to
+  int8 row by row, and the float32 scale of each row.
+- <segment>/embeddings.binary.npy: with binary quantization, the signs of the embeddings, packed 64 dimensions per uint64.
+- <segment>/timestamps.npy: created_at as unix timestamps, nan when missing, for the date filters.
+- <segment>/<column>.offsets.npy and <segment>/<column>.bytes: the utf-8 strings of each column, end to end.
+- <segment>/<column>.hash.npy: 64-bit hashes of the values of the columns used by filters, compared without decoding strings.
+- <segment>/tombstones.bin: the int64 rows of the segment that were deleted, appended to over time.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import math
+import mmap
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from datastore.datastore import DataStore
+from datastore.providers.local_datastore import normalize_embeddings, select_top_k
+from models.models import (
+    DocumentChunk,
+    DocumentChunkMetadata,
+    DocumentChunkWithScore,
+    DocumentMetadataFilter,
+    QueryResult,
+    QueryWithEmbedding,
+    Source,
+)
+from services.date import to_unix_timestamp
+
+SEGMENT_DIR = os.environ.get("SEGMENT_DIR", "segments")
+SEGMENT_MERGE_FACTOR = int(os.environ.get("SEGMENT_MERGE_FACTOR", 8))  # Merge this many segments of about the same size
+SEGMENT_MAX_DELETED_RATIO = float(os.environ.get("SEGMENT_MAX_DELETED_RATIO", 0.3))  # Rewrite a segment once this fraction of its rows is deleted
+SEGMENT_QUANTIZATION = os.environ.get("SEGMENT_QUANTIZATION", "none")  # none, int8 or binary
+SEGMENT_RESCORE_FACTOR = int(os.environ.get("SEGMENT_RESCORE_FACTOR", 8))  # Rescore this many times top_k quantized candidates
+
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "LOCK"
+TOMBSTONES_FILE = "tombstones.bin"
+QUERY_BLOCK_ROWS = 65536  # The number of rows of a segment to score at once, which bounds the memory used by a query
+DEQUANTIZE_BLOCK_ROWS = 1024  # The number of int8 rows converted to float32 at once, which should fit in the CPU cache
+
+QUANTIZATIONS = ["none", "int8", "binary"]
+
+STRING_COLUMNS = [
+    "id",
+    "text",
+    "document_id",
+    "source",
+    "source_id",
+    "url",
+    "created_at",
+    "author",
+    "content_hash",
+]
+HASHED_COLUMNS = ["id", "document_id", "source", "source_id", "author"]
+
+
+def string_hash(value: Optional[str]) -> int:
+    """
+    Return a non-zero 64-bit hash of value, or 0 for None.
+    """
+    if value is None:
+        return 0
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+def _string_hashes(values: List[Optional[str]]) -> np.ndarray:
+    return np.array([string_hash(value) for value in values], dtype=np.uint64)
+
+
+def quantize_int8(embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Scale each row of embeddings to the int8 range, and return the int8 rows and their float32 scales,
+    such that a row is approximately its int8 row times its scale.
+    """
+    scales = np.abs(embeddings).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.round(embeddings / scales[:, np.newaxis]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize_binary(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Return the signs of the embeddings as bits, packed 64 dimensions per uint64, the last one padded with zeros.
+    """
+    bits = np.zeros(
+        (len(embeddings), (embeddings.shape[1] + 63) // 64 * 64), dtype=bool
+    )
+    bits[:, : embeddings.shape[1]] = embeddings > 0
+    return np.packbits(bits, axis=1).view(np.uint64)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """
+    Return the number of bits set in each row of uint64 words, counted in parallel within the words.
+    """
+    words = words - ((words >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    words = (words & np.uint64(0x3333333333333333)) + (
+        (words >> np.uint64(2)) & np.uint64(0x3333333333333333)
+    )
+    words = (words + (words >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    # The sum of the 8 byte counts ends up in the top byte
+    return ((words * np.uint64(0x0101010101010101)) >> np.uint64(56)).sum(axis=1)
+
+
+def _chunk_strings(chunk: DocumentChunk) -> Dict[str, Optional[str]]:
+    metadata = chunk.metadata
+    return {
+        "id": chunk.id,
+        "text": chunk.text,
+        "document_id": metadata.document_id,
+        "source": metadata.source.value if metadata.source else None,
+        "source_id": metadata.source_id,
+        "url": metadata.url,
+        "created_at": metadata.created_at,
+        "author": metadata.author,
+        "content_hash": chunk.content_hash,
+    }
+
+
+class SegmentWriter:
+    """
+    Writes the rows of a new segment to a temporary directory, which close moves into place.
+    """
+
+    def __init__(self, path: str, size: int, dimension: int, quantization: str = "none"):
+        self.path = path
+        self.size = size
+        self.row = 0
+        self._temp_path = f"{path}.tmp"
+        os.makedirs(self._temp_path)
+
+        def open_array(name: str, dtype, shape) -> np.memmap:
+            return np.lib.format.open_memmap(
+                os.path.join(self._temp_path, name), mode="w+", dtype=dtype, shape=shape
+            )
+
+        self._embeddings = open_array("embeddings.npy", np.float32, (size, dimension))
+        self._timestamps = open_array("timestamps.npy", np.float64, (size,))
+        self._quantized: List[np.memmap] = []
+        if quantization == "int8":
+            self._int8 = open_array("embeddings.int8.npy", np.int8, (size, dimension))
+            self._scales = open_array("embeddings.scales.npy", np.float32, (size,))
+            self._quantized = [self._int8, self._scales]
+        elif quantization == "binary":
+            self._binary = open_array(
+                "embeddings.binary.npy", np.uint64, (size, (dimension + 63) // 64)
+            )
+            self._quantized = [self._binary]
+        self._quantization = quantization
+        self._hashes = {
+            name: open_array(f"{name}.hash.npy", np.uint64, (size,))
+            for name in HASHED_COLUMNS
+        }
+        self._offsets = {
+            name: open_array(f"{name}.offsets.npy", np.int64, (size + 1,))
+            for name in STRING_COLUMNS
+        }
+        self._bytes = {
+            name: open(os.path.join(self._temp_path, f"{name}.bytes"), "wb")
+            for name in STRING_COLUMNS
+        }
+        self._lengths = {name: 0 for name in STRING_COLUMNS}
+        for offsets in self._offsets.values():
+            offsets[0] = 0
+
+    def append(
+        self,
+        embeddings: np.ndarray,
+        timestamps: np.ndarray,
+        strings: Dict[str, List[Optional[str]]],
+    ) -> None:
+        start, end = self.row, self.row + len(embeddings)
+        self._embeddings[start:end] = embeddings
+        self._timestamps[start:end] = timestamps
+        if self._quantization == "int8":
+            self._int8[start:end], self._scales[start:end] = quantize_int8(embeddings)
+        elif self._quantization == "binary":
+            self._binary[start:end] = quantize_binary(embeddings)
+        for name in HASHED_COLUMNS:
+            self._hashes[name][start:end] = _string_hashes(strings[name])
+        for name in STRING_COLUMNS:
+            encoded = [(value or "").encode("utf-8") for value in strings[name]]
+            self._bytes[name].write(b"".join(encoded))
+            self._offsets[name][start + 1 : end + 1] = self._lengths[name] + np.cumsum(
+                [len(value) for value in encoded]
+            )
+            self._lengths[name] += sum(len(value) for value in encoded)
+        self.row = end
+
+    def close(self) -> None:
+        assert self.row == self.size, "a segment must be written in full"
+        arrays = [self._embeddings, self._timestamps] + self._quantized
+        arrays += list(self._hashes.values()) + list(self._offsets.values())
+        for array in arrays:
+            array.flush()
+        for file in self._bytes.values():
+            file.close()
+        os.rename(self._temp_path, self.path)
+
+
+class Segment:
+    """
+    A read-only view of a segment, whose arrays are memory-mapped rather than loaded.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        self.embeddings = load("embeddings.npy")
+        self.size = self.embeddings.shape[0]
+        self.timestamps = load("timestamps.npy")
+        # The quantized embeddings, of the quantization the segment was written with
+        self.quantization = "none"
+        if os.path.exists(os.path.join(path, "embeddings.int8.npy")):
+            self.quantization = "int8"
+            self.int8 = load("embeddings.int8.npy")
+            self.scales = load("embeddings.scales.npy")
+        elif os.path.exists(os.path.join(path, "embeddings.binary.npy")):
+            self.quantization = "binary"
+            self.binary = load("embeddings.binary.npy")
+        self.hashes = {name: load(f"{name}.hash.npy") for name in HASHED_COLUMNS}
+        self._offsets = {name: load(f"{name}.offsets.npy") for name in STRING_COLUMNS}
+        self._bytes: Dict[str, bytes] = {}
+        for name in STRING_COLUMNS:
+            with open(os.path.join(path, f"{name}.bytes"), "rb") as file:
+                # An empty file cannot be memory-mapped
+                self._bytes[name] = (
+                    mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)  # type: ignore
+                    if os.fstat(file.fileno()).st_size
+                    else b""
+                )
+        self.deleted = np.zeros(self.size, dtype=bool)
+        self._tombstones_read = 0
+        self.read_tombstones()
+
+    def scores(self, query_embeddings: np.ndarray, start: int, end: int) -> np.ndarray:
+        """
+        Score rows [start, end) of the segment against the queries, from the quantized embeddings if any.
+        The scores are exact cosine similarities without quantization, and estimates of them with it.
+        """
+        if self.quantization == "int8":
+            scores = np.empty((len(query_embeddings), end - start), dtype=np.float32)
+            for block in range(start, end, DEQUANTIZE_BLOCK_ROWS):
+                block_end = min(block + DEQUANTIZE_BLOCK_ROWS, end)
+                scores[:, block - start : block_end - start] = (
+                    query_embeddings @ self.int8[block:block_end].T.astype(np.float32)
+                ) * self.scales[block:block_end]
+            return scores
+        if self.quantization == "binary":
+            codes = self.binary[start:end]
+            hamming = np.empty((len(query_embeddings), end - start), dtype=np.float32)
+            for i, query_code in enumerate(quantize_binary(query_embeddings)):
+                hamming[i] = popcount(codes ^ query_code)
+            # The angle between two vectors is about pi times the fraction of their signs that differ
+            return np.cos(np.pi * hamming / self.embeddings.shape[1])
+        return query_embeddings @ self.embeddings[start:end].T
+
+    @property
+    def live_size(self) -> int:
+        return self.size - int(self.deleted.sum())
+
+    def read_tombstones(self) -> np.ndarray:
+        """
+        Read the rows deleted since the tombstone file was last read, mark them deleted, and return them.
+        """
+        tombstones_path = os.path.join(self.path, TOMBSTONES_FILE)
+        try:
+            # Only read whole rows, another process may be appending to the file
+            size = os.path.getsize(tombstones_path) // 8 * 8
+        except FileNotFoundError:
+            return np.empty(0, dtype=np.int64)
+        if size <= self._tombstones_read:
+            return np.empty(0, dtype=np.int64)
+        with open(tombstones_path, "rb") as file:
+            file.seek(self._tombstones_read)
+            rows = np.frombuffer(
+                file.read(size - self._tombstones_read), dtype="<i8"
+            ).astype(np.int64)
+        self._tombstones_read = size
+        self.deleted[rows] = True
+        return rows
+
+    def string(self, name: str, row: int) -> Optional[str]:
+        offsets = self._offsets[name]
+        value = self._bytes[name][offsets[row] : offsets[row + 1]].decode("utf-8")
+        # Empty strings are stored for None, and no chunk has an empty id or metadata value
+        return value if value or name == "text" else None
+
+    def strings(self, name: str, rows: np.ndarray) -> List[Optional[str]]:
+        return [self.string(name, row) for row in rows]
+
+    def filter_mask(self, filter: DocumentMetadataFilter) -> np.ndarray:
+        """
+        Return a boolean array of the live rows of the segment that match the filter.
+        """
+        mask = ~self.deleted
+        for name in ["document_id", "source_id", "author"]:
+            value = getattr(filter, name)
+            if value is not None:
+                mask &= self.hashes[name] == string_hash(value)
+        if filter.source:
+            mask &= self.hashes["source"] == string_hash(filter.source.value)
+        # Comparisons with nan are false, so chunks without a date never match a date filter
+        if filter.start_date:
+            mask &= self.timestamps >= to_unix_timestamp(filter.start_date)
+        if filter.end_date:
+            mask &= self.timestamps <= to_unix_timestamp(filter.end_date)
+        return mask
+
+    def chunk(self, row: int, score: float) -> DocumentChunkWithScore:
+        source = self.string("source", row)
+        return DocumentChunkWithScore(
+            id=self.string("id", row),
+            text=self.string("text", row),
+            score=score,
+            metadata=DocumentChunkMetadata(
+                document_id=self.string("document_id", row),
+                source=Source(source) if source else None,
+                source_id=self.string("source_id", row),
+                url=self.string("url", row),
+                created_at=self.string("created_at", row),
+                author=self.string("author", row),
+            ),
+        )
+
+
+class SegmentDataStore(DataStore):
+    supports_incremental_upsert = True
+
+    def __init__(
+        self,
+        path: str = SEGMENT_DIR,
+        merge_factor: int = SEGMENT_MERGE_FACTOR,
+        max_deleted_ratio: float = SEGMENT_MAX_DELETED_RATIO,
+        quantization: str = SEGMENT_QUANTIZATION,
+        rescore_factor: int = SEGMENT_RESCORE_FACTOR,
+    ):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(
+                f"Unsupported quantization {quantization}, try one of {', '.join(QUANTIZATIONS)}"
+            )
+        self._path = path
+        self._quantization = quantization
+        self._rescore_factor = max(1, rescore_factor)
+        self._merge_factor = max(2, merge_factor)
+        self._max_deleted_ratio = max_deleted_ratio
+        self._segments: Dict[str, Segment] = {}
+        self._version = -1
+        self._compaction: Optional[asyncio.Task] = None
+        # Reads and writes of the segments run in this thread, merges in threads of their own
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="segment")
+        os.makedirs(path, exist_ok=True)
+        self._refresh()
+        logger.info(
+            f"Opened {len(self._segments)} segments of "
+            f"{sum(segment.live_size for segment in self._segments.values())} chunks from {path}"
+        )
+
+    async def _run(self, function: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run function with the given arguments in the thread of the datastore, without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _segment_path(self, name: str) -> str:
+        return os.path.join(self._path, name)
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        # Writes from the workers of a server, and from the background merge, are serialized by a lock file
+        with open(os.path.join(self._path, LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> Dict:
+        try:
+            with open(os.path.join(self._path, MANIFEST_FILE)) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return {"version": 0, "segments": []}
+
+    def _write_manifest(self, segments: List[str]) -> None:
+        manifest = {"version": self._read_manifest()["version"] + 1, "segments": segments}
+        path = os.path.join(self._path, MANIFEST_FILE)
+        with open(f"{path}.tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def _refresh(self) -> None:
+        """
+        Pick up the segments and deletes written since the last call, by this process or another one.
+        """
+        for _ in range(3):
+            manifest = self._read_manifest()
+            if manifest["version"] != self._version:
+                try:
+                    self._segments = {
+                        name: self._segments.get(name)
+                        or Segment(self._segment_path(name))
+                        for name in manifest["segments"]
+                    }
+                except FileNotFoundError:
+                    # A merge removed a segment between reading the manifest and opening it
+                    continue
+                self._version = manifest["version"]
+            break
+        for segment in self._segments.values():
+            segment.read_tombstones()
+
+    def _tombstone(self, segment: Segment, rows: np.ndarray) -> None:
+        rows = rows[~segment.deleted[rows]]
+        if not len(rows):
+            return
+        with open(os.path.join(segment.path, TOMBSTONES_FILE), "ab") as tombstones:
+            tombstones.write(rows.astype("<i8").tobytes())
+            tombstones.flush()
+            os.fsync(tombstones.fileno())
+        segment.read_tombstones()
+
+    def _write_segment(self, chunks: List[DocumentChunk]) -> str:
+        embeddings = normalize_embeddings(
+            np.array([chunk.embedding for chunk in chunks], dtype=np.float32)
+        )
+        for segment in self._segments.values():
+            if segment.embeddings.shape[1] != embeddings.shape[1]:
+                raise ValueError(
+                    f"Embedding dimension {embeddings.shape[1]} does not match the stored dimension {segment.embeddings.shape[1]}"
+                )
+        strings = [_chunk_strings(chunk) for chunk in chunks]
+        name = f"segment-{uuid.uuid4().hex}"
+        writer = SegmentWriter(
+            self._segment_path(name), len(chunks), embeddings.shape[1], self._quantization
+        )
+        writer.append(
+            embeddings,
+            np.array(
+                [
+                    to_unix_timestamp(s["created_at"]) if s["created_at"] else np.nan
+                    for s in strings
+                ],
+                dtype=np.float64,
+            ),
+            {column: [s[column] for s in strings] for column in STRING_COLUMNS},
+        )
+        writer.close()
+        return name
+
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+        """
+        Takes in a list of list of document chunks and inserts them into the database.
+        Return a list of document ids.
+        """
+        # The last chunk with a given id wins
+        unique_chunks = list(
+            {chunk.id: chunk for doc_chunks in chunks.values() for chunk in doc_chunks}.values()
+        )
+        if unique_chunks:
+            await self._run(self._write, unique_chunks)
+            self._maybe_compact()
+        return list(chunks.keys())
+
+    def _write(self, chunks: List[DocumentChunk]) -> None:
+        with self._write_lock():
+            self._refresh()
+            name = self._write_segment(chunks)
+            # Add the new segment before deleting the chunks it replaces, so that a crash
+            # in between leaves duplicates rather than losing chunks
+            self._write_manifest(list(self._segments) + [name])
+            id_hashes = _string_hashes([chunk.id for chunk in chunks])
+            for segment in self._segments.values():
+                self._tombstone(
+                    segment, np.flatnonzero(np.isin(segment.hashes["id"], id_hashes))
+                )
+            self._refresh()
+
+    async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        """
+        Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
+        Each segment is scored block by block against all the queries at once, and the best rows of every block are merged.
+        Segments with quantized embeddings are scored approximately from them, and the best rescore_factor * top_k
+        candidates of each query are then rescored from the full-precision embeddings, which are only read for those rows.
+        """
+        return await self._run(self._search, queries)
+
+    def _search(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        self._refresh()
+        segments = list(self._segments.values())
+        top_ks = [query.top_k or 0 for query in queries]
+        k = max(top_ks, default=0)
+        if k == 0 or not segments:
+            return [QueryResult(query=query.query, results=[]) for query in queries]
+
+        query_embeddings = normalize_embeddings(
+            np.array([query.embedding for query in queries], dtype=np.float32)
+        )
+        rescore = any(segment.quantization != "none" for segment in segments)
+        candidates = k * self._rescore_factor if rescore else k
+        candidate_scores: List[np.ndarray] = []
+        candidate_segments: List[np.ndarray] = []
+        candidate_rows: List[np.ndarray] = []
+        for index, segment in enumerate(segments):
+            # Queries often share a filter, so compute the mask of each distinct filter once
+            masks: Dict[str, np.ndarray] = {}
+            query_masks = []
+            for query in queries:
+                key = query.filter.json() if query.filter else ""
+                if key not in masks:
+                    masks[key] = (
+                        segment.filter_mask(query.filter)
+                        if query.filter
+                        else ~segment.deleted
+                    )
+                query_masks.append(masks[key])
+
+            for start in range(0, segment.size, QUERY_BLOCK_ROWS):
+                end = min(start + QUERY_BLOCK_ROWS, segment.size)
+                scores = segment.scores(query_embeddings, start, end)
+                for i, mask in enumerate(query_masks):
+                    scores[i, ~mask[start:end]] = -np.inf
+                rows, top_scores = select_top_k(scores, min(candidates, end - start))
+                candidate_scores.append(top_scores)
+                candidate_segments.append(np.full(rows.shape, index))
+                candidate_rows.append(rows + start)
+
+        all_scores = np.concatenate(candidate_scores, axis=1)
+        best, best_scores = select_top_k(all_scores, min(candidates, all_scores.shape[1]))
+        best_segments = np.take_along_axis(
+            np.concatenate(candidate_segments, axis=1), best, axis=1
+        )
+        best_rows = np.take_along_axis(np.concatenate(candidate_rows, axis=1), best, axis=1)
+        if rescore:
+            best_scores = self._rescore(
+                segments, query_embeddings, best_segments, best_rows, best_scores
+            )
+            best, best_scores = select_top_k(best_scores, min(k, best_scores.shape[1]))
+            best_segments = np.take_along_axis(best_segments, best, axis=1)
+            best_rows = np.take_along_axis(best_rows, best, axis=1)
+
+        results = []
+        for i, query in enumerate(queries):
+            results.append(
+                QueryResult(
+                    query=query.query,
+                    results=[
+                        segments[index].chunk(row, float(score))
+                        for index, row, score in zip(
+                            best_segments[i, : top_ks[i]],
+                            best_rows[i, : top_ks[i]],
+                            best_scores[i, : top_ks[i]],
+                        )
+                        # Rows excluded by the filter or deleted
+                        if score != -np.inf
+                    ],
+                )
+            )
+        return results
+
+    def _rescore(
+        self,
+        segments: List[Segment],
+        query_embeddings: np.ndarray,
+        candidate_segments: np.ndarray,
+        candidate_rows: np.ndarray,
+        candidate_scores: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Return the exact scores of the candidate rows of each query, -inf for the rows excluded by the filters.
+        """
+        scores = np.full(candidate_scores.shape, -np.inf, dtype=np.float32)
+        valid = candidate_scores != -np.inf
+        for index, segment in enumerate(segments):
+            queries, positions = np.nonzero(valid & (candidate_segments == index))
+            if len(queries):
+                embeddings = segment.embeddings[candidate_rows[queries, positions]]
+                scores[queries, positions] = np.einsum(
+                    "ij,ij->i", embeddings, query_embeddings[queries]
+                )
+        return scores
+
+    async def delete(
+        self,
+        ids: Optional[List[str]] = None,
+        filter: Optional[DocumentMetadataFilter] = None,
+        delete_all: Optional[bool] = None,
+    ) -> bool:
+        """
+        Removes vectors by ids, filter, or everything in the datastore.
+        Multiple parameters can be used at once.
+        Returns whether the operation was successful.
+        """
+        await self._run(self._delete, ids, filter, delete_all)
+        self._maybe_compact()
+        return True
+
+    def _delete(
+        self,
+        ids: Optional[List[str]],
+        filter: Optional[DocumentMetadataFilter],
+        delete_all: Optional[bool],
+    ) -> None:
+        with self._write_lock():
+            self._refresh()
+            if delete_all:
+                names = list(self._segments)
+                self._write_manifest([])
+                self._refresh()
+                for name in names:
+                    shutil.rmtree(self._segment_path(name), ignore_errors=True)
+                return
+
+            # An empty filter would match everything, only delete_all does that
+            has_filter = filter is not None and any(
+                value is not None for value in filter.dict().values()
+            )
+            document_hashes = _string_hashes(ids or [])
+            for segment in self._segments.values():
+                mask = np.zeros(segment.size, dtype=bool)
+                if ids:
+                    mask |= np.isin(segment.hashes["document_id"], document_hashes)
+                if has_filter:
+                    mask |= segment.filter_mask(filter)  # type: ignore
+                self._tombstone(segment, np.flatnonzero(mask))
+
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        Takes in a list of document ids and returns, for each stored document, a dict from chunk id to the content hash of the chunk.
+        """
+        return await self._run(self._chunk_hashes, document_ids)
+
+    def _chunk_hashes(self, document_ids: List[str]) -> Dict[str, Dict[str, Optional[str]]]:
+        self._refresh()
+        hashes: Dict[str, Dict[str, Optional[str]]] = {}
+        document_hashes = _string_hashes(document_ids)
+        for segment in self._segments.values():
+            rows = np.flatnonzero(
+                np.isin(segment.hashes["document_id"], document_hashes) & ~segment.deleted
+            )
+            for row in rows:
+                hashes.setdefault(segment.string("document_id", row), {})[  # type: ignore
+                    segment.string("id", row)  # type: ignore
+                ] = segment.string("content_hash", row)
+        return hashes
+
+    async def _delete_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        """
+        Takes in a dict from document id to chunk ids and deletes those chunks.
+        """
+        await self._run(
+            self._delete_ids, [id_ for ids in chunk_ids.values() for id_ in ids]
+        )
+        self._maybe_compact()
+
+    def _delete_ids(self, chunk_ids: List[str]) -> None:
+        id_hashes = _string_hashes(chunk_ids)
+        with self._write_lock():
+            self._refresh()
+            for segment in self._segments.values():
+                self._tombstone(
+                    segment, np.flatnonzero(np.isin(segment.hashes["id"], id_hashes))
+                )
+
+    def _segments_to_merge(self) -> List[str]:
+        """
+        Pick the segments to merge next: a segment with too many deleted rows,
+        or merge_factor segments whose number of rows has the same order of magnitude.
+        """
+        tiers: Dict[int, List[str]] = {}
+        for name, segment in self._segments.items():
+            if segment.size - segment.live_size > self._max_deleted_ratio * segment.size:
+                return [name]
+            tier = int(math.log(max(segment.live_size, 1), self._merge_factor))
+            tiers.setdefault(tier, []).append(name)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self._merge_factor:
+                return tiers[tier]
+        return []
+
+    def _maybe_compact(self) -> None:
+        if self._compaction is not None and not self._compaction.done():
+            return
+        names = self._segments_to_merge()
+        if names:
+            self._compaction = asyncio.create_task(self._compact_in_background(names))
+
+    async def _compact_in_background(self, names: List[str]) -> None:
+        try:
+            await asyncio.to_thread(self._merge, names)
+        except Exception as e:
+            logger.error(f"Error merging segments {names}: {e}")
+            return
+        await self._run(self._refresh)
+        self._maybe_compact()
+
+    async def compact(self) -> None:
+        """
+        Merge all the segments into one, without their deleted rows.
+        """
+        if self._compaction is not None:
+            await self._compaction
+        await self._run(self._refresh)
+        if self._segments:
+            await asyncio.to_thread(self._merge, list(self._segments))
+            await self._run(self._refresh)
+
+    def _merge(self, names: List[str]) -> None:
+        """
+        Write the live rows of the named segments to a new segment, and replace them with it.
+        Runs in a thread, with its own views of the segments, while queries and writes go on.
+        """
+        sources = [Segment(self._segment_path(name)) for name in names]
+        live_rows = [np.flatnonzero(~source.deleted) for source in sources]
+        size = sum(len(rows) for rows in live_rows)
+        name = f"segment-{uuid.uuid4().hex}"
+
+        if size:
+            writer = SegmentWriter(
+                self._segment_path(name),
+                size,
+                sources[0].embeddings.shape[1],
+                self._quantization,
+            )
+            for source, rows in zip(sources, live_rows):
+                for start in range(0, len(rows), QUERY_BLOCK_ROWS):
+                    block = rows[start : start + QUERY_BLOCK_ROWS]
+                    writer.append(
+                        source.embeddings[block],
+                        source.timestamps[block],
+                        {column: source.strings(column, block) for column in STRING_COLUMNS},
+                    )
+            writer.close()
+
+        with self._write_lock():
+            manifest = self._read_manifest()
+            if not all(name in manifest["segments"] for name in names):
+                # The segments were deleted in the meantime
+                shutil.rmtree(self._segment_path(name), ignore_errors=True)
+                return
+
+            if size:
+                # Carry over the rows deleted while the segments were being merged
+                deleted: List[np.ndarray] = []
+                offset = 0
+                for source, rows in zip(sources, live_rows):
+                    newly_deleted = source.read_tombstones()
+                    positions = np.searchsorted(rows, newly_deleted)
+                    found = positions < len(rows)
+                    found[found] = rows[positions[found]] == newly_deleted[found]
+                    deleted.append(offset + positions[found])
+                    offset += len(rows)
+                self._tombstone(Segment(self._segment_path(name)), np.concatenate(deleted))
+
+            segments = [segment for segment in manifest["segments"] if segment not in names]
+            self._write_manifest(segments + ([name] if size else []))
+
+        for source in names:
+            shutil.rmtree(self._segment_path(source), ignore_errors=True)
+        logger.info(f"Merged {len(names)} segments into {name} of {size} chunks")
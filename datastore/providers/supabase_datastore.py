@@ -1,12 +1,17 @@
 import os
-from typing import Any, List
+from typing import Any, List, Optional
 from datetime import datetime
 
 from supabase import Client
 
-from datastore.providers.pgvector_datastore import PGClient, PgVectorDataStore
+from datastore.providers.pgvector_datastore import (
+    PGClient,
+    PgVectorDataStore,
+    group_rows_by_columns,
+)
 from models.models import (
     DocumentMetadataFilter,
+    QueryAccuracy,
 )
 
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
@@ -38,13 +43,33 @@ class SupabaseClient(PGClient):
         Takes in a list of documents and inserts them into the table.
         """
         if "created_at" in json:
-            json["created_at"] = json["created_at"][0].isoformat()
+            json["created_at"] = json["created_at"].isoformat()
 
         self.client.table(table).upsert(json).execute()
 
-    async def rpc(self, function_name: str, params: dict[str, Any]):
+    async def bulk_upsert(self, table: str, rows: List[dict[str, Any]]):
+        """
+        Inserts or updates the rows in the table, with a request per set of columns.
+        """
+        rows = [
+            {**row, "created_at": row["created_at"].isoformat()}
+            if "created_at" in row
+            else row
+            for row in rows
+        ]
+        # Rows of a request must have the same columns, or the missing ones are set to null instead of their default
+        for group in group_rows_by_columns(rows):
+            self.client.table(table).upsert(group).execute()
+
+    async def rpc(
+        self,
+        function_name: str,
+        params: dict[str, Any],
+        accuracy: Optional[QueryAccuracy] = None,
+    ):
         """
         Calls a stored procedure in the database with the given parameters.
+        The accuracy hint is ignored, since PostgREST does not set settings for a single call.
         """
         if "in_start_date" in params:
             params["in_start_date"] = params["in_start_date"].isoformat()
@@ -54,6 +79,17 @@ class SupabaseClient(PGClient):
         response = self.client.rpc(function_name, params=params).execute()
         return response.data
 
+    async def select_in(
+        self, table: str, columns: List[str], column: str, ids: List[str]
+    ) -> List[dict[str, Any]]:
+        """
+        Returns the given columns of rows in the table that match the ids.
+        """
+        response = (
+            self.client.table(table).select(",".join(columns)).in_(column, ids).execute()
+        )
+        return response.data
+
     async def delete_like(self, table: str, column: str, pattern: str):
         """
         Deletes rows in the table that match the pattern.
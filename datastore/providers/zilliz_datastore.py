@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from loguru import logger
 from typing import Optional
@@ -8,6 +9,7 @@ from pymilvus import (
 from uuid import uuid4
 
 from datastore.providers.milvus_datastore import (
+    MILVUS_MAX_WORKERS,
     MilvusDataStore,
 )
 
@@ -19,6 +21,7 @@ ZILLIZ_PASSWORD = os.environ.get("ZILLIZ_PASSWORD")
 ZILLIZ_USE_SECURITY = False if ZILLIZ_PASSWORD is None else True
 
 ZILLIZ_CONSISTENCY_LEVEL = os.environ.get("ZILLIZ_CONSISTENCY_LEVEL")
+ZILLIZ_PARTITION_KEY = os.environ.get("ZILLIZ_PARTITION_KEY")
 
 class ZillizDataStore(MilvusDataStore):
     def __init__(self, create_new: Optional[bool] = False):
@@ -31,6 +34,10 @@ class ZillizDataStore(MilvusDataStore):
         """
         # Overwrite the default consistency level by MILVUS_CONSISTENCY_LEVEL
         self._consistency_level = ZILLIZ_CONSISTENCY_LEVEL or "Bounded"
+        self._partition_key = ZILLIZ_PARTITION_KEY
+        self._executor = ThreadPoolExecutor(
+            max_workers=MILVUS_MAX_WORKERS, thread_name_prefix="zilliz"
+        )
         self._create_connection()
 
         self._create_collection(ZILLIZ_COLLECTION, create_new)  # type: ignore
@@ -0,0 +1 @@
+alter table documents add column if not exists content_hash text;
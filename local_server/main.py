@@ -14,7 +14,7 @@ from models.api import (
     UpsertResponse,
 )
 from datastore.factory import get_datastore
-from services.file import get_document_from_file
+from services.file import FileTooLargeError, get_document_from_file
 
 from starlette.responses import FileResponse
 
@@ -77,7 +77,10 @@ async def upsert_file(
     except:
         metadata_obj = DocumentMetadata(source=Source.file)
 
-    document = await get_document_from_file(file, metadata_obj)
+    try:
+        document = await get_document_from_file(file, metadata_obj)
+    except FileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
     try:
         ids = await datastore.upsert([document])
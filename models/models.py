@@ -39,6 +39,7 @@ class DocumentChunk(BaseModel):
     text: str
     metadata: DocumentChunkMetadata
     embedding: Optional[List[float]] = None
+    content_hash: Optional[str] = None  # set by incremental upserts to skip unchanged chunks
 
 
 class DocumentChunkWithScore(DocumentChunk):
@@ -64,10 +65,18 @@ class DocumentMetadataFilter(BaseModel):
     end_date: Optional[str] = None  # any date string format
 
 
+class QueryAccuracy(str, Enum):
+    # Hint for datastores with approximate indexes, trading recall for latency
+    fast = "fast"
+    balanced = "balanced"
+    accurate = "accurate"
+
+
 class Query(BaseModel):
     query: str
     filter: Optional[DocumentMetadataFilter] = None
     top_k: Optional[int] = 3
+    accuracy: Optional[QueryAccuracy] = None
 
 
 class QueryWithEmbedding(Query):
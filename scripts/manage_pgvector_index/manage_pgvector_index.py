@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+
+from datastore.providers.postgres_datastore import PostgresClient
+
+
+async def main():
+    # parse the command-line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--method",
+        default=None,
+        choices=["hnsw", "ivfflat"],
+        help="The index to create on the embeddings, or none to only check the query plan",
+    )
+    parser.add_argument(
+        "--table", default="documents", help="The table of the embeddings"
+    )
+    parser.add_argument(
+        "--m",
+        default=16,
+        type=int,
+        help="The maximum number of connections of a node of an HNSW index",
+    )
+    parser.add_argument(
+        "--ef_construction",
+        default=64,
+        type=int,
+        help="The size of the candidate list when building an HNSW index",
+    )
+    parser.add_argument(
+        "--lists",
+        default=None,
+        type=int,
+        help="The number of lists of an IVFFlat index, by default the number of rows divided by 1000",
+    )
+    parser.add_argument(
+        "--rebuild",
+        default=False,
+        type=bool,
+        help="A boolean flag to indicate whether to rebuild the index if it already exists",
+    )
+    args = parser.parse_args()
+
+    client = PostgresClient(pool_size=1)
+    if args.method:
+        await client.create_index(
+            args.table,
+            args.method,
+            m=args.m,
+            ef_construction=args.ef_construction,
+            lists=args.lists,
+            rebuild=args.rebuild,
+        )
+    if await client.check_query_plan(args.table):
+        print(f"Vector searches of {args.table} use an index")
+    else:
+        print(f"Vector searches of {args.table} scan the whole table")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import json
+import os
+from typing import Optional
+
+from loguru import logger
+from pymilvus import Collection, utility
+
+from datastore.providers.milvus_datastore import (
+    EMBEDDING_FIELD,
+    MILVUS_NUM_PARTITIONS,
+    SCHEMA_V2,
+    MilvusDataStore,
+    batch_rows,
+    create_schema,
+    get_partition_key,
+)
+
+
+async def migrate(
+    datastore: MilvusDataStore,
+    target_name: str,
+    partition_key: Optional[str],
+    num_partitions: int,
+    batch_size: int,
+    swap: bool,
+) -> int:
+    """
+    Copy the chunks of the collection of the datastore to a new collection partitioned by partition_key,
+    batch_size chunks per query, and return the number of chunks copied.
+    """
+    source = datastore.col
+    source_name = source.name
+    if utility.has_collection(target_name, using=datastore.alias):
+        raise ValueError(f"Collection {target_name} already exists")
+    logger.info(
+        f"Creating {target_name} partitioned by {partition_key} in {num_partitions} partitions"
+    )
+    target = Collection(
+        target_name,
+        schema=create_schema(partition_key),
+        using=datastore.alias,
+        consistency_level=datastore._consistency_level,
+        **({} if partition_key is None else {"num_partitions": num_partitions}),
+    )
+
+    # The primary keys of all the chunks, then their fields a batch of keys at a time
+    pk_name = "pk" if datastore._schema_ver == "V1" else "id"
+    expression = "pk >= 0" if datastore._schema_ver == "V1" else 'id >= ""'
+    pks = [
+        entity[pk_name]
+        for entity in await datastore._run(
+            source.query, expression, output_fields=[pk_name]
+        )
+    ]
+    logger.info(f"Copying {len(pks)} chunks from {source_name}")
+    fields = [field[0] for field in SCHEMA_V2]
+    migrated = 0
+    for start in range(0, len(pks), batch_size):
+        keys = ",".join(json.dumps(pk) for pk in pks[start : start + batch_size])
+        entities = await datastore._run(
+            source.query, f"{pk_name} in [{keys}]", output_fields=fields
+        )
+        rows = [[entity[field] for field in fields] for entity in entities]
+        for batch in batch_rows(rows):
+            await datastore._run(
+                target.insert, [list(column) for column in zip(*batch)]
+            )
+        migrated += len(rows)
+        logger.info(f"Migrated {migrated} chunks")
+
+    await datastore._run(target.flush)
+    logger.info(f"Creating the index {datastore.index_params} on {target_name}")
+    await datastore._run(
+        target.create_index, EMBEDDING_FIELD, index_params=datastore.index_params
+    )
+    logger.info(
+        f"Migrated {migrated} chunks: {source_name} has {source.num_entities} entities, "
+        f"{target_name} has {target.num_entities}"
+    )
+    if swap:
+        backup_name = f"{source_name}_backup"
+        logger.info(
+            f"Renaming {source_name} to {backup_name} and {target_name} to {source_name}"
+        )
+        source.release()
+        utility.rename_collection(source_name, backup_name, using=datastore.alias)
+        utility.rename_collection(target_name, source_name, using=datastore.alias)
+    return migrated
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--datastore",
+        default=os.environ.get("DATASTORE", "milvus"),
+        choices=["milvus", "zilliz"],
+        help="The datastore of the collection to migrate, defaults to DATASTORE",
+    )
+    parser.add_argument(
+        "--partition_key",
+        required=True,
+        help="The field to partition the new collection by, one of document_id, source_id, source or author",
+    )
+    parser.add_argument(
+        "--num_partitions",
+        default=MILVUS_NUM_PARTITIONS,
+        type=int,
+        help="The number of partitions of the new collection, defaults to MILVUS_NUM_PARTITIONS",
+    )
+    parser.add_argument(
+        "--target",
+        default=None,
+        help="The name of the new collection, defaults to the name of the collection with a _partitioned suffix",
+    )
+    parser.add_argument(
+        "--batch_size",
+        default=100,
+        type=int,
+        help="The number of chunks to read per query",
+    )
+    parser.add_argument(
+        "--swap",
+        default=False,
+        type=bool,
+        help="Rename the collection to <name>_backup and the new collection to its name once copied",
+    )
+    args = parser.parse_args()
+
+    # Open the collection that the app is configured with
+    if args.datastore == "zilliz":
+        from datastore.providers.zilliz_datastore import ZillizDataStore
+
+        datastore: MilvusDataStore = ZillizDataStore()
+    else:
+        datastore = MilvusDataStore()
+    if get_partition_key(datastore.col) == args.partition_key:
+        logger.info(
+            f"{datastore.col.name} is already partitioned by {args.partition_key}"
+        )
+        return
+    await migrate(
+        datastore,
+        args.target or f"{datastore.col.name}_partitioned",
+        args.partition_key,
+        args.num_partitions,
+        args.batch_size,
+        args.swap,
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+
+from loguru import logger
+
+from datastore.providers.redis_datastore import (
+    REDIS_DOC_PREFIX,
+    REDIS_INDEX_NAME,
+    VECTOR_DIMENSION,
+    RedisDataStore,
+)
+
+# The Redis type of JSON keys, to skip any other key that shares the prefix
+REDIS_JSON_KEY_TYPE = "ReJSON-RL"
+
+
+async def migrate(
+    datastore: RedisDataStore,
+    source_index: str,
+    source_prefix: str,
+    batch_size: int,
+    drop_source: bool,
+) -> int:
+    """
+    Copy the JSON chunks under source_prefix to hashes in the datastore, batch_size keys per round trip,
+    and return the number of chunks copied.
+    """
+    client = datastore.client
+    migrated = 0
+    keys = []
+
+    async def copy(keys):
+        async with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.json().get(key)
+            documents = await pipe.execute()
+        async with client.pipeline(transaction=False) as pipe:
+            for document in documents:
+                if document is None:
+                    # Deleted since it was scanned
+                    continue
+                key = datastore._redis_key(
+                    document["metadata"]["document_id"], document["chunk_id"]
+                )
+                pipe.hset(key, mapping=datastore._get_redis_hash(document))
+            await pipe.execute()
+        return sum(document is not None for document in documents)
+
+    async for key in client.scan_iter(
+        match=f"{source_prefix}:*", count=batch_size, _type=REDIS_JSON_KEY_TYPE
+    ):
+        keys.append(key)
+        if len(keys) == batch_size:
+            migrated += await copy(keys)
+            keys = []
+            logger.info(f"Migrated {migrated} chunks")
+    if keys:
+        migrated += await copy(keys)
+
+    source_info = await client.ft(source_index).info()
+    target_info = await client.ft(datastore._index_name).info()
+    logger.info(
+        f"Migrated {migrated} chunks: {source_index} has {source_info['num_docs']} documents, "
+        f"{datastore._index_name} has {target_info['num_docs']}"
+    )
+    if drop_source:
+        logger.info(f"Dropping {source_index} and its documents")
+        await client.ft(source_index).dropindex(delete_documents=True)
+    return migrated
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--source_index",
+        default=REDIS_INDEX_NAME,
+        help="The name of the JSON index to migrate, defaults to REDIS_INDEX_NAME",
+    )
+    parser.add_argument(
+        "--source_prefix",
+        default=REDIS_DOC_PREFIX,
+        help="The key prefix of the JSON index, defaults to REDIS_DOC_PREFIX",
+    )
+    parser.add_argument(
+        "--target_index", required=True, help="The name of the hash index to create"
+    )
+    parser.add_argument(
+        "--target_prefix",
+        required=True,
+        help="The key prefix of the hash index, which must differ from the source prefix",
+    )
+    parser.add_argument(
+        "--dim",
+        default=VECTOR_DIMENSION,
+        type=int,
+        help="The dimension of the embeddings",
+    )
+    parser.add_argument(
+        "--batch_size",
+        default=500,
+        type=int,
+        help="The number of chunks to read and write per round trip",
+    )
+    parser.add_argument(
+        "--drop_source",
+        default=False,
+        type=bool,
+        help="A boolean flag to indicate whether to drop the JSON index and delete its documents once they are copied",
+    )
+    args = parser.parse_args()
+
+    if args.target_prefix == args.source_prefix:
+        raise ValueError("The hash chunks need a different key prefix than the JSON chunks")
+
+    datastore = await RedisDataStore.init(
+        dim=args.dim,
+        storage_type="hash",
+        index_name=args.target_index,
+        doc_prefix=args.target_prefix,
+    )
+    if datastore._storage_type != "hash":
+        raise ValueError(f"The index {args.target_index} already exists and is not a hash index")
+    await migrate(
+        datastore,
+        args.source_index,
+        args.source_prefix,
+        args.batch_size,
+        args.drop_source,
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,107 +1,117 @@
-import uuid
 import json
 import argparse
 import asyncio
+from typing import Optional
 
 from loguru import logger
 from models.models import Document, DocumentMetadata
 from datastore.datastore import DataStore
 from datastore.factory import get_datastore
-from services.extract_metadata import extract_metadata_from_document
-from services.pii_detection import screen_text_for_pii
+from services.ingestion import (
+    QUEUE_SIZE,
+    Checkpoint,
+    DeadLetterQueue,
+    Pipeline,
+    add_language_model_stages,
+    add_upsert_stages,
+)
 
 DOCUMENT_UPSERT_BATCH_SIZE = 50
 
 
+def get_document_from_item(item: dict, custom_metadata: dict) -> Optional[Document]:
+    # get the id, text, source, source_id, url, created_at and author from the item
+    # use default values if not specified
+    id = item.get("id", None)
+    text = item.get("text", None)
+    source = item.get("source", None)
+    source_id = item.get("source_id", None)
+    url = item.get("url", None)
+    created_at = item.get("created_at", None)
+    author = item.get("author", None)
+
+    if not text:
+        logger.info("No document text, skipping...")
+        return None
+
+    # create a metadata object with the source, source_id, url, created_at and author
+    metadata = DocumentMetadata(
+        source=source,
+        source_id=source_id,
+        url=url,
+        created_at=created_at,
+        author=author,
+    )
+
+    # update metadata with custom values
+    for key, value in custom_metadata.items():
+        if hasattr(metadata, key):
+            setattr(metadata, key, value)
+
+    # create a document object with the id, text and metadata
+    return Document(
+        id=id,
+        text=text,
+        metadata=metadata,
+    )
+
+
 async def process_jsonl_dump(
     filepath: str,
     datastore: DataStore,
     custom_metadata: dict,
     screen_for_pii: bool,
     extract_metadata: bool,
+    llm_concurrency: int = 4,
+    embed_concurrency: int = 2,
+    upsert_concurrency: int = 2,
+    queue_size: int = QUEUE_SIZE,
+    resume: bool = False,
+    checkpoint_path: Optional[str] = None,
+    dead_letter_path: Optional[str] = None,
 ):
-    # open the jsonl file as a generator of dictionaries
-    with open(filepath) as jsonl_file:
-        data = [json.loads(line) for line in jsonl_file]
+    checkpoint = Checkpoint(checkpoint_path or f"{filepath}.checkpoint", resume)
+    dead_letters = DeadLetterQueue(
+        dead_letter_path or f"{filepath}.dead_letter.jsonl", append=resume
+    )
 
-    documents = []
-    skipped_items = []
-    # iterate over the data and create document objects
-    for item in data:
-        if len(documents) % 20 == 0:
-            logger.info(f"Processed {len(documents)} documents")
+    # stream the lines of the jsonl file instead of loading it all into memory,
+    # the bounded queues of the pipeline keep the reader from running ahead
+    async def read_lines():
+        with open(filepath) as jsonl_file:
+            for line in jsonl_file:
+                if line.strip():
+                    yield line.strip()
 
+    async def parse(line: str) -> Optional[Document]:
         try:
-            # get the id, text, source, source_id, url, created_at and author from the item
-            # use default values if not specified
-            id = item.get("id", None)
-            text = item.get("text", None)
-            source = item.get("source", None)
-            source_id = item.get("source_id", None)
-            url = item.get("url", None)
-            created_at = item.get("created_at", None)
-            author = item.get("author", None)
-
-            if not text:
-                logger.info("No document text, skipping...")
-                continue
-
-            # create a metadata object with the source, source_id, url, created_at and author
-            metadata = DocumentMetadata(
-                source=source,
-                source_id=source_id,
-                url=url,
-                created_at=created_at,
-                author=author,
-            )
-
-            # update metadata with custom values
-            for key, value in custom_metadata.items():
-                if hasattr(metadata, key):
-                    setattr(metadata, key, value)
-
-            # screen for pii if requested
-            if screen_for_pii:
-                pii_detected = screen_text_for_pii(text)
-                # if pii detected, print a warning and skip the document
-                if pii_detected:
-                    logger.info("PII detected in document, skipping")
-                    skipped_items.append(item)  # add the skipped item to the list
-                    continue
-
-            # extract metadata if requested
-            if extract_metadata:
-                # extract metadata from the document text
-                extracted_metadata = extract_metadata_from_document(
-                    f"Text: {text}; Metadata: {str(metadata)}"
-                )
-                # get a Metadata object from the extracted metadata
-                metadata = DocumentMetadata(**extracted_metadata)
-
-            # create a document object with the id, text and metadata
-            document = Document(
-                id=id,
-                text=text,
-                metadata=metadata,
-            )
-            documents.append(document)
+            document = get_document_from_item(json.loads(line), custom_metadata)
+            if document is None:
+                dead_letters.put(line, "No document text")
+            return document
         except Exception as e:
             # log the error and continue with the next item
-            logger.error(f"Error processing {item}: {e}")
-            skipped_items.append(item)  # add the skipped item to the list
+            logger.error(f"Error processing {line}: {e}")
+            dead_letters.put(line, f"Error processing item: {e}")
+            return None
 
-    # do this in batches, the upsert method already batches documents but this allows
-    # us to add more descriptive logging
-    for i in range(0, len(documents), DOCUMENT_UPSERT_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_documents = documents[i : i + DOCUMENT_UPSERT_BATCH_SIZE]
-        logger.info(f"Upserting batch of {len(batch_documents)} documents, batch {i}")
-        await datastore.upsert(batch_documents)
+    pipeline = Pipeline(queue_size=queue_size).add_stage("parse", parse)
+    add_language_model_stages(
+        pipeline, screen_for_pii, extract_metadata, llm_concurrency, dead_letters
+    )
+    add_upsert_stages(
+        pipeline,
+        datastore,
+        DOCUMENT_UPSERT_BATCH_SIZE,
+        embed_concurrency=embed_concurrency,
+        upsert_concurrency=upsert_concurrency,
+        dead_letters=dead_letters,
+    )
 
-    # print the skipped items
-    logger.info(f"Skipped {len(skipped_items)} items due to errors or PII detection")
-    for item in skipped_items:
-        logger.info(item)
+    try:
+        await pipeline.run(read_lines(), checkpoint)
+    finally:
+        dead_letters.close()
 
 
 async def main():
@@ -125,6 +135,46 @@ async def main():
         type=bool,
         help="A boolean flag to indicate whether to try to extract metadata from the document (using a language model)",
     )
+    parser.add_argument(
+        "--llm_concurrency",
+        default=4,
+        type=int,
+        help="The number of documents to screen for PII or extract metadata from at once",
+    )
+    parser.add_argument(
+        "--embed_concurrency",
+        default=2,
+        type=int,
+        help="The number of batches of documents to embed at once",
+    )
+    parser.add_argument(
+        "--upsert_concurrency",
+        default=2,
+        type=int,
+        help="The number of batches of documents to upsert at once",
+    )
+    parser.add_argument(
+        "--queue_size",
+        default=QUEUE_SIZE,
+        type=int,
+        help="The maximum number of items waiting between two stages of the pipeline",
+    )
+    parser.add_argument(
+        "--resume",
+        default=False,
+        type=bool,
+        help="A boolean flag to indicate whether to skip the items a previous run already processed, as recorded in the checkpoint file",
+    )
+    parser.add_argument(
+        "--checkpoint_path",
+        default=None,
+        help="The path to the checkpoint file, defaults to the path to the jsonl dump followed by .checkpoint",
+    )
+    parser.add_argument(
+        "--dead_letter_path",
+        default=None,
+        help="The path to the JSONL file of skipped items, defaults to the path to the jsonl dump followed by .dead_letter.jsonl",
+    )
     args = parser.parse_args()
 
     # get the arguments
@@ -137,7 +187,18 @@ async def main():
     datastore = await get_datastore()
     # process the jsonl dump
     await process_jsonl_dump(
-        filepath, datastore, custom_metadata, screen_for_pii, extract_metadata
+        filepath,
+        datastore,
+        custom_metadata,
+        screen_for_pii,
+        extract_metadata,
+        args.llm_concurrency,
+        args.embed_concurrency,
+        args.upsert_concurrency,
+        args.queue_size,
+        args.resume,
+        args.checkpoint_path,
+        args.dead_letter_path,
     )
 
 
@@ -4,16 +4,47 @@ import os
 import json
 import argparse
 import asyncio
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from tempfile import SpooledTemporaryFile
+from typing import Optional
 
 from loguru import logger
 from models.models import Document, DocumentMetadata, Source
 from datastore.datastore import DataStore
 from datastore.factory import get_datastore
-from services.extract_metadata import extract_metadata_from_document
-from services.file import extract_text_from_filepath
-from services.pii_detection import screen_text_for_pii
+from services.file import extract_text_from_file, get_mimetype
+from services.ingestion import (
+    Checkpoint,
+    DeadLetterQueue,
+    Pipeline,
+    add_language_model_stages,
+    add_upsert_stages,
+)
 
 DOCUMENT_UPSERT_BATCH_SIZE = 50
+EXTENSIONS = ".pdf,.txt,.md,.docx,.pptx,.csv"  # The extensions of the files to process by default
+MAX_FILE_SIZE = 50 * 1024 * 1024  # The maximum uncompressed size of a file to process, in bytes
+SPOOL_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # Files larger than this are spooled to a temporary file instead of memory
+
+
+@lru_cache(maxsize=1)
+def open_zip_file(filepath: str) -> zipfile.ZipFile:
+    # keep the archive open in each worker, so that its central directory is only read once
+    return zipfile.ZipFile(filepath)
+
+
+def extract_text_from_zip_member(filepath: str, name: str, mimetype: str) -> str:
+    """Return the text content of a file of a zip archive, without extracting it to disk."""
+    # copy the member to a seekable buffer, as the pdf, docx and pptx readers need to seek,
+    # which is slow on a compressed member
+    with open_zip_file(filepath).open(name) as member, SpooledTemporaryFile(
+        max_size=SPOOL_MAX_MEMORY_SIZE
+    ) as buffer:
+        shutil.copyfileobj(member, buffer)
+        buffer.seek(0)
+        return extract_text_from_file(buffer, mimetype)  # type: ignore
 
 
 async def process_file_dump(
@@ -22,93 +53,100 @@ async def process_file_dump(
     custom_metadata: dict,
     screen_for_pii: bool,
     extract_metadata: bool,
+    llm_concurrency: int = 4,
+    resume: bool = False,
+    checkpoint_path: Optional[str] = None,
+    dead_letter_path: Optional[str] = None,
+    extensions: str = EXTENSIONS,
+    max_file_size: int = MAX_FILE_SIZE,
+    extract_workers: int = os.cpu_count() or 1,
 ):
-    # create a ZipFile object and extract all the files into a directory named 'dump'
-    with zipfile.ZipFile(filepath) as zip_file:
-        zip_file.extractall("dump")
-
-    documents = []
-    skipped_files = []
-    # use os.walk to traverse the dump directory and its subdirectories
-    for root, dirs, files in os.walk("dump"):
-        for filename in files:
-            if len(documents) % 20 == 0:
-                logger.info(f"Processed {len(documents)} documents")
-
-            filepath = os.path.join(root, filename)
-
-            try:
-                extracted_text = extract_text_from_filepath(filepath)
-                logger.info(f"extracted_text from {filepath}")
-
-                # create a metadata object with the source and source_id fields
-                metadata = DocumentMetadata(
-                    source=Source.file,
-                    source_id=filename,
-                )
-
-                # update metadata with custom values
-                for key, value in custom_metadata.items():
-                    if hasattr(metadata, key):
-                        setattr(metadata, key, value)
-
-                # screen for pii if requested
-                if screen_for_pii:
-                    pii_detected = screen_text_for_pii(extracted_text)
-                    # if pii detected, print a warning and skip the document
-                    if pii_detected:
-                        logger.info("PII detected in document, skipping")
-                        skipped_files.append(
-                            filepath
-                        )  # add the skipped file to the list
-                        continue
-
-                # extract metadata if requested
-                if extract_metadata:
-                    # extract metadata from the document text
-                    extracted_metadata = extract_metadata_from_document(
-                        f"Text: {extracted_text}; Metadata: {str(metadata)}"
-                    )
-                    # get a Metadata object from the extracted metadata
-                    metadata = DocumentMetadata(**extracted_metadata)
-
-                # create a document object with a random id, text and metadata
-                document = Document(
-                    id=str(uuid.uuid4()),
-                    text=extracted_text,
-                    metadata=metadata,
-                )
-                documents.append(document)
-            except Exception as e:
-                # log the error and continue with the next file
-                logger.error(f"Error processing {filepath}: {e}")
-                skipped_files.append(filepath)  # add the skipped file to the list
-
-    # do this in batches, the upsert method already batches documents but this allows
-    # us to add more descriptive logging
-    for i in range(0, len(documents), DOCUMENT_UPSERT_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_documents = [doc for doc in documents[i : i + DOCUMENT_UPSERT_BATCH_SIZE]]
-        logger.info(f"Upserting batch of {len(batch_documents)} documents, batch {i}")
-        logger.info("documents: ", documents)
-        await datastore.upsert(batch_documents)
-
-    # delete all files in the dump directory
-    for root, dirs, files in os.walk("dump", topdown=False):
-        for filename in files:
-            filepath = os.path.join(root, filename)
-            os.remove(filepath)
-        for dirname in dirs:
-            dirpath = os.path.join(root, dirname)
-            os.rmdir(dirpath)
-
-    # delete the dump directory
-    os.rmdir("dump")
-
-    # print the skipped files
-    logger.info(f"Skipped {len(skipped_files)} files due to errors or PII detection")
-    for file in skipped_files:
-        logger.info(file)
+    checkpoint = Checkpoint(checkpoint_path or f"{filepath}.checkpoint", resume)
+    dead_letters = DeadLetterQueue(
+        dead_letter_path or f"{filepath}.dead_letter.jsonl", append=resume
+    )
+    allowed_extensions = {
+        extension.strip().lower() for extension in extensions.split(",")
+    }
+
+    # list the members of the zip file in the order of the archive,
+    # which stays the same between runs so the offsets of the checkpoint do too
+    async def read_members():
+        with zipfile.ZipFile(filepath) as zip_file:
+            for info in zip_file.infolist():
+                if not info.is_dir():
+                    yield info
+
+    def should_skip(info: zipfile.ZipInfo) -> Optional[str]:
+        name = os.path.basename(info.filename)
+        # skip the resource forks that macOS adds to the archives it creates
+        if info.filename.startswith("__MACOSX/") or name.startswith("._"):
+            return "macOS resource fork"
+        if os.path.splitext(name)[1].lower() not in allowed_extensions:
+            return "extension not allowed"
+        if info.file_size > max_file_size:
+            return f"larger than {max_file_size} bytes"
+        return None
+
+    # extract the text of the files in parallel, as parsing pdf, docx and pptx files is cpu bound
+    executor = ProcessPoolExecutor(max_workers=extract_workers)
+    loop = asyncio.get_running_loop()
+
+    async def extract(info: zipfile.ZipInfo) -> Optional[Document]:
+        reason = should_skip(info)
+        if reason:
+            dead_letters.put(info.filename, reason)
+            return None
+
+        try:
+            mimetype = get_mimetype(info.filename)
+            if not mimetype:
+                raise Exception("Unsupported file type")
+            extracted_text = await loop.run_in_executor(
+                executor,
+                extract_text_from_zip_member,
+                filepath,
+                info.filename,
+                mimetype,
+            )
+            logger.info(f"extracted_text from {info.filename}")
+
+            # create a metadata object with the source and source_id fields
+            metadata = DocumentMetadata(
+                source=Source.file,
+                source_id=os.path.basename(info.filename),
+            )
+
+            # update metadata with custom values
+            for key, value in custom_metadata.items():
+                if hasattr(metadata, key):
+                    setattr(metadata, key, value)
+
+            # create a document object with a random id, text and metadata
+            return Document(
+                id=str(uuid.uuid4()),
+                text=extracted_text,
+                metadata=metadata,
+            )
+        except Exception as e:
+            # log the error and continue with the next file
+            logger.error(f"Error processing {info.filename}: {e}")
+            dead_letters.put(info.filename, f"Error processing file: {e}")
+            return None
+
+    pipeline = Pipeline().add_stage("extract_text", extract, extract_workers)
+    add_language_model_stages(
+        pipeline, screen_for_pii, extract_metadata, llm_concurrency, dead_letters
+    )
+    add_upsert_stages(
+        pipeline, datastore, DOCUMENT_UPSERT_BATCH_SIZE, dead_letters=dead_letters
+    )
+
+    try:
+        await pipeline.run(read_members(), checkpoint)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        dead_letters.close()
 
 
 async def main():
@@ -132,6 +170,45 @@ async def main():
         type=bool,
         help="A boolean flag to indicate whether to try to extract metadata from the document (using a language model)",
     )
+    parser.add_argument(
+        "--llm_concurrency",
+        default=4,
+        type=int,
+        help="The number of documents to screen for PII or extract metadata from at once",
+    )
+    parser.add_argument(
+        "--resume",
+        default=False,
+        type=bool,
+        help="A boolean flag to indicate whether to skip the files a previous run already processed, as recorded in the checkpoint file",
+    )
+    parser.add_argument(
+        "--checkpoint_path",
+        default=None,
+        help="The path to the checkpoint file, defaults to the path to the file dump followed by .checkpoint",
+    )
+    parser.add_argument(
+        "--dead_letter_path",
+        default=None,
+        help="The path to the JSONL file of skipped files, defaults to the path to the file dump followed by .dead_letter.jsonl",
+    )
+    parser.add_argument(
+        "--extensions",
+        default=EXTENSIONS,
+        help="A comma-separated list of the extensions of the files to process, other files are skipped",
+    )
+    parser.add_argument(
+        "--max_file_size",
+        default=MAX_FILE_SIZE,
+        type=int,
+        help="The maximum uncompressed size of a file to process in bytes, larger files are skipped",
+    )
+    parser.add_argument(
+        "--extract_workers",
+        default=os.cpu_count() or 1,
+        type=int,
+        help="The number of processes to extract the text of the files in",
+    )
     args = parser.parse_args()
 
     # get the arguments
@@ -144,7 +221,18 @@ async def main():
     datastore = await get_datastore()
     # process the file dump
     await process_file_dump(
-        filepath, datastore, custom_metadata, screen_for_pii, extract_metadata
+        filepath,
+        datastore,
+        custom_metadata,
+        screen_for_pii,
+        extract_metadata,
+        args.llm_concurrency,
+        args.resume,
+        args.checkpoint_path,
+        args.dead_letter_path,
+        args.extensions,
+        args.max_file_size,
+        args.extract_workers,
     )
 
 
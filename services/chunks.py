@@ -1,11 +1,15 @@
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, List, Optional, Tuple
+import asyncio
+import hashlib
 import uuid
 import os
 from models.models import Document, DocumentChunk, DocumentChunkMetadata
 
 import tiktoken
 
-from services.openai import get_embeddings
+from services.embedding_cache import get_embedding_cache
+from services.openai import aget_embeddings_batched
 
 # Global variables
 tokenizer = tiktoken.get_encoding(
@@ -18,7 +22,10 @@ MIN_CHUNK_SIZE_CHARS = 350  # The minimum size of each text chunk in characters
 MIN_CHUNK_LENGTH_TO_EMBED = 5  # Discard chunks shorter than this
 EMBEDDINGS_BATCH_SIZE = int(os.environ.get("OPENAI_EMBEDDING_BATCH_SIZE", 128))  # The number of embeddings to request at a time
 MAX_NUM_CHUNKS = 10000  # The maximum number of chunks to generate from a text
+CHUNKING_MAX_WORKERS = int(os.environ.get("CHUNKING_MAX_WORKERS", os.cpu_count() or 1))  # The number of processes to chunk documents in
+CHUNKING_PARALLEL_MIN_CHARS = int(os.environ.get("CHUNKING_PARALLEL_MIN_CHARS", 1_000_000))  # Chunk a batch of documents in parallel when its text is at least this long
 
+_chunking_executor: Optional[ProcessPoolExecutor] = None
 
 
 def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
@@ -36,8 +43,12 @@ def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
     if not text or text.isspace():
         return []
 
-    # Tokenize the text
+    # Tokenize the text once, chunks are taken from it by moving a cursor
+    # forward instead of re-slicing the remaining tokens, which would copy
+    # the rest of the document for every chunk
     tokens = tokenizer.encode(text, disallowed_special=())
+    num_tokens = len(tokens)
+    start = 0
 
     # Initialize an empty list of chunks
     chunks = []
@@ -49,17 +60,17 @@ def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
     num_chunks = 0
 
     # Loop until all tokens are consumed
-    while tokens and num_chunks < MAX_NUM_CHUNKS:
-        # Take the first chunk_size tokens as a chunk
-        chunk = tokens[:chunk_size]
+    while start < num_tokens and num_chunks < MAX_NUM_CHUNKS:
+        # Take the next chunk_size tokens as a chunk
+        chunk = tokens[start : start + chunk_size]
 
         # Decode the chunk into text
         chunk_text = tokenizer.decode(chunk)
 
         # Skip the chunk if it is empty or whitespace
         if not chunk_text or chunk_text.isspace():
-            # Remove the tokens corresponding to the chunk text from the remaining tokens
-            tokens = tokens[len(chunk) :]
+            # Move the cursor past the tokens of the chunk
+            start += len(chunk)
             # Continue to the next iteration of the loop
             continue
 
@@ -83,41 +94,23 @@ def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
             # Append the chunk text to the list of chunks
             chunks.append(chunk_text_to_append)
 
-        # Remove the tokens corresponding to the chunk text from the remaining tokens
-        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+        # Move the cursor past the tokens corresponding to the chunk text. The
+        # chunk text is re-encoded rather than mapped back onto the original
+        # tokens, since BPE may split a truncated prefix differently; this only
+        # costs one encode of at most chunk_size tokens.
+        start += len(tokenizer.encode(chunk_text, disallowed_special=()))
 
         # Increment the number of chunks
         num_chunks += 1
 
     # Handle the remaining tokens
-    if tokens:
-        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
+    if start < num_tokens:
+        remaining_text = tokenizer.decode(tokens[start:]).replace("\n", " ").strip()
         if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
             chunks.append(remaining_text)
 
     return chunks
 
-### >>> NEW
-
-def create_document_chunks(
-    doc: Union[Document, SourceCode, LangchainTools, CodeDocs], 
-    chunk_token_size: Optional[int]
-) -> Tuple[List[DocumentChunk], str]:
-    # ... rest of your code
-
-    # Modify this section to handle different data types
-    if isinstance(doc, SourceCode):
-        text = doc.code
-    elif isinstance(doc, LangchainTools):
-        text = f"{doc.tool_name} {doc.version}"
-    elif isinstance(doc, CodeDocs):
-        text = doc.content
-    else:  # Assuming it's of type Document
-        text = doc.text
-
-    # ... rest of your code
-# <<< NEW
-# >>> OLD
 
 def create_document_chunks(
     doc: Document, chunk_token_size: Optional[int]
@@ -168,30 +161,82 @@ def create_document_chunks(
     # Return the list of chunks and the document id
     return doc_chunks, doc_id
 
-### >>> NEW
 
-def create_document_chunks(
-    doc: Union[Document, SourceCode, LangchainTools, CodeDocs], 
-    chunk_token_size: Optional[int]
-) -> Tuple[List[DocumentChunk], str]:
-    # ... rest of your code
-
-    # Modify this section to handle different data types
-    if isinstance(doc, SourceCode):
-        text = doc.code
-    elif isinstance(doc, LangchainTools):
-        text = f"{doc.tool_name} {doc.version}"
-    elif isinstance(doc, CodeDocs):
-        text = doc.content
-    else:  # Assuming it's of type Document
-        text = doc.text
-
-    # ... rest of your code
-    
-# << NEW
-# >>> OLD 
-
-def get_document_chunks(
+def get_chunking_executor() -> ProcessPoolExecutor:
+    """
+    Return the process pool used to chunk large batches of documents, creating it on first use.
+    """
+    global _chunking_executor
+    if _chunking_executor is None:
+        _chunking_executor = ProcessPoolExecutor(max_workers=CHUNKING_MAX_WORKERS)
+    return _chunking_executor
+
+
+async def create_documents_chunks(
+    documents: List[Document], chunk_token_size: Optional[int]
+) -> List[Tuple[List[DocumentChunk], str]]:
+    """
+    Create the chunks of each document, in a process pool when the documents are large enough to make it worthwhile.
+
+    Args:
+        documents: The list of documents to create chunks from.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+
+    Returns:
+        A list of (doc_chunks, doc_id) tuples as returned by create_document_chunks, in the same order as documents.
+    """
+    total_chars = sum(len(doc.text) for doc in documents)
+    if (
+        CHUNKING_MAX_WORKERS <= 1
+        or len(documents) < 2
+        or total_chars < CHUNKING_PARALLEL_MIN_CHARS
+    ):
+        return [create_document_chunks(doc, chunk_token_size) for doc in documents]
+
+    # Tokenizing pins a core, so spread the documents over the process pool.
+    # gather keeps the results in the order of the documents.
+    loop = asyncio.get_running_loop()
+    executor = get_chunking_executor()
+    return await asyncio.gather(
+        *[
+            loop.run_in_executor(executor, create_document_chunks, doc, chunk_token_size)
+            for doc in documents
+        ]
+    )
+
+
+async def embed_document_chunks(chunks: List[DocumentChunk]) -> None:
+    """
+    Set the embedding of each chunk, embedding only the chunks that are not cached, in concurrent batches.
+
+    Args:
+        chunks: The list of document chunks to embed.
+    """
+    if not chunks:
+        return
+
+    embeddings: List[List[float]] = await get_embedding_cache().get_or_embed(
+        [chunk.text for chunk in chunks],
+        lambda texts: aget_embeddings_batched(texts, EMBEDDINGS_BATCH_SIZE),
+    )
+
+    # Update the document chunk objects with the embeddings
+    for chunk, embedding in zip(chunks, embeddings):
+        chunk.embedding = embedding
+
+
+def get_chunk_content_hash(chunk: DocumentChunk) -> str:
+    """
+    Return a hash of the text and metadata of a chunk, which changes whenever the stored chunk would.
+    """
+    digest = hashlib.sha256()
+    digest.update(chunk.text.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(chunk.metadata.json(sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+async def get_document_chunks(
     documents: List[Document], chunk_token_size: Optional[int]
 ) -> Dict[str, List[DocumentChunk]]:
     """
@@ -211,10 +256,10 @@ def get_document_chunks(
     # Initialize an empty list of all chunks
     all_chunks: List[DocumentChunk] = []
 
-    # Loop over each document and create chunks
-    for doc in documents:
-        doc_chunks, doc_id = create_document_chunks(doc, chunk_token_size)
-
+    # Loop over the chunks of each document
+    for doc_chunks, doc_id in await create_documents_chunks(
+        documents, chunk_token_size
+    ):
         # Append the chunks for this document to the list of all chunks
         all_chunks.extend(doc_chunks)
 
@@ -225,23 +270,6 @@ def get_document_chunks(
     if not all_chunks:
         return {}
 
-    # Get all the embeddings for the document chunks in batches, using get_embeddings
-    embeddings: List[List[float]] = []
-    for i in range(0, len(all_chunks), EMBEDDINGS_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_texts = [
-            chunk.text for chunk in all_chunks[i : i + EMBEDDINGS_BATCH_SIZE]
-        ]
-
-        # Get the embeddings for the batch texts
-        batch_embeddings = get_embeddings(batch_texts)
-
-        # Append the batch embeddings to the embeddings list
-        embeddings.extend(batch_embeddings)
-
-    # Update the document chunk objects with the embeddings
-    for i, chunk in enumerate(all_chunks):
-        # Assign the embedding from the embeddings list to the chunk object
-        chunk.embedding = embeddings[i]
+    await embed_document_chunks(all_chunks)
 
     return chunks
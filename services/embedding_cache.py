@@ -0,0 +1,416 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+from contextlib import closing
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from services.openai import get_embedding_model_id
+
+# Read environment variables for the embedding cache
+EMBEDDING_CACHE = os.environ.get("EMBEDDING_CACHE", "none")
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_REDIS_URL = os.environ.get(
+    "EMBEDDING_CACHE_REDIS_URL", "redis://localhost:6379"
+)
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", 0)) or None  # seconds
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+QUERY_EMBEDDING_CACHE_TTL = float(os.environ.get("QUERY_EMBEDDING_CACHE_TTL", 3600))  # seconds
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a text before hashing it, so that texts differing only in unicode form or whitespace share an entry.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_cache_key(text: str, model_id: Optional[str] = None) -> str:
+    """
+    Return the content address of the embedding of a text for a model.
+
+    Args:
+        text: The text that is embedded.
+        model_id: The model or deployment id used to embed the text, or None to use the configured one.
+
+    Returns:
+        A hex digest of the model id and the normalized text.
+    """
+    model_id = model_id or get_embedding_model_id()
+    digest = hashlib.sha256()
+    digest.update(model_id.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalize_text(text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _pack(embedding: List[float]) -> bytes:
+    return array("d", embedding).tobytes()
+
+
+def _unpack(data: bytes) -> List[float]:
+    embedding = array("d")
+    embedding.frombytes(data)
+    return embedding.tolist()
+
+
+class EmbeddingCache(ABC):
+    """
+    A content-addressed store of embeddings, keyed by embedding_cache_key.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    async def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        """
+        Return the cached embedding for each key, or None where there is no entry.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_many(self, entries: Dict[str, List[float]]) -> None:
+        """
+        Store embeddings by key.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Return the hit and miss counters of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def get_or_embed(
+        self,
+        texts: List[str],
+        embed: Callable[[List[str]], Awaitable[List[List[float]]]],
+    ) -> List[List[float]]:
+        """
+        Return the embeddings of texts, only calling embed for texts that are not cached.
+
+        Args:
+            texts: The list of texts to embed.
+            embed: A coroutine function that embeds a list of texts, in order.
+
+        Returns:
+            A list of embeddings, in the same order as texts.
+        """
+        keys = [embedding_cache_key(text) for text in texts]
+        embeddings = await self.get_many(keys)
+
+        # Embed each missing text once, even if it appears several times
+        missing: Dict[str, str] = {}
+        for key, text, embedding in zip(keys, texts, embeddings):
+            if embedding is None:
+                missing.setdefault(key, text)
+
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+
+        if missing:
+            new_embeddings = await embed(list(missing.values()))
+            entries = dict(zip(missing.keys(), new_embeddings))
+            await self.set_many(entries)
+            embeddings = [
+                embedding if embedding is not None else entries[key]
+                for key, embedding in zip(keys, embeddings)
+            ]
+
+        logger.debug(f"Embedding cache stats: {self.stats()}")
+        return embeddings  # type: ignore
+
+
+class InMemoryEmbeddingCache(EmbeddingCache):
+    """
+    A least recently used cache of embeddings held in process memory.
+    """
+
+    def __init__(self, max_size: int = EMBEDDING_CACHE_SIZE):
+        super().__init__()
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, array]" = OrderedDict()
+
+    async def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        embeddings: List[Optional[List[float]]] = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                embeddings.append(None)
+            else:
+                self._entries.move_to_end(key)
+                embeddings.append(entry.tolist())
+        return embeddings
+
+    async def set_many(self, entries: Dict[str, List[float]]) -> None:
+        for key, embedding in entries.items():
+            # Packed doubles take a fraction of the memory of a list of floats
+            self._entries[key] = array("d", embedding)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class SqliteEmbeddingCache(EmbeddingCache):
+    """
+    An on-disk cache of embeddings in a sqlite database, shared across restarts and processes.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        super().__init__()
+        self.path = path
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        found: Dict[str, bytes] = {}
+        with closing(self._connect()) as connection, connection:
+            # Stay well below sqlite's limit on the number of bound parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                rows = connection.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+                found.update(rows)
+        return [_unpack(found[key]) if key in found else None for key in keys]
+
+    def _set_many(self, entries: Dict[str, List[float]]) -> None:
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                [(key, _pack(embedding)) for key, embedding in entries.items()],
+            )
+
+    async def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        return await asyncio.to_thread(self._get_many, keys)
+
+    async def set_many(self, entries: Dict[str, List[float]]) -> None:
+        await asyncio.to_thread(self._set_many, entries)
+
+
+class RedisEmbeddingCache(EmbeddingCache):
+    """
+    A cache of embeddings in Redis, shared by every server that points at it.
+    """
+
+    KEY_PREFIX = "embedding"
+
+    def __init__(
+        self,
+        url: str = EMBEDDING_CACHE_REDIS_URL,
+        ttl: Optional[int] = EMBEDDING_CACHE_TTL,
+    ):
+        import redis.asyncio as redis
+
+        super().__init__()
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    async def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        if not keys:
+            return []
+        values = await self.client.mget([f"{self.KEY_PREFIX}:{key}" for key in keys])
+        return [_unpack(value) if value is not None else None for value in values]
+
+    async def set_many(self, entries: Dict[str, List[float]]) -> None:
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key, embedding in entries.items():
+                pipe.set(f"{self.KEY_PREFIX}:{key}", _pack(embedding), ex=self.ttl)
+            await pipe.execute()
+
+
+class NoEmbeddingCache(EmbeddingCache):
+    """
+    A cache that stores nothing, so every text is embedded.
+    """
+
+    async def get_many(self, keys: List[str]) -> List[Optional[List[float]]]:
+        return [None] * len(keys)
+
+    async def set_many(self, entries: Dict[str, List[float]]) -> None:
+        pass
+
+
+class QueryEmbeddingCache:
+    """
+    A least recently used cache of query embeddings whose entries expire after a TTL.
+
+    Concurrent misses for the same query share a single embedding call.
+    """
+
+    def __init__(
+        self,
+        max_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+        ttl: float = QUERY_EMBEDDING_CACHE_TTL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, List[float]]]" = OrderedDict()
+        self._in_flight: Dict[str, "asyncio.Future[List[float]]"] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.embed_seconds = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Return the hit ratio of the cache and an estimate of the embedding latency it saved.
+
+        Queries that waited on an in-flight embedding call are counted as coalesced, not as hits.
+        """
+        lookups = self.hits + self.misses + self.coalesced
+        average_miss_seconds = self.embed_seconds / self.misses if self.misses else 0.0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "saved_seconds": (self.hits + self.coalesced) * average_miss_seconds,
+        }
+
+    def _get(self, key: str) -> Optional[List[float]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, embedding = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return embedding
+
+    def _set(self, key: str, embedding: List[float]) -> None:
+        self._entries[key] = (self._clock() + self.ttl, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_or_embed(
+        self,
+        texts: List[str],
+        embed: Callable[[List[str]], Awaitable[List[List[float]]]],
+    ) -> List[List[float]]:
+        """
+        Return the embeddings of query texts, only calling embed for queries that are neither cached nor in flight.
+
+        Args:
+            texts: The list of query texts to embed.
+            embed: A coroutine function that embeds a list of texts, in order.
+
+        Returns:
+            A list of embeddings, in the same order as texts.
+        """
+        if self.max_size <= 0:
+            return await embed(texts)
+
+        keys = [embedding_cache_key(text) for text in texts]
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        waiting: Dict[int, "asyncio.Future[List[float]]"] = {}
+        missing: Dict[str, str] = {}
+
+        for i, (key, text) in enumerate(zip(keys, texts)):
+            embedding = self._get(key)
+            if embedding is not None:
+                self.hits += 1
+                embeddings[i] = embedding
+            elif key in self._in_flight:
+                self.coalesced += 1
+                waiting[i] = self._in_flight[key]
+            else:
+                if key not in missing:
+                    self.misses += 1
+                    missing[key] = text
+                    self._in_flight[key] = asyncio.get_running_loop().create_future()
+                else:
+                    self.coalesced += 1
+                waiting[i] = self._in_flight[key]
+
+        if missing:
+            futures = {key: self._in_flight[key] for key in missing}
+            start = time.perf_counter()
+            try:
+                new_embeddings = await embed(list(missing.values()))
+            except BaseException as e:
+                for future in futures.values():
+                    future.set_exception(e)
+                    # Mark the exception as retrieved, it is raised from here
+                    future.exception()
+                raise
+            else:
+                self.embed_seconds += time.perf_counter() - start
+                for (key, future), embedding in zip(futures.items(), new_embeddings):
+                    self._set(key, embedding)
+                    future.set_result(embedding)
+            finally:
+                for key in missing:
+                    self._in_flight.pop(key, None)
+
+        for i, future in waiting.items():
+            embeddings[i] = await future
+
+        logger.debug(f"Query embedding cache stats: {self.stats()}")
+        return embeddings  # type: ignore
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    Return the embedding cache configured by EMBEDDING_CACHE, creating it on first use.
+    """
+    global _embedding_cache
+    if _embedding_cache is not None:
+        return _embedding_cache
+
+    match EMBEDDING_CACHE:
+        case "none":
+            _embedding_cache = NoEmbeddingCache()
+        case "memory":
+            _embedding_cache = InMemoryEmbeddingCache()
+        case "sqlite":
+            _embedding_cache = SqliteEmbeddingCache()
+        case "redis":
+            _embedding_cache = RedisEmbeddingCache()
+        case _:
+            raise ValueError(
+                f"Unsupported embedding cache: {EMBEDDING_CACHE}. "
+                f"Try one of the following: none, memory, sqlite, or redis"
+            )
+    return _embedding_cache
+
+
+_query_embedding_cache: Optional[QueryEmbeddingCache] = None
+
+
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    """
+    Return the query embedding cache configured by QUERY_EMBEDDING_CACHE_SIZE and QUERY_EMBEDDING_CACHE_TTL.
+    """
+    global _query_embedding_cache
+    if _query_embedding_cache is None:
+        _query_embedding_cache = QueryEmbeddingCache()
+    return _query_embedding_cache
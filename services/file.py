@@ -1,5 +1,7 @@
+import asyncio
 import os
-from io import BufferedReader
+from concurrent.futures import ProcessPoolExecutor
+from io import BufferedReader, BytesIO
 from typing import Optional
 from fastapi import UploadFile
 import mimetypes
@@ -11,6 +13,15 @@ from loguru import logger
 
 from models.models import Document, DocumentMetadata
 
+FILE_MAX_SIZE = int(os.environ.get("FILE_MAX_SIZE", 50 * 1024 * 1024))  # The maximum size of an uploaded file, in bytes
+FILE_EXTRACTION_MAX_WORKERS = int(os.environ.get("FILE_EXTRACTION_MAX_WORKERS", os.cpu_count() or 1))  # The number of processes to extract the text of uploaded files in
+
+_extraction_executor: Optional[ProcessPoolExecutor] = None
+
+
+class FileTooLargeError(ValueError):
+    pass
+
 
 async def get_document_from_file(
     file: UploadFile, metadata: DocumentMetadata
@@ -22,18 +33,23 @@ async def get_document_from_file(
     return doc
 
 
+def get_mimetype(filepath: str) -> Optional[str]:
+    """Return the mimetype of a file based on its extension, or None if it is unknown."""
+    mimetype, _ = mimetypes.guess_type(filepath)
+    if not mimetype and filepath.endswith(".md"):
+        mimetype = "text/markdown"
+    return mimetype
+
+
 def extract_text_from_filepath(filepath: str, mimetype: Optional[str] = None) -> str:
     """Return the text content of a file given its filepath."""
 
     if mimetype is None:
         # Get the mimetype of the file based on its extension
-        mimetype, _ = mimetypes.guess_type(filepath)
+        mimetype = get_mimetype(filepath)
 
     if not mimetype:
-        if filepath.endswith(".md"):
-            mimetype = "text/markdown"
-        else:
-            raise Exception("Unsupported file type")
+        raise Exception("Unsupported file type")
 
     try:
         with open(filepath, "rb") as file:
@@ -87,31 +103,52 @@ def extract_text_from_file(file: BufferedReader, mimetype: str) -> str:
     return extracted_text
 
 
+def extract_text_from_bytes(content: bytes, mimetype: str) -> str:
+    """Return the text content of a file given its content."""
+    return extract_text_from_file(BytesIO(content), mimetype)  # type: ignore
+
+
+def get_extraction_executor() -> ProcessPoolExecutor:
+    """
+    Return the process pool used to extract the text of uploaded files, creating it on first use.
+    """
+    global _extraction_executor
+    if _extraction_executor is None:
+        _extraction_executor = ProcessPoolExecutor(
+            max_workers=FILE_EXTRACTION_MAX_WORKERS
+        )
+    return _extraction_executor
+
+
 # Extract text from a file based on its mimetype
 async def extract_text_from_form_file(file: UploadFile):
     """Return the text content of a file."""
     # get the file body from the upload file object
-    mimetype = file.content_type
+    mimetype = file.content_type or get_mimetype(file.filename or "")
     logger.info(f"mimetype: {mimetype}")
-    logger.info(f"file.file: {file.file}")
-    logger.info("file: ", file)
 
-    file_stream = await file.read()
+    if not mimetype:
+        raise Exception("Unsupported file type")
 
-    temp_file_path = "/tmp/temp_file"
+    # the upload is already buffered in a spooled temporary file of its own,
+    # so check its size before reading it into memory
+    size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(0)
+    if size > FILE_MAX_SIZE:
+        raise FileTooLargeError(
+            f"File is {size} bytes, the maximum size is {FILE_MAX_SIZE} bytes"
+        )
 
-    # write the file to a temporary location
-    with open(temp_file_path, "wb") as f:
-        f.write(file_stream)
+    file_stream = await file.read()
 
+    # parse the file in another process, as parsing pdf, docx and pptx files is cpu bound
+    # and would otherwise block the event loop, and the queries with it
     try:
-        extracted_text = extract_text_from_filepath(temp_file_path, mimetype)
+        extracted_text = await asyncio.get_running_loop().run_in_executor(
+            get_extraction_executor(), extract_text_from_bytes, file_stream, mimetype
+        )
     except Exception as e:
         logger.error(e)
-        os.remove(temp_file_path)
         raise e
 
-    # remove file from temp location
-    os.remove(temp_file_path)
-
     return extracted_text
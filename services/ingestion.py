@@ -0,0 +1,531 @@
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from loguru import logger
+from tenacity import AsyncRetrying, stop_after_attempt, wait_random_exponential
+
+from datastore.datastore import DataStore
+from models.models import (
+    Document,
+    DocumentChunk,
+    DocumentMetadata,
+)
+from services.chunks import create_documents_chunks, embed_document_chunks
+from services.extract_metadata import extract_metadata_from_document
+from services.pii_detection import screen_text_for_pii
+
+QUEUE_SIZE = 100  # The maximum number of items waiting between two stages
+PROGRESS_INTERVAL = 10  # The number of seconds between two progress reports
+BATCH_MAX_ATTEMPTS = 3  # The number of times a batch is chunked, embedded or upserted before it is given up
+# The wait between two attempts of a batch
+BATCH_RETRY_WAIT = wait_random_exponential(min=1, max=20)
+
+# A sentinel put on a queue once all the items before it were produced
+_END = object()
+
+
+class IngestionStats:
+    """
+    Counts the items each stage of a pipeline has processed, to report progress and throughput.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.processed: Dict[str, int] = defaultdict(int)
+        self.dropped: Dict[str, int] = defaultdict(int)
+        self.units: Dict[str, int] = defaultdict(int)
+
+    def record(self, stage: str, dropped: bool = False) -> None:
+        self.processed[stage] += 1
+        if dropped:
+            self.dropped[stage] += 1
+
+    def count(self, unit: str, n: int = 1) -> None:
+        """
+        Count n units of work, such as documents or chunks, that are not items of a stage.
+        """
+        self.units[unit] += n
+
+    def report(self) -> str:
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        parts = [
+            f"{stage}: {count} ({count / elapsed:.1f}/s"
+            + (f", {self.dropped[stage]} dropped)" if self.dropped[stage] else ")")
+            for stage, count in self.processed.items()
+        ]
+        parts += [
+            f"{unit}: {count} ({count / elapsed:.1f}/s)"
+            for unit, count in self.units.items()
+        ]
+        return f"[{elapsed:.0f}s] " + ", ".join(parts)
+
+
+class Checkpoint:
+    """
+    Records which items of a source were processed, so that an interrupted ingestion can resume where it stopped.
+
+    The state file is an append-only JSONL file with one line per committed batch, holding the offsets of
+    the items in the batch, the ids of the documents upserted, and the offset below which every item was
+    processed. Items that were dropped, for instance because PII was detected, count as processed too.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        # Every offset below the watermark was processed, done holds the processed offsets above it
+        self.watermark = 0
+        self.done: Set[int] = set()
+        self._skipped: List[int] = []
+
+        if resume and os.path.exists(path):
+            with open(path) as state_file:
+                for line in state_file:
+                    try:
+                        state = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line can be cut short by a crash, its batch is processed again
+                        continue
+                    self.done.update(state["offsets"])
+                    self._advance(max(self.watermark, state["offset"]))
+            logger.info(
+                f"Resuming from {path}, {self.watermark + len(self.done)} items were already processed"
+            )
+        self.resumed = self.watermark + len(self.done)
+        self._file = open(path, "a" if resume else "w")
+
+    def _advance(self, watermark: int) -> None:
+        while watermark in self.done:
+            watermark += 1
+        if watermark != self.watermark:
+            self.watermark = watermark
+            self.done = {offset for offset in self.done if offset >= watermark}
+
+    def is_done(self, offset: int) -> bool:
+        return offset < self.watermark or offset in self.done
+
+    def skip(self, offsets: List[int]) -> None:
+        """
+        Mark dropped items as processed. They are written to the state file with the next committed batch.
+        """
+        self._skipped.extend(offsets)
+
+    def commit(self, offsets: List[int], document_ids: List[str]) -> None:
+        """
+        Mark the items of a batch as processed once its documents were upserted, and write it to the state file.
+        """
+        offsets = self._skipped + offsets
+        self._skipped = []
+        self.done.update(offsets)
+        self._advance(self.watermark)
+        self._file.write(
+            json.dumps(
+                {
+                    "offset": self.watermark,
+                    "offsets": offsets,
+                    "document_ids": document_ids,
+                }
+            )
+            + "\n"
+        )
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        if self._skipped:
+            self.commit([], [])
+        self._file.close()
+
+
+class DeadLetterQueue:
+    """
+    Writes the items that were skipped or failed to a JSONL file, with the reason why, so they can be inspected and retried.
+    """
+
+    def __init__(self, path: str, append: bool = False):
+        self.path = path
+        self.count = 0
+        self._file = open(path, "a" if append else "w")
+
+    def put(self, item: Any, reason: str) -> None:
+        logger.info(f"Skipping item: {reason}")
+        self._file.write(json.dumps({"reason": reason, "item": item}, default=str) + "\n")
+        self._file.flush()
+        self.count += 1
+
+    def close(self) -> None:
+        self._file.close()
+        logger.info(f"Skipped {self.count} items, see {self.path}")
+
+
+class KeyedLocks:
+    """
+    A lock per key, such as a document id, held by one holder at a time. The lock of a key only exists while it is
+    held or waited for.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._holders: Dict[str, int] = defaultdict(int)
+
+    @asynccontextmanager
+    async def hold(self, keys: Iterable[str]) -> AsyncIterator[None]:
+        """
+        Hold the locks of all the keys, taken in sorted order so that two holders never wait for each other.
+        """
+        keys = sorted(set(keys))
+        for key in keys:
+            self._holders[key] += 1
+        try:
+            async with AsyncExitStack() as stack:
+                for key in keys:
+                    await stack.enter_async_context(
+                        self._locks.setdefault(key, asyncio.Lock())
+                    )
+                yield
+        finally:
+            for key in keys:
+                self._holders[key] -= 1
+                if not self._holders[key]:
+                    del self._holders[key]
+                    self._locks.pop(key, None)
+
+
+class Stage:
+    """
+    A step of a pipeline, run by concurrency workers that each take items from the stage's queue.
+
+    fn returns the item to pass on to the next stage, or None to drop the item.
+    A stage with a batch_size instead groups the items it receives into lists of up to batch_size items.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Optional[Callable[[Any], Awaitable[Any]]] = None,
+        concurrency: int = 1,
+        batch_size: Optional[int] = None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.concurrency = 1 if batch_size else max(1, concurrency)
+        self.batch_size = batch_size
+
+
+class Pipeline:
+    """
+    A chain of stages connected by bounded queues, so that all the stages run at once
+    while only a bounded number of items is held in memory.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = QUEUE_SIZE,
+        progress_interval: float = PROGRESS_INTERVAL,
+    ):
+        self.queue_size = queue_size
+        self.progress_interval = progress_interval
+        self.stages: List[Stage] = []
+        self.stats = IngestionStats()
+        self.checkpoint: Optional[Checkpoint] = None
+
+    def add_stage(
+        self,
+        name: str,
+        fn: Callable[[Any], Awaitable[Any]],
+        concurrency: int = 1,
+    ) -> "Pipeline":
+        self.stages.append(Stage(name, fn, concurrency))
+        return self
+
+    def add_batch_stage(self, name: str, batch_size: int) -> "Pipeline":
+        self.stages.append(Stage(name, batch_size=batch_size))
+        return self
+
+    async def _feed(self, source: AsyncIterable[Any], outbox: asyncio.Queue, workers: int):
+        # Items travel through the stages along with the offsets of the source items they come from
+        offset = 0
+        async for item in source:
+            if self.checkpoint is not None and self.checkpoint.is_done(offset):
+                self.stats.count("resumed")
+            else:
+                self.stats.record("read")
+                await outbox.put(([offset], item))
+            offset += 1
+        for _ in range(workers):
+            await outbox.put(_END)
+
+    async def _work(
+        self,
+        stage: Stage,
+        inbox: asyncio.Queue,
+        outbox: Optional[asyncio.Queue],
+        downstream_workers: int,
+        running: List[int],
+    ):
+        batch: List[Any] = []
+        batch_offsets: List[int] = []
+        while True:
+            entry = await inbox.get()
+            if entry is _END:
+                break
+            offsets, item = entry
+            if stage.batch_size:
+                batch.append(item)
+                batch_offsets += offsets
+                if len(batch) < stage.batch_size:
+                    continue
+                result, batch = batch, []
+                offsets, batch_offsets = batch_offsets, []
+            else:
+                result = await stage.fn(item)  # type: ignore
+            self.stats.record(stage.name, dropped=result is None)
+            await self._pass_on(offsets, result, outbox)
+
+        if batch:
+            self.stats.record(stage.name)
+            await self._pass_on(batch_offsets, batch, outbox)
+
+        # The last worker of a stage to finish tells the next stage it is done
+        running[0] -= 1
+        if running[0] == 0 and outbox is not None:
+            for _ in range(downstream_workers):
+                await outbox.put(_END)
+
+    async def _pass_on(
+        self, offsets: List[int], result: Any, outbox: Optional[asyncio.Queue]
+    ):
+        if outbox is not None:
+            if result is not None:
+                await outbox.put((offsets, result))
+            elif self.checkpoint is not None:
+                self.checkpoint.skip(offsets)
+        elif self.checkpoint is not None:
+            # The result of the last stage of a checkpointed pipeline are the ids of the documents it upserted
+            if result is None:
+                self.checkpoint.skip(offsets)
+            else:
+                self.checkpoint.commit(offsets, result)
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            logger.info(self.stats.report())
+
+    async def run(
+        self, source: AsyncIterable[Any], checkpoint: Optional[Checkpoint] = None
+    ) -> IngestionStats:
+        """
+        Feed the items of source through every stage, and return the stats once all of them went through.
+
+        With a checkpoint, the items it records as processed are skipped, and the items that go through
+        the last stage or are dropped are recorded in it.
+        """
+        self.checkpoint = checkpoint
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        tasks = [
+            asyncio.create_task(
+                self._feed(source, queues[0], self.stages[0].concurrency)
+            )
+        ]
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i + 1] if i + 1 < len(self.stages) else None
+            downstream_workers = (
+                self.stages[i + 1].concurrency if i + 1 < len(self.stages) else 0
+            )
+            running = [stage.concurrency]
+            tasks += [
+                asyncio.create_task(
+                    self._work(stage, queues[i], outbox, downstream_workers, running)
+                )
+                for _ in range(stage.concurrency)
+            ]
+
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION
+            )
+            for task in pending:
+                task.cancel()
+            # Raise the first error of a stage, if any
+            for task in done:
+                task.result()
+        finally:
+            reporter.cancel()
+            if checkpoint is not None:
+                checkpoint.close()
+
+        logger.info(f"Done. {self.stats.report()}")
+        return self.stats
+
+
+def add_upsert_stages(
+    pipeline: Pipeline,
+    datastore: DataStore,
+    batch_size: int,
+    embed_concurrency: int = 2,
+    upsert_concurrency: int = 2,
+    chunk_token_size: Optional[int] = None,
+    dead_letters: Optional[DeadLetterQueue] = None,
+    max_attempts: int = BATCH_MAX_ATTEMPTS,
+) -> Pipeline:
+    """
+    Add the stages that batch, chunk, embed and upsert the documents coming out of a pipeline.
+    The last stage outputs the ids of the documents upserted, which a checkpoint records.
+    A datastore that upserts incrementally embeds the new or changed chunks itself, so there is no embed stage then.
+
+    A batch that fails is tried again, up to max_attempts times in all. If it still fails, its documents are put on
+    the dead letter queue and the batch is dropped, so that the checkpoint records it and the other batches go on.
+    Without a dead letter queue, the error stops the pipeline instead.
+
+    Args:
+        pipeline: The pipeline to add the stages to. Its last stage must output Document objects.
+        datastore: The datastore to upsert the documents into.
+        batch_size: The number of documents to chunk, embed and upsert at once.
+        embed_concurrency: The number of batches to embed at once.
+        upsert_concurrency: The number of batches to upsert at once.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+        dead_letters: The queue to put the documents of the batches that failed on.
+        max_attempts: The number of times a batch is tried in each stage.
+
+    Returns:
+        The pipeline.
+    """
+    Batch = Tuple[List[Document], Dict[str, List[DocumentChunk]]]
+
+    def retried(
+        name: str,
+        fn: Callable[[Any], Awaitable[Any]],
+        batch_documents: Callable[[Any], List[Document]],
+    ) -> Callable[[Any], Awaitable[Any]]:
+        async def run(batch: Any) -> Any:
+            try:
+                async for attempt in AsyncRetrying(
+                    stop=stop_after_attempt(max_attempts),
+                    wait=BATCH_RETRY_WAIT,
+                    reraise=True,
+                ):
+                    with attempt:
+                        return await fn(batch)
+            except Exception as e:
+                if dead_letters is None:
+                    raise
+                documents = batch_documents(batch)
+                logger.error(f"Error in {name} of a batch of {len(documents)} documents: {e}")
+                for document in documents:
+                    dead_letters.put(
+                        document.dict(), f"Error in {name} after {max_attempts} attempts: {e}"
+                    )
+                return None
+
+        return run
+
+    async def chunk(documents: List[Document]) -> Batch:
+        chunks: Dict[str, List[DocumentChunk]] = {}
+        for doc_chunks, doc_id in await create_documents_chunks(
+            documents, chunk_token_size
+        ):
+            chunks[doc_id] = doc_chunks
+        pipeline.stats.count("chunks", sum(len(v) for v in chunks.values()))
+        return documents, chunks
+
+    async def embed(batch: Batch) -> Batch:
+        documents, chunks = batch
+        await embed_document_chunks(
+            [chunk for doc_chunks in chunks.values() for chunk in doc_chunks]
+        )
+        return batch
+
+    document_locks = KeyedLocks()
+
+    async def upsert(batch: Batch) -> List[str]:
+        documents, chunks = batch
+        logger.info(f"Upserting batch of {len(documents)} documents")
+        # Batches upserted at once that hold the same document would interleave their deletes and inserts
+        async with document_locks.hold(chunks.keys()):
+            doc_ids = await datastore.upsert_chunks(documents, chunks) if chunks else []
+        pipeline.stats.count("documents", len(documents))
+        return doc_ids
+
+    pipeline.add_batch_stage("batch", batch_size).add_stage(
+        "chunk", retried("chunk", chunk, lambda documents: documents)
+    )
+    if not datastore.upserts_incrementally:
+        pipeline.add_stage(
+            "embed", retried("embed", embed, lambda batch: batch[0]), embed_concurrency
+        )
+    return pipeline.add_stage(
+        "upsert", retried("upsert", upsert, lambda batch: batch[0]), upsert_concurrency
+    )
+
+
+def add_language_model_stages(
+    pipeline: Pipeline,
+    screen_for_pii: bool,
+    extract_metadata: bool,
+    concurrency: int,
+    dead_letters: DeadLetterQueue,
+) -> Pipeline:
+    """
+    Add the stages that screen the documents coming out of a pipeline for PII and extract their metadata
+    using a language model, if requested. Documents with PII, or that fail, are put on the dead letter queue.
+
+    Args:
+        pipeline: The pipeline to add the stages to. Its last stage must output Document objects.
+        screen_for_pii: Whether to skip the documents that contain PII.
+        extract_metadata: Whether to replace the metadata of the documents by the metadata extracted from their text.
+        concurrency: The number of documents to send to the language model at once, in each stage.
+        dead_letters: The queue to put the skipped documents on.
+
+    Returns:
+        The pipeline.
+    """
+
+    async def screen(document: Document) -> Optional[Document]:
+        try:
+            # the language model client is blocking, so call it in a thread
+            pii_detected = await asyncio.to_thread(screen_text_for_pii, document.text)
+        except Exception as e:
+            dead_letters.put(document.dict(), f"Error screening for PII: {e}")
+            return None
+        # if pii detected, skip the document
+        if pii_detected:
+            dead_letters.put(document.dict(), "PII detected in document")
+            return None
+        return document
+
+    async def extract(document: Document) -> Optional[Document]:
+        try:
+            # extract metadata from the document text
+            extracted_metadata = await asyncio.to_thread(
+                extract_metadata_from_document,
+                f"Text: {document.text}; Metadata: {str(document.metadata)}",
+            )
+            # get a Metadata object from the extracted metadata
+            document.metadata = DocumentMetadata(**extracted_metadata)
+        except Exception as e:
+            dead_letters.put(document.dict(), f"Error extracting metadata: {e}")
+            return None
+        return document
+
+    if screen_for_pii:
+        pipeline.add_stage("screen_for_pii", screen, concurrency)
+    if extract_metadata:
+        pipeline.add_stage("extract_metadata", extract, concurrency)
+    return pipeline
@@ -1,10 +1,23 @@
 from typing import List
+import asyncio
 import openai
 import os
 from loguru import logger
 
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 
+# The maximum number of embedding requests to have in flight at once
+EMBEDDINGS_MAX_CONCURRENCY = int(os.environ.get("OPENAI_EMBEDDING_CONCURRENCY", 4))
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+def get_embedding_model_id() -> str:
+    """
+    Return the id of the model (or Azure deployment) used to embed texts.
+    """
+    # NOTE: Azure Open AI requires deployment id
+    return os.environ.get("OPENAI_EMBEDDINGMODEL_DEPLOYMENTID") or EMBEDDING_MODEL
+
 
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
 def get_embeddings(texts: List[str]) -> List[List[float]]:
@@ -26,7 +39,7 @@ def get_embeddings(texts: List[str]) -> List[List[float]]:
 
     response = {}
     if deployment == None:
-        response = openai.Embedding.create(input=texts, model="text-embedding-ada-002")
+        response = openai.Embedding.create(input=texts, model=EMBEDDING_MODEL)
     else:
         response = openai.Embedding.create(input=texts, deployment_id=deployment)
 
@@ -37,6 +50,74 @@ def get_embeddings(texts: List[str]) -> List[List[float]]:
     return [result["embedding"] for result in data]
 
 
+@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
+async def aget_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    Embed texts using OpenAI's ada model without blocking the event loop.
+
+    Args:
+        texts: The list of texts to embed.
+
+    Returns:
+        A list of embeddings, each of which is a list of floats, in the same order as texts.
+
+    Raises:
+        Exception: If the OpenAI API call still fails after retrying.
+    """
+    # NOTE: Azure Open AI requires deployment id
+    deployment = os.environ.get("OPENAI_EMBEDDINGMODEL_DEPLOYMENTID")
+
+    response = {}
+    if deployment == None:
+        response = await openai.Embedding.acreate(
+            input=texts, model=EMBEDDING_MODEL
+        )
+    else:
+        response = await openai.Embedding.acreate(
+            input=texts, deployment_id=deployment
+        )
+
+    # Sort by index so the embeddings line up with the input texts
+    data = sorted(response["data"], key=lambda result: result["index"])  # type: ignore
+
+    return [result["embedding"] for result in data]
+
+
+async def aget_embeddings_batched(
+    texts: List[str],
+    batch_size: int,
+    max_concurrency: int = EMBEDDINGS_MAX_CONCURRENCY,
+) -> List[List[float]]:
+    """
+    Embed texts in batches, with up to max_concurrency batches in flight at once.
+
+    Each batch is retried on its own, so a transient failure does not restart the whole job.
+
+    Args:
+        texts: The list of texts to embed.
+        batch_size: The number of texts to send per request.
+        max_concurrency: The maximum number of requests to have in flight at once.
+
+    Returns:
+        A list of embeddings, each of which is a list of floats, in the same order as texts.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def embed_batch(batch_texts: List[str]) -> List[List[float]]:
+        async with semaphore:
+            return await aget_embeddings(batch_texts)
+
+    batches = await asyncio.gather(
+        *[
+            embed_batch(texts[i : i + batch_size])
+            for i in range(0, len(texts), batch_size)
+        ]
+    )
+    logger.info(f"Embedded {len(texts)} texts in {len(batches)} batches")
+
+    return [embedding for batch in batches for embedding in batch]
+
+
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
 def get_chat_completion(
     messages,
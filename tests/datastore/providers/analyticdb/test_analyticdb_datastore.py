@@ -6,8 +6,10 @@ from models.models import (
     QueryWithEmbedding,
     Source,
 )
+from datastore.providers import analyticdb_datastore as analyticdb_datastore_module
 from datastore.providers.analyticdb_datastore import (
     OUTPUT_DIM,
+    PG_CONFIG,
     AnalyticDBDataStore,
 )
 
@@ -321,3 +323,30 @@ async def test_delete_with_document_id(analyticdb_datastore, document_chunk_one)
 #     import sys
 #     import pytest
 #     pytest.main(sys.argv)
+
+
+@pytest.mark.asyncio
+async def test_upsert_batches_query_more_queries_than_connections(
+    document_chunk_two, monkeypatch
+):
+    monkeypatch.setattr(analyticdb_datastore_module, "UPSERT_BATCH_SIZE", 4)
+    datastore = AnalyticDBDataStore(PG_CONFIG, pool_size=2)
+    await datastore.delete(delete_all=True)
+    res = await datastore._upsert(document_chunk_two)
+    assert res == list(document_chunk_two.keys())
+
+    ids = [chunk.id for chunks in document_chunk_two.values() for chunk in chunks]
+    queries = [
+        QueryWithEmbedding(
+            query=f"Query {i}",
+            embedding=[i] * OUTPUT_DIM,
+            top_k=1,
+        )
+        for i in range(6)
+    ]
+    query_results = await datastore._query(queries)
+    assert [query.query for query in queries] == [
+        result.query for result in query_results
+    ]
+    for i, result in enumerate(query_results):
+        assert [ids[i]] == [chunk.id for chunk in result.results]
@@ -291,3 +291,27 @@ async def test_delete_by_id(document_chunks):
                 for result in query_results[0].results
             ]
         )
+
+
+@pytest.mark.asyncio
+async def test_chunk_hashes_and_delete_chunks(document_chunks):
+    for datastore in get_chroma_datastore():
+        await datastore.delete(delete_all=True)
+
+        for i, chunk in enumerate(document_chunks["first-doc"]):
+            chunk.content_hash = f"hash-{i}"
+        await datastore._upsert(document_chunks)
+
+        hashes = await datastore._get_chunk_hashes(["first-doc", "second-doc"])
+        assert hashes["first-doc"] == {
+            f"first-doc-{i}": f"hash-{i}" for i in range(N_TEST_CHUNKS)
+        }
+        assert hashes["second-doc"] == {
+            f"second-doc-{i}": None for i in range(N_TEST_CHUNKS)
+        }
+
+        await datastore._delete_chunks({"first-doc": ["first-doc-0", "first-doc-1"]})
+        hashes = await datastore._get_chunk_hashes(["first-doc"])
+        assert sorted(hashes["first-doc"]) == [
+            f"first-doc-{i}" for i in range(2, N_TEST_CHUNKS)
+        ]
@@ -0,0 +1,308 @@
+from typing import Dict, List
+
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import services.chunks
+from datastore.providers import local_datastore
+from datastore.providers.local_datastore import LocalDataStore
+from models.models import (
+    Document,
+    DocumentChunk,
+    DocumentChunkMetadata,
+    DocumentMetadataFilter,
+    QueryWithEmbedding,
+    Source,
+)
+
+DIM = 8
+
+
+def embedding(i: int) -> List[float]:
+    return np.random.default_rng(i).normal(size=DIM).tolist()
+
+
+@pytest.fixture
+def document_chunks() -> Dict[str, List[DocumentChunk]]:
+    return {
+        f"doc-{d}": [
+            DocumentChunk(
+                id=f"doc-{d}-{i}",
+                text=f"Chunk {i} of document {d}",
+                metadata=DocumentChunkMetadata(
+                    document_id=f"doc-{d}",
+                    source=Source.email if d % 2 else Source.file,
+                    source_id=f"source-{d}",
+                    author="alice" if d < 2 else "bob",
+                    created_at=f"2023-01-0{d + 1}",
+                    url=None,
+                ),
+                embedding=embedding(10 * d + i),
+            )
+            for i in range(3)
+        ]
+        for d in range(4)
+    }
+
+
+@pytest.fixture(params=["exact", "hnsw"])
+def datastore(request, monkeypatch) -> LocalDataStore:
+    # Search the graph even for the few chunks of the tests
+    monkeypatch.setattr(local_datastore, "HNSW_EXACT_MAX_ROWS", 0)
+    return LocalDataStore(
+        persistence_dir=None, initial_capacity=2, index=request.param
+    )
+
+
+def exact_top_k(chunks: Dict[str, List[DocumentChunk]], query: List[float], k: int):
+    flat = [chunk for doc_chunks in chunks.values() for chunk in doc_chunks]
+    q = np.array(query) / np.linalg.norm(query)
+    scores = [
+        float(q @ (np.array(c.embedding) / np.linalg.norm(c.embedding))) for c in flat
+    ]
+    return [flat[i].id for i in np.argsort(scores)[::-1][:k]]
+
+
+@pytest.mark.asyncio
+async def test_query_returns_exact_top_k_for_every_query(datastore, document_chunks):
+    await datastore._upsert(document_chunks)
+    queries = [
+        QueryWithEmbedding(query=f"q{i}", embedding=embedding(100 + i), top_k=k)
+        for i, k in enumerate([1, 4, 20])
+    ]
+
+    results = await datastore._query(queries)
+
+    for query, result in zip(queries, results):
+        assert result.query == query.query
+        assert [chunk.id for chunk in result.results] == exact_top_k(
+            document_chunks, query.embedding, query.top_k  # type: ignore
+        )
+    scores = [chunk.score for chunk in results[2].results]
+    assert scores == sorted(scores, reverse=True)
+    assert results[0].results[0].metadata.document_id is not None
+
+
+@pytest.mark.asyncio
+async def test_query_applies_filters(datastore, document_chunks):
+    await datastore._upsert(document_chunks)
+
+    async def ids(filter: DocumentMetadataFilter) -> List[str]:
+        query = QueryWithEmbedding(
+            query="q", embedding=embedding(0), filter=filter, top_k=20
+        )
+        (result,) = await datastore._query([query])
+        return sorted(chunk.id for chunk in result.results)
+
+    assert await ids(DocumentMetadataFilter(document_id="doc-1")) == [
+        "doc-1-0",
+        "doc-1-1",
+        "doc-1-2",
+    ]
+    assert len(await ids(DocumentMetadataFilter(source=Source.email))) == 6
+    assert len(await ids(DocumentMetadataFilter(author="bob", source_id="source-3"))) == 3
+    dated = await ids(
+        DocumentMetadataFilter(start_date="2023-01-02", end_date="2023-01-03")
+    )
+    assert dated == ["doc-1-0", "doc-1-1", "doc-1-2", "doc-2-0", "doc-2-1", "doc-2-2"]
+    assert await ids(DocumentMetadataFilter(author="nobody")) == []
+
+
+@pytest.mark.asyncio
+async def test_upsert_overwrites_chunks_with_the_same_id(datastore, document_chunks):
+    await datastore._upsert(document_chunks)
+    chunk = document_chunks["doc-0"][0].copy(update={"text": "updated"})
+    await datastore._upsert({"doc-0": [chunk]})
+
+    (result,) = await datastore._query(
+        [QueryWithEmbedding(query="q", embedding=chunk.embedding, top_k=1)]  # type: ignore
+    )
+
+    assert datastore._size == 12
+    assert result.results[0].id == chunk.id
+    assert result.results[0].text == "updated"
+    assert result.results[0].score == pytest.approx(1.0)
+
+
+@pytest.mark.asyncio
+async def test_delete(datastore, document_chunks):
+    await datastore._upsert(document_chunks)
+
+    await datastore.delete(ids=["doc-0"])
+    assert datastore._size == 9
+    await datastore.delete(filter=DocumentMetadataFilter(author="bob"))
+    assert sorted(datastore._rows) == ["doc-1-0", "doc-1-1", "doc-1-2"]
+    await datastore.delete(filter=DocumentMetadataFilter())
+    assert datastore._size == 3
+
+    (result,) = await datastore._query(
+        [QueryWithEmbedding(query="q", embedding=embedding(10), top_k=5)]
+    )
+    assert [chunk.id for chunk in result.results][0] == "doc-1-0"
+
+    await datastore.delete(delete_all=True)
+    (result,) = await datastore._query(
+        [QueryWithEmbedding(query="q", embedding=embedding(10), top_k=5)]
+    )
+    assert result.results == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_deleted_ratio", [0.3, 1.0])
+async def test_deleted_chunks_are_dropped_from_the_index(
+    document_chunks, monkeypatch, max_deleted_ratio
+):
+    monkeypatch.setattr(local_datastore, "HNSW_EXACT_MAX_ROWS", 0)
+    datastore = LocalDataStore(
+        persistence_dir=None,
+        index="hnsw",
+        hnsw_max_deleted_ratio=max_deleted_ratio,
+    )
+    await datastore._upsert(document_chunks)
+
+    await datastore.delete(ids=["doc-0", "doc-1"])
+    # Overwritten chunks leave deleted nodes too
+    await datastore._upsert({"doc-2": document_chunks["doc-2"]})
+
+    assert len(datastore._index) == 6  # type: ignore
+    assert datastore._index.deleted_count == (  # type: ignore
+        0 if max_deleted_ratio < 1 else 9
+    )
+    (result,) = await datastore._query(
+        [QueryWithEmbedding(query="q", embedding=embedding(21), top_k=6)]
+    )
+    assert [chunk.id for chunk in result.results][0] == "doc-2-1"
+    assert sorted(chunk.id for chunk in result.results) == sorted(
+        id_ for id_ in datastore._rows
+    )
+
+
+@pytest.mark.asyncio
+async def test_writes_and_searches_run_in_the_datastore_thread(
+    datastore, document_chunks, monkeypatch
+):
+    threads = []
+    for name in ["_write_chunks", "_search"]:
+        function = getattr(datastore, name)
+
+        def recorded(*args, function=function):
+            threads.append(threading.current_thread().name)
+            return function(*args)
+
+        monkeypatch.setattr(datastore, name, recorded)
+
+    await datastore._upsert(document_chunks)
+    await datastore._query(
+        [QueryWithEmbedding(query="q", embedding=embedding(10), top_k=5)]
+    )
+
+    assert len(threads) == 2
+    assert all(thread.startswith("local") for thread in threads)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("index", ["exact", "hnsw"])
+async def test_persists_to_disk(tmp_path, monkeypatch, document_chunks, index):
+    monkeypatch.setattr(local_datastore, "HNSW_EXACT_MAX_ROWS", 0)
+    datastore = LocalDataStore(persistence_dir=str(tmp_path), index=index)
+    await datastore._upsert(document_chunks)
+    await datastore.delete(ids=["doc-3"])
+    query = QueryWithEmbedding(query="q", embedding=embedding(5), top_k=4)
+    (expected,) = await datastore._query([query])
+
+    reloaded = LocalDataStore(persistence_dir=str(tmp_path), index=index)
+    (result,) = await reloaded._query([query])
+
+    assert result == expected
+    assert len(result.results) == 4
+    if index == "hnsw":
+        assert len(reloaded._index) == 9  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_hnsw_index_is_built_for_a_store_persisted_without_one(
+    tmp_path, monkeypatch, document_chunks
+):
+    monkeypatch.setattr(local_datastore, "HNSW_EXACT_MAX_ROWS", 0)
+    await LocalDataStore(persistence_dir=str(tmp_path))._upsert(document_chunks)
+
+    datastore = LocalDataStore(persistence_dir=str(tmp_path), index="hnsw")
+    (result,) = await datastore._query(
+        [QueryWithEmbedding(query="q", embedding=embedding(21), top_k=1)]
+    )
+
+    assert len(datastore._index) == 12  # type: ignore
+    assert result.results[0].id == "doc-2-1"
+
+
+@pytest.mark.asyncio
+async def test_changes_are_appended_to_the_log_and_replayed(
+    tmp_path, monkeypatch, document_chunks
+):
+    # Only append to the log, without writing the datastore file
+    monkeypatch.setattr(local_datastore, "LOCAL_LOG_COMPACT_RATIO", 100.0)
+    datastore = LocalDataStore(persistence_dir=str(tmp_path), index="hnsw")
+    await datastore._upsert(document_chunks)
+    chunk = document_chunks["doc-0"][0].copy(update={"text": "updated"})
+    await datastore._upsert({"doc-0": [chunk]})
+    await datastore.delete(ids=["doc-3"])
+    await datastore._delete_chunks({"doc-1": ["doc-1-0"]})
+
+    log_path = tmp_path / local_datastore.LOG_FILE.format(generation=0)
+    assert log_path.exists()
+    assert not (tmp_path / local_datastore.DATASTORE_FILE).exists()
+    # A record cut short by a crash is dropped
+    with open(log_path, "ab") as log_file:
+        log_file.write(b"\x93NUMPY")
+    query = QueryWithEmbedding(query="q", embedding=embedding(0), top_k=4)
+    (expected,) = await datastore._query([query])
+
+    reloaded = LocalDataStore(persistence_dir=str(tmp_path), index="hnsw")
+    (result,) = await reloaded._query([query])
+
+    assert sorted(reloaded._rows) == sorted(datastore._rows)
+    assert len(reloaded._rows) == 8
+    assert result == expected
+    assert reloaded._columns["text"][reloaded._rows["doc-0-0"]] == "updated"
+
+    await reloaded.delete(delete_all=True)
+    assert not log_path.exists()
+    assert LocalDataStore(persistence_dir=str(tmp_path))._size == 0
+
+
+@pytest.mark.asyncio
+async def test_upsert_persists_once(tmp_path, monkeypatch):
+    async def fake_embeddings(texts, batch_size):
+        return [embedding(len(text)) for text in texts]
+
+    monkeypatch.setattr(services.chunks, "aget_embeddings_batched", fake_embeddings)
+    monkeypatch.setattr(
+        services.chunks, "get_text_chunks", lambda text, size: text.split("\n")
+    )
+    datastore = LocalDataStore(persistence_dir=str(tmp_path))
+    writes: List[str] = []
+    for name in ["_append_log", "_write_snapshot"]:
+
+        def write(*args, name=name, original=getattr(datastore, name)):
+            writes.append(name)
+            return original(*args)
+
+        monkeypatch.setattr(datastore, name, write)
+    documents = [
+        Document(id=f"doc-{d}", text=f"First line of {d}\nSecond line of {d}")
+        for d in range(5)
+    ]
+
+    await datastore.upsert(documents)
+    assert len(writes) == 1
+    # Each document is deleted, then the new chunks are inserted
+    documents[0] = Document(id="doc-0", text="Changed line\nSecond line of 0")
+    await datastore.upsert(documents)
+    assert len(writes) == 2
+
+    reloaded = LocalDataStore(persistence_dir=str(tmp_path))
+    assert reloaded._size == 10
+    assert reloaded._columns["text"][reloaded._rows["doc-0_0"]] == "Changed line"
@@ -11,9 +11,13 @@ from models.models import (
     QueryWithEmbedding,
     Source,
 )
+from datastore.providers import milvus_datastore as milvus_datastore_module
 from datastore.providers.milvus_datastore import (
     OUTPUT_DIM,
     MilvusDataStore,
+    batch_rows,
+    create_schema,
+    get_partition_key,
 )
 
 
@@ -168,6 +172,56 @@ async def test_upsert(milvus_datastore, document_chunk_one):
     milvus_datastore.col.drop()
 
 
+def test_batch_rows(monkeypatch):
+    monkeypatch.setattr(milvus_datastore_module, "MILVUS_UPSERT_BATCH_SIZE", 3)
+    monkeypatch.setattr(milvus_datastore_module, "MILVUS_UPSERT_BATCH_BYTES", 4 * 10)
+    small = [[0.0] * 2, "a"]
+    large = [[0.0] * 20, "b"]
+
+    assert [] == batch_rows([])
+    assert [3, 3, 1] == [len(batch) for batch in batch_rows([small] * 7)]
+    # A row over the byte bound is inserted on its own
+    assert [[small], [large], [small, small]] == batch_rows(
+        [small, large, small, small]
+    )
+
+
+@pytest.mark.asyncio
+async def test_upsert_in_batches(milvus_datastore, monkeypatch):
+    monkeypatch.setattr(milvus_datastore_module, "MILVUS_UPSERT_BATCH_SIZE", 4)
+    await milvus_datastore.delete(delete_all=True)
+    chunks = {
+        f"doc_{i}": [
+            DocumentChunk(
+                id=f"doc_{i}_{j}",
+                text="lorem ipsum",
+                metadata=DocumentChunkMetadata(document_id=f"doc_{i}"),
+                embedding=sample_embedding(i * 3 + j),
+            )
+            for j in range(3)
+        ]
+        for i in range(5)
+    }
+    res = await milvus_datastore._upsert(chunks)
+    assert res == list(chunks.keys())
+    milvus_datastore.col.flush()
+    assert 15 == milvus_datastore.col.num_entities
+
+    await milvus_datastore.delete(ids=["doc_0", "doc_3"])
+    query = QueryWithEmbedding(
+        query="lorem",
+        top_k=15,
+        embedding=sample_embedding(0),
+    )
+    query_results = await milvus_datastore._query(queries=[query])
+    assert 9 == len(query_results[0].results)
+    assert all(
+        not result.id.startswith(("doc_0_", "doc_3_"))
+        for result in query_results[0].results
+    )
+    milvus_datastore.col.drop()
+
+
 @pytest.mark.asyncio
 async def test_reload(milvus_datastore, document_chunk_one, document_chunk_two):
     await milvus_datastore.delete(delete_all=True)
@@ -255,6 +309,69 @@ async def test_query_filter(milvus_datastore, document_chunk_one):
     milvus_datastore.col.drop()
 
 
+@pytest.mark.asyncio
+async def test_query_grouped_by_filter(milvus_datastore, document_chunk_one):
+    await milvus_datastore.delete(delete_all=True)
+    res = await milvus_datastore._upsert(document_chunk_one)
+    assert res == list(document_chunk_one.keys())
+    milvus_datastore.col.flush()
+    date_filter = DocumentMetadataFilter(
+        start_date="2000-01-03T16:39:57-08:00", end_date="2010-01-03T16:39:57-08:00"
+    )
+    queries = [
+        QueryWithEmbedding(query="first", top_k=1, embedding=sample_embedding(0)),
+        QueryWithEmbedding(
+            query="second", top_k=1, embedding=sample_embedding(0), filter=date_filter
+        ),
+        QueryWithEmbedding(query="third", top_k=3, embedding=sample_embedding(0)),
+        QueryWithEmbedding(
+            query="fourth", top_k=2, embedding=sample_embedding(0), filter=date_filter
+        ),
+    ]
+    query_results = await milvus_datastore._query(queries=queries)
+
+    assert ["first", "second", "third", "fourth"] == [
+        result.query for result in query_results
+    ]
+    assert [1, 1, 3, 1] == [len(result.results) for result in query_results]
+    assert "abc_123" == query_results[0].results[0].id
+    assert "def_456" == query_results[1].results[0].id
+    assert "abc_123" == query_results[2].results[0].id
+    assert "def_456" == query_results[3].results[0].id
+    milvus_datastore.col.drop()
+
+
+def test_create_schema_invalid_partition_key():
+    with pytest.raises(ValueError):
+        create_schema("created_at")
+
+
+@pytest.mark.asyncio
+async def test_query_partition_key(document_chunk_one):
+    milvus_datastore = MilvusDataStore(
+        create_new=True, consistency_level="Strong", partition_key="source"
+    )
+    assert "source" == get_partition_key(milvus_datastore.col)
+    res = await milvus_datastore._upsert(document_chunk_one)
+    assert res == list(document_chunk_one.keys())
+    milvus_datastore.col.flush()
+    query = QueryWithEmbedding(
+        query="lorem",
+        top_k=3,
+        embedding=sample_embedding(0),
+        filter=DocumentMetadataFilter(source=Source.chat),
+    )
+    query_results = await milvus_datastore._query(queries=[query])
+
+    assert 1 == len(query_results[0].results)
+    assert "ghi_789" == query_results[0].results[0].id
+
+    await milvus_datastore.delete(filter=DocumentMetadataFilter(source=Source.chat))
+    query_results = await milvus_datastore._query(queries=[query])
+    assert 0 == len(query_results[0].results)
+    milvus_datastore.col.drop()
+
+
 @pytest.mark.asyncio
 async def test_delete_with_date_filter(milvus_datastore, document_chunk_one):
     await milvus_datastore.delete(delete_all=True)
@@ -0,0 +1,104 @@
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+from datastore.providers import pgvector_datastore
+from datastore.providers.pgvector_datastore import (
+    PGClient,
+    PgVectorDataStore,
+    group_rows_by_columns,
+)
+from models.models import (
+    DocumentChunk,
+    DocumentChunkMetadata,
+    DocumentMetadataFilter,
+    QueryAccuracy,
+)
+
+
+class RecordingClient(PGClient):
+    """
+    Client that records the rows of each bulk upsert instead of writing them.
+    """
+
+    def __init__(self):
+        self.batches: List[List[Dict[str, Any]]] = []
+
+    async def upsert(self, table: str, json: Dict[str, Any]) -> None:
+        raise AssertionError("Chunks should be written in bulk")
+
+    async def bulk_upsert(self, table: str, rows: List[Dict[str, Any]]) -> None:
+        self.batches.append(rows)
+
+    async def rpc(
+        self,
+        function_name: str,
+        params: Dict[str, Any],
+        accuracy: Optional[QueryAccuracy] = None,
+    ) -> Any:
+        return []
+
+    async def select_in(
+        self, table: str, columns: List[str], column: str, ids: List[str]
+    ) -> List[Dict[str, Any]]:
+        return []
+
+    async def delete_like(self, table: str, column: str, pattern: str) -> None:
+        pass
+
+    async def delete_in(self, table: str, column: str, ids: List[str]) -> None:
+        pass
+
+    async def delete_by_filters(
+        self, table: str, filter: DocumentMetadataFilter
+    ) -> None:
+        pass
+
+
+class RecordingDataStore(PgVectorDataStore):
+    def create_db_client(self) -> PGClient:
+        return RecordingClient()
+
+
+def test_group_rows_by_columns():
+    rows = [
+        {"id": "a", "content": "1"},
+        {"id": "b", "content": "2", "content_hash": "h"},
+        {"id": "c", "content": "3"},
+        {"id": "a", "content": "4"},
+    ]
+    assert group_rows_by_columns(rows) == [
+        [{"id": "a", "content": "4"}, {"id": "c", "content": "3"}],
+        [{"id": "b", "content": "2", "content_hash": "h"}],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_upsert_batches(monkeypatch):
+    monkeypatch.setattr(pgvector_datastore, "UPSERT_BATCH_SIZE", 4)
+    datastore = RecordingDataStore()
+    chunks = {
+        f"doc-{d}": [
+            DocumentChunk(
+                id=f"doc-{d}-{i}",
+                text=f"Chunk {i} of document {d}",
+                metadata=DocumentChunkMetadata(
+                    created_at="2023-01-01" if i else None
+                ),
+                embedding=[float(i), 1.0],
+            )
+            for i in range(3)
+        ]
+        for d in range(3)
+    }
+    assert ["doc-0", "doc-1", "doc-2"] == await datastore._upsert(chunks)
+
+    batches = datastore.client.batches
+    assert [4, 4, 1] == [len(batch) for batch in batches]
+    rows = [row for batch in batches for row in batch]
+    assert [chunk.id for document in chunks.values() for chunk in document] == [
+        row["id"] for row in rows
+    ]
+    assert "doc-2" == rows[-1]["document_id"]
+    assert "created_at" not in rows[0]
+    assert 2023 == rows[1]["created_at"].year
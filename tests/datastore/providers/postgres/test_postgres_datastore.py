@@ -1,10 +1,11 @@
 from typing import Dict, List
 import pytest
-from datastore.providers.postgres_datastore import PostgresDataStore
+from datastore.providers.postgres_datastore import PostgresClient, PostgresDataStore
 from models.models import (
     DocumentChunk,
     DocumentChunkMetadata,
     DocumentMetadataFilter,
+    QueryAccuracy,
     QueryWithEmbedding,
 )
 
@@ -289,3 +290,79 @@ async def test_delete_all(postgres_datastore):
     results_after_delete = await postgres_datastore._query([query])
 
     assert len(results_after_delete[0].results) == 0
+
+
+@pytest.mark.asyncio
+async def test_query_more_queries_than_connections(
+    initial_document_chunks: Dict[str, List[DocumentChunk]],
+):
+    postgres_datastore = PostgresDataStore()
+    postgres_datastore.client = PostgresClient(pool_size=2)
+    await postgres_datastore.delete(delete_all=True)
+    await postgres_datastore._upsert(initial_document_chunks)
+
+    queries = [
+        QueryWithEmbedding(
+            query=f"Query {i}",
+            top_k=1,
+            embedding=create_embedding(4 + i % 3),
+        )
+        for i in range(10)
+    ]
+    query_results = await postgres_datastore._query(queries)
+    assert [query.query for query in queries] == [
+        result.query for result in query_results
+    ]
+    for i, result in enumerate(query_results):
+        assert 1 == len(result.results)
+        assert f"first-doc-{4 + i % 3}" == result.results[0].id
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("method", ["hnsw", "ivfflat"])
+async def test_create_index_query_accuracy(
+    postgres_datastore: PostgresDataStore,
+    initial_document_chunks: Dict[str, List[DocumentChunk]],
+    queries: List[QueryWithEmbedding],
+    method: str,
+):
+    await postgres_datastore.delete(delete_all=True)
+    await postgres_datastore._upsert(initial_document_chunks)
+    client = postgres_datastore.client
+    name = await client.create_index("documents", method, lists=1)
+    try:
+        assert f"documents_embedding_{method}_idx" == name
+        assert name == await client.create_index(
+            "documents", method, lists=1, rebuild=True
+        )
+        assert isinstance(await client.check_query_plan("documents"), bool)
+
+        for accuracy in QueryAccuracy:
+            query_results = await postgres_datastore._query(
+                [query.copy(update={"accuracy": accuracy}) for query in queries]
+            )
+            assert ["first-doc-4"] == [
+                result.id for result in query_results[0].results
+            ]
+            assert ["first-doc-5", "first-doc-4"] == [
+                result.id for result in query_results[1].results
+            ]
+    finally:
+        await client._run(client._execute, f"DROP INDEX IF EXISTS {name}")
+
+
+@pytest.mark.asyncio
+async def test_create_index_default_lists(
+    postgres_datastore: PostgresDataStore,
+    initial_document_chunks: Dict[str, List[DocumentChunk]],
+):
+    await postgres_datastore.delete(delete_all=True)
+    await postgres_datastore._upsert(initial_document_chunks)
+    client = postgres_datastore.client
+    # Counting the rows for the default lists must not leave a transaction open
+    name = await client.create_index("documents", "ivfflat")
+    try:
+        assert "documents_embedding_ivfflat_idx" == name
+        assert name == await client.create_index("documents", "ivfflat", rebuild=True)
+    finally:
+        await client._run(client._execute, f"DROP INDEX IF EXISTS {name}")
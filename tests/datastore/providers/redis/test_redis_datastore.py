@@ -1,5 +1,6 @@
+from datastore.providers import redis_datastore as redis_datastore_module
 from datastore.providers.redis_datastore import RedisDataStore
-from models.models import DocumentChunk, DocumentChunkMetadata, QueryWithEmbedding, Source, DocumentMetadataFilter
+from models.models import DocumentChunk, DocumentChunkMetadata, QueryAccuracy, QueryWithEmbedding, Source, DocumentMetadataFilter
 import pytest
 import redis.asyncio as redis
 import numpy as np
@@ -62,3 +63,194 @@ async def test_redis_filter_query(redis_datastore):
 async def test_redis_delete_docs(redis_datastore):
     res = await redis_datastore.delete(ids=["docs"])
     assert res
+
+
+@pytest.fixture
+async def redis_hash_datastore():
+    datastore = await RedisDataStore.init(
+        dim=5, storage_type="hash", index_name="hash_index", doc_prefix="hash_doc"
+    )
+    yield datastore
+    await datastore.client.ft("hash_index").dropindex(delete_documents=True)
+
+@pytest.mark.asyncio
+async def test_redis_hash_upsert_query(redis_hash_datastore):
+    docs = create_document_chunks(NUM_TEST_DOCS, 5)
+    await redis_hash_datastore._upsert(docs)
+    query = QueryWithEmbedding(
+        query="Lorem ipsum 0",
+        filter=DocumentMetadataFilter(source=Source.file),
+        top_k=5,
+        embedding=create_embedding(0, 5),
+    )
+    query_results = await redis_hash_datastore._query(queries=[query])
+    assert 1 == len(query_results)
+    assert 5 == len(query_results[0].results)
+    for i in range(5):
+        result = query_results[0].results[i]
+        assert f"Lorem ipsum {i}" == result.text
+        assert "docs" == result.id
+        assert Source.file == result.metadata.source
+        assert result.metadata.author is None
+
+
+@pytest.mark.asyncio
+async def test_redis_upsert_query_batches(redis_hash_datastore, monkeypatch):
+    # Send the upsert over several pipeline round trips
+    monkeypatch.setattr(redis_datastore_module, "REDIS_PIPELINE_SIZE", 3)
+    docs = create_document_chunks(NUM_TEST_DOCS, 5)
+    assert ["docs"] == await redis_hash_datastore._upsert(docs)
+    queries = [
+        QueryWithEmbedding(
+            query=f"Lorem ipsum {i}",
+            top_k=NUM_TEST_DOCS,
+            embedding=create_embedding(i, 5),
+        )
+        for i in range(3)
+    ]
+    query_results = await redis_hash_datastore._query(queries=queries)
+    assert [query.query for query in queries] == [result.query for result in query_results]
+    for result in query_results:
+        assert NUM_TEST_DOCS == len(result.results)
+
+
+@pytest.mark.asyncio
+async def test_redis_delete_by_ids_and_filter(redis_hash_datastore):
+    docs = create_document_chunks(NUM_TEST_DOCS, 5)
+    other_docs = [
+        DocumentChunk(
+            id=f"{document_id}_0",
+            text=f"Dolor sit {document_id}",
+            embedding=create_embedding(0, 5),
+            metadata=DocumentChunkMetadata(source=Source.email, document_id=document_id),
+        )
+        for document_id in ["other-doc", "other.doc"]
+    ]
+    await redis_hash_datastore._upsert(
+        {**docs, "other-doc": other_docs[:1], "other.doc": other_docs[1:]}
+    )
+    query = QueryWithEmbedding(
+        query="Lorem ipsum 0", top_k=20, embedding=create_embedding(0, 5)
+    )
+
+    # The source does not match the chunks of the document, so nothing is deleted
+    await redis_hash_datastore.delete(
+        filter=DocumentMetadataFilter(document_id="docs", source=Source.email)
+    )
+    query_results = await redis_hash_datastore._query(queries=[query])
+    assert NUM_TEST_DOCS + 2 == len(query_results[0].results)
+
+    await redis_hash_datastore.delete(filter=DocumentMetadataFilter(source=Source.file))
+    query_results = await redis_hash_datastore._query(queries=[query])
+    assert {"other-doc", "other.doc"} == {result.id for result in query_results[0].results}
+
+    await redis_hash_datastore.delete(ids=["other-doc", "other.doc"])
+    query_results = await redis_hash_datastore._query(queries=[query])
+    assert 0 == len(query_results[0].results)
+
+
+@pytest.mark.asyncio
+async def test_redis_hnsw_query_accuracy():
+    datastore = await RedisDataStore.init(
+        dim=5,
+        storage_type="hash",
+        index_name="hnsw_index",
+        doc_prefix="hnsw_doc",
+        index_type="HNSW",
+        hnsw_m=4,
+        hnsw_ef_construction=20,
+        hnsw_ef_runtime=4,
+    )
+    try:
+        await datastore._upsert(create_document_chunks(NUM_TEST_DOCS, 5))
+        for accuracy in [None, *QueryAccuracy]:
+            query = QueryWithEmbedding(
+                query="Lorem ipsum 0",
+                top_k=5,
+                embedding=create_embedding(0, 5),
+                accuracy=accuracy,
+            )
+            redis_query = datastore._get_redis_query(query)
+            assert ("EF_RUNTIME" in redis_query.query_string()) == (accuracy is not None)
+            query_results = await datastore._query(queries=[query])
+            assert 5 == len(query_results[0].results)
+            assert "Lorem ipsum 0" == query_results[0].results[0].text
+    finally:
+        await datastore.client.ft("hnsw_index").dropindex(delete_documents=True)
+
+
+
+@pytest.mark.asyncio
+async def test_redis_upsert_retry_after_failure(redis_hash_datastore, monkeypatch):
+    docs = create_document_chunks(NUM_TEST_DOCS, 5)
+    execute = redis.client.Pipeline.execute
+    failures = [ConnectionError("Connection reset")]
+
+    async def fail_once(self, *args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return await execute(self, *args, **kwargs)
+
+    monkeypatch.setattr(redis.client.Pipeline, "execute", fail_once)
+    with pytest.raises(ConnectionError):
+        await redis_hash_datastore._upsert(docs)
+
+    # The retry upserts the same, unchanged chunks
+    assert [f"first-doc_{i}" for i in range(NUM_TEST_DOCS)] == [
+        chunk.id for chunk in docs["docs"]
+    ]
+    assert all(isinstance(chunk.metadata, DocumentChunkMetadata) for chunk in docs["docs"])
+    assert ["docs"] == await redis_hash_datastore._upsert(docs)
+    query = QueryWithEmbedding(query="Lorem ipsum 0", top_k=20, embedding=create_embedding(0, 5))
+    query_results = await redis_hash_datastore._query(queries=[query])
+    assert NUM_TEST_DOCS == len(query_results[0].results)
+
+def create_authored_chunk(document_id, author, created_at):
+    return DocumentChunk(
+        id=f"{document_id}_0",
+        text=f"Written by {author}",
+        embedding=create_embedding(0, 5),
+        metadata=DocumentChunkMetadata(
+            document_id=document_id, author=author, created_at=created_at
+        ),
+    )
+
+
+@pytest.mark.asyncio
+async def test_redis_delete_by_author_matches_exactly(redis_hash_datastore):
+    chunks = [
+        create_authored_chunk("john-smith", "John Smith", "2023-01-01"),
+        create_authored_chunk("john-smithers", "John Smithers", "2023-01-01"),
+        create_authored_chunk("jane-smith", "Jane Smith", "2023-01-01"),
+        create_authored_chunk("o-brien", "Dr. O'Brien (Jr.)", "2023-01-01"),
+    ]
+    await redis_hash_datastore._upsert({chunk.metadata.document_id: [chunk] for chunk in chunks})
+    query = QueryWithEmbedding(query="Written", top_k=10, embedding=create_embedding(0, 5))
+
+    await redis_hash_datastore.delete(filter=DocumentMetadataFilter(author="John Smith"))
+    await redis_hash_datastore.delete(filter=DocumentMetadataFilter(author="Dr. O'Brien (Jr.)"))
+
+    query_results = await redis_hash_datastore._query(queries=[query])
+    assert {"john-smithers", "jane-smith"} == {result.id for result in query_results[0].results}
+
+
+@pytest.mark.asyncio
+async def test_redis_delete_by_date(redis_hash_datastore):
+    chunks = [
+        create_authored_chunk(f"doc-{day}", "Someone", f"2023-01-0{day}")
+        for day in range(1, 6)
+    ]
+    await redis_hash_datastore._upsert({chunk.metadata.document_id: [chunk] for chunk in chunks})
+    query = QueryWithEmbedding(query="Written", top_k=10, embedding=create_embedding(0, 5))
+
+    await redis_hash_datastore.delete(
+        filter=DocumentMetadataFilter(start_date="2023-01-04")
+    )
+    query_results = await redis_hash_datastore._query(queries=[query])
+    assert {"doc-1", "doc-2", "doc-3"} == {result.id for result in query_results[0].results}
+
+    await redis_hash_datastore.delete(
+        filter=DocumentMetadataFilter(start_date="2023-01-02", end_date="2023-01-02")
+    )
+    query_results = await redis_hash_datastore._query(queries=[query])
+    assert {"doc-1", "doc-3"} == {result.id for result in query_results[0].results}
@@ -0,0 +1,254 @@
+import asyncio
+import os
+import threading
+from typing import Dict, List
+
+import numpy as np
+import pytest
+
+from datastore.providers import segment_datastore
+from datastore.providers.local_datastore import LocalDataStore
+from datastore.providers.segment_datastore import SegmentDataStore
+from models.models import (
+    DocumentChunk,
+    DocumentChunkMetadata,
+    DocumentMetadataFilter,
+    QueryWithEmbedding,
+    Source,
+)
+
+DIM = 8
+
+
+def embedding(i: int) -> List[float]:
+    return np.random.default_rng(i).normal(size=DIM).tolist()
+
+
+def document_chunks(d: int) -> Dict[str, List[DocumentChunk]]:
+    return {
+        f"doc-{d}": [
+            DocumentChunk(
+                id=f"doc-{d}-{i}",
+                text=f"Chunk {i} of document {d}",
+                metadata=DocumentChunkMetadata(
+                    document_id=f"doc-{d}",
+                    source=Source.email if d % 2 else Source.file,
+                    source_id=f"source-{d}",
+                    author="alice" if d < 3 else "bob",
+                    created_at=f"2023-01-0{d + 1}",
+                ),
+                content_hash=f"hash-{d}-{i}",
+                embedding=embedding(10 * d + i),
+            )
+            for i in range(3)
+        ]
+    }
+
+
+QUERIES = [
+    QueryWithEmbedding(query="all", embedding=embedding(100), top_k=20),
+    QueryWithEmbedding(query="one", embedding=embedding(101), top_k=1),
+    QueryWithEmbedding(
+        query="filtered",
+        embedding=embedding(102),
+        top_k=4,
+        filter=DocumentMetadataFilter(author="bob", start_date="2023-01-05"),
+    ),
+    QueryWithEmbedding(
+        query="document",
+        embedding=embedding(103),
+        top_k=5,
+        filter=DocumentMetadataFilter(document_id="doc-1", source=Source.email),
+    ),
+]
+
+
+async def assert_same_results(datastore, expected: LocalDataStore):
+    results = await datastore._query(QUERIES)
+    expected_results = await expected._query(QUERIES)
+    for result, expected_result in zip(results, expected_results):
+        assert [chunk.id for chunk in result.results] == [
+            chunk.id for chunk in expected_result.results
+        ]
+        for chunk, expected_chunk in zip(result.results, expected_result.results):
+            assert chunk.score == pytest.approx(expected_chunk.score, abs=1e-5)
+            assert chunk.text == expected_chunk.text
+            assert chunk.metadata == expected_chunk.metadata
+
+
+@pytest.mark.asyncio
+async def test_segments_match_exact_search(tmp_path):
+    datastore = SegmentDataStore(path=str(tmp_path), merge_factor=100)
+    expected = LocalDataStore(persistence_dir=None)
+    for d in range(6):
+        await datastore._upsert(document_chunks(d))
+        await expected._upsert(document_chunks(d))
+
+    assert len(datastore._segments) == 6
+    await assert_same_results(datastore, expected)
+
+    # Overwriting a chunk tombstones its previous row
+    chunk = document_chunks(2)["doc-2"][1].copy(update={"text": "updated"})
+    await datastore._upsert({"doc-2": [chunk]})
+    await expected._upsert({"doc-2": [chunk]})
+    await datastore.delete(ids=["doc-4"])
+    await expected.delete(ids=["doc-4"])
+    await datastore.delete(filter=DocumentMetadataFilter(source_id="source-0"))
+    await expected.delete(filter=DocumentMetadataFilter(source_id="source-0"))
+    await assert_same_results(datastore, expected)
+
+    assert await datastore._get_chunk_hashes(["doc-2", "doc-4"]) == {
+        "doc-2": {"doc-2-0": "hash-2-0", "doc-2-1": "hash-2-1", "doc-2-2": "hash-2-2"}
+    }
+
+    # Reopening only maps the segments and reads the tombstones
+    await assert_same_results(SegmentDataStore(path=str(tmp_path)), expected)
+
+
+@pytest.mark.asyncio
+async def test_writes_are_seen_by_other_instances(tmp_path):
+    writer = SegmentDataStore(path=str(tmp_path))
+    reader = SegmentDataStore(path=str(tmp_path))
+
+    await writer._upsert(document_chunks(0))
+    (result,) = await reader._query([QUERIES[0]])
+    assert len(result.results) == 3
+
+    await writer.delete(ids=["doc-0"])
+    (result,) = await reader._query([QUERIES[0]])
+    assert result.results == []
+
+
+@pytest.mark.asyncio
+async def test_background_merge_keeps_results_and_concurrent_deletes(
+    tmp_path, monkeypatch
+):
+    datastore = SegmentDataStore(path=str(tmp_path), merge_factor=100)
+    expected = LocalDataStore(persistence_dir=None)
+    for d in range(6):
+        await datastore._upsert(document_chunks(d))
+        await expected._upsert(document_chunks(d))
+    await datastore.delete(ids=["doc-5"])
+    await expected.delete(ids=["doc-5"])
+
+    # Another worker deletes a document while the merged segment is being written
+    other_worker = SegmentDataStore(
+        path=str(tmp_path), merge_factor=100, max_deleted_ratio=1
+    )
+    close = segment_datastore.SegmentWriter.close
+
+    def close_after_delete(writer):
+        asyncio.run(other_worker.delete(ids=["doc-3"]))
+        close(writer)
+
+    monkeypatch.setattr(segment_datastore.SegmentWriter, "close", close_after_delete)
+    await datastore.compact()
+    await expected.delete(ids=["doc-3"])
+
+    assert len(datastore._segments) == 1
+    assert len(os.listdir(tmp_path)) == 3  # the manifest, the lock file and the merged segment
+    await assert_same_results(datastore, expected)
+    await assert_same_results(SegmentDataStore(path=str(tmp_path)), expected)
+
+
+@pytest.mark.asyncio
+async def test_merges_segments_of_the_same_size_in_the_background(tmp_path):
+    datastore = SegmentDataStore(path=str(tmp_path), merge_factor=2)
+    expected = LocalDataStore(persistence_dir=None)
+    for d in range(4):
+        await datastore._upsert(document_chunks(d))
+        await expected._upsert(document_chunks(d))
+        while datastore._compaction is not None and not datastore._compaction.done():
+            await datastore._compaction
+
+    assert len(datastore._segments) < 4
+    await assert_same_results(datastore, expected)
+
+    await datastore.delete(delete_all=True)
+    (result,) = await datastore._query([QUERIES[0]])
+    assert result.results == []
+
+
+@pytest.mark.asyncio
+async def test_reads_and_writes_do_not_block_the_event_loop(tmp_path, monkeypatch):
+    datastore = SegmentDataStore(path=str(tmp_path))
+    loop_ran = threading.Event()
+    write_segment = SegmentDataStore._write_segment
+
+    def write_segment_after_loop(self, chunks):
+        # Only set by the event loop if the write runs in another thread
+        assert loop_ran.wait(timeout=5)
+        return write_segment(self, chunks)
+
+    async def set_loop_ran():
+        loop_ran.set()
+
+    monkeypatch.setattr(SegmentDataStore, "_write_segment", write_segment_after_loop)
+    await asyncio.gather(datastore._upsert(document_chunks(0)), set_loop_ran())
+
+    (result,) = await datastore._query([QUERIES[0]])
+    assert len(result.results) == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("quantization", ["int8", "binary"])
+async def test_quantized_segments_are_rescored_to_exact_scores(tmp_path, quantization):
+    # Unquantized segments written before quantization was enabled are still searched
+    datastore = SegmentDataStore(path=str(tmp_path), merge_factor=100)
+    expected = LocalDataStore(persistence_dir=None)
+    await datastore._upsert(document_chunks(0))
+    await expected._upsert(document_chunks(0))
+
+    # With more candidates than chunks, rescoring gives back the exact results
+    datastore = SegmentDataStore(
+        path=str(tmp_path),
+        merge_factor=100,
+        quantization=quantization,
+        rescore_factor=100,
+    )
+    for d in range(1, 6):
+        await datastore._upsert(document_chunks(d))
+        await expected._upsert(document_chunks(d))
+
+    quantizations = sorted(s.quantization for s in datastore._segments.values())
+    assert quantizations == sorted(["none"] + [quantization] * 5)
+    await assert_same_results(datastore, expected)
+
+    await datastore.compact()
+    (segment,) = datastore._segments.values()
+    assert segment.quantization == quantization
+    await assert_same_results(datastore, expected)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("quantization, min_recall", [("int8", 0.95), ("binary", 0.9)])
+async def test_quantized_search_recall(tmp_path, quantization, min_recall):
+    dimension = 128
+    rng = np.random.default_rng(0)
+    # Chunks about 100 topics, and queries about the same topics
+    topics = rng.normal(size=(100, dimension))
+    vectors = topics[np.arange(2000) % 100] + rng.normal(size=(2000, dimension))
+    chunks = [
+        DocumentChunk(
+            id=str(i),
+            text="",
+            metadata=DocumentChunkMetadata(document_id=str(i)),
+            embedding=vector.tolist(),
+        )
+        for i, vector in enumerate(vectors)
+    ]
+    datastore = SegmentDataStore(path=str(tmp_path), quantization=quantization)
+    await datastore._upsert({"doc": chunks})
+    queries = [
+        QueryWithEmbedding(query=str(i), embedding=vector.tolist(), top_k=10)
+        for i, vector in enumerate(topics[:20] + rng.normal(size=(20, dimension)))
+    ]
+
+    results = await datastore._query(queries)
+
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    found = 0
+    for query, result in zip(queries, results):
+        expected = np.argsort(-(normalized @ np.array(query.embedding)))[:10]
+        found += len({int(chunk.id) for chunk in result.results} & set(expected))
+    assert found / 200 >= min_recall
@@ -0,0 +1,144 @@
+from typing import Dict, List, Optional
+
+import pytest
+
+import datastore.datastore
+import services.chunks
+from datastore.datastore import DataStore
+from models.models import (
+    Document,
+    DocumentChunk,
+    DocumentMetadataFilter,
+    QueryResult,
+    QueryWithEmbedding,
+)
+
+
+class InMemoryDataStore(DataStore):
+    supports_incremental_upsert = True
+
+    def __init__(self):
+        self.chunks: Dict[str, DocumentChunk] = {}
+        self.upserted: List[str] = []
+        self.deleted: List[str] = []
+
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+        for doc_chunks in chunks.values():
+            for chunk in doc_chunks:
+                self.chunks[chunk.id] = chunk  # type: ignore
+                self.upserted.append(chunk.id)  # type: ignore
+        return list(chunks.keys())
+
+    async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
+        raise NotImplementedError
+
+    async def delete(
+        self,
+        ids: Optional[List[str]] = None,
+        filter: Optional[DocumentMetadataFilter] = None,
+        delete_all: Optional[bool] = None,
+    ) -> bool:
+        raise NotImplementedError
+
+    async def _get_chunk_hashes(
+        self, document_ids: List[str]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        hashes: Dict[str, Dict[str, Optional[str]]] = {}
+        for chunk in self.chunks.values():
+            if chunk.metadata.document_id in document_ids:
+                hashes.setdefault(chunk.metadata.document_id, {})[chunk.id] = chunk.content_hash  # type: ignore
+        return hashes
+
+    async def _delete_chunks(self, chunk_ids: Dict[str, List[str]]) -> None:
+        for ids in chunk_ids.values():
+            for chunk_id in ids:
+                del self.chunks[chunk_id]
+                self.deleted.append(chunk_id)
+
+
+@pytest.fixture
+def embedded_texts(monkeypatch) -> List[str]:
+    texts: List[str] = []
+
+    async def fake_embeddings(batch_texts, batch_size):
+        texts.extend(batch_texts)
+        return [[float(len(text))] for text in batch_texts]
+
+    monkeypatch.setattr(services.chunks, "aget_embeddings_batched", fake_embeddings)
+    # One chunk per line, so the test does not depend on the tokenizer
+    monkeypatch.setattr(
+        services.chunks, "get_text_chunks", lambda text, size: text.split("\n")
+    )
+    monkeypatch.setattr(datastore.datastore, "INCREMENTAL_UPSERT", True)
+    return texts
+
+
+@pytest.mark.asyncio
+async def test_incremental_upsert_only_writes_changed_chunks(embedded_texts):
+    store = InMemoryDataStore()
+    paragraphs = [f"Paragraph number {i} of the document." for i in range(4)]
+
+    await store.upsert([Document(id="doc", text="\n".join(paragraphs))])
+    assert len(store.upserted) == 4
+    assert len(embedded_texts) == 4
+
+    store.upserted.clear()
+    embedded_texts.clear()
+    paragraphs[2] = "Paragraph number 2 was edited."
+    ids = await store.upsert([Document(id="doc", text="\n".join(paragraphs[:3]))])
+
+    assert ids == ["doc"]
+    assert store.upserted == ["doc_2"]
+    assert embedded_texts == ["Paragraph number 2 was edited."]
+    assert store.deleted == ["doc_3"]
+    assert sorted(store.chunks) == ["doc_0", "doc_1", "doc_2"]
+
+
+@pytest.mark.asyncio
+async def test_incremental_upsert_rewrites_chunks_when_metadata_changes(
+    embedded_texts,
+):
+    store = InMemoryDataStore()
+    await store.upsert([Document(id="doc", text="Some text that is long enough.")])
+
+    store.upserted.clear()
+    await store.upsert(
+        [
+            Document(
+                id="doc",
+                text="Some text that is long enough.",
+                metadata={"author": "someone"},
+            )
+        ]
+    )
+
+    assert store.upserted == ["doc_0"]
+    assert store.chunks["doc_0"].metadata.author == "someone"
+
+
+@pytest.mark.asyncio
+async def test_upsert_chunks_only_writes_changed_chunks(embedded_texts):
+    store = InMemoryDataStore()
+    documents = [Document(id="doc", text="First line.\nSecond line.")]
+    await store.upsert(documents)
+    store.upserted.clear()
+    embedded_texts.clear()
+
+    documents = [Document(id="doc", text="First line.\nSecond line, edited.")]
+    chunks = {
+        "doc": [
+            DocumentChunk(
+                id=f"doc_{i}",
+                text=text,
+                metadata=store.chunks["doc_0"].metadata,
+                embedding=[float(len(text))],
+            )
+            for i, text in enumerate(["First line.", "Second line, edited."])
+        ]
+    }
+    ids = await store.upsert_chunks(documents, chunks)
+
+    assert ids == ["doc"]
+    assert store.upserted == ["doc_1"]
+    # The chunks were embedded already
+    assert embedded_texts == []
@@ -0,0 +1,184 @@
+import numpy as np
+import pytest
+
+from datastore.hnsw import HNSWIndex
+
+DIM = 32
+
+
+def unit_vectors(count: int, seed: int) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(count, DIM))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(
+        np.float32
+    )
+
+
+def exact_labels(vectors: np.ndarray, labels: np.ndarray, query: np.ndarray, k: int):
+    return labels[np.argsort(-(vectors @ query), kind="stable")[:k]].tolist()
+
+
+@pytest.fixture(scope="module")
+def vectors() -> np.ndarray:
+    return unit_vectors(2000, seed=0)
+
+
+@pytest.fixture(scope="module")
+def index(vectors) -> HNSWIndex:
+    index = HNSWIndex(DIM, m=8, ef_construction=64, seed=0)
+    index.add(vectors, np.arange(len(vectors)))
+    return index
+
+
+def recall(index: HNSWIndex, vectors: np.ndarray, k: int, ef: int) -> float:
+    labels = np.arange(len(vectors))
+    found = 0
+    for query in unit_vectors(50, seed=1):
+        found += len(
+            set(index.search(query, k, ef=ef)[0].tolist())
+            & set(exact_labels(vectors, labels, query, k))
+        )
+    return found / (50 * k)
+
+
+def test_search_recall_grows_with_ef(index, vectors):
+    low, high = recall(index, vectors, 10, ef=10), recall(index, vectors, 10, ef=200)
+
+    assert high >= 0.95
+    assert high > low
+
+
+def test_search_returns_scores_best_first(index, vectors):
+    labels, scores = index.search(vectors[7], 5)
+
+    assert labels[0] == 7
+    assert scores[0] == pytest.approx(1.0)
+    assert list(scores) == sorted(scores, reverse=True)
+    assert np.allclose(scores, vectors[labels] @ vectors[7])
+
+
+def test_search_only_returns_allowed_labels(index, vectors):
+    allowed = np.zeros(len(vectors), dtype=bool)
+    allowed[::50] = True
+
+    labels, _ = index.search(vectors[3], 10, ef=200, allowed=allowed)
+
+    assert len(labels) == 10
+    assert allowed[labels].all()
+
+
+def test_removed_and_replaced_labels():
+    vectors = unit_vectors(300, seed=2)
+    index = HNSWIndex(DIM, m=4, seed=0)
+    index.add(vectors, np.arange(300))
+
+    index.remove([5, 6, 1000])
+    index.add(vectors[[0]], [7])
+
+    assert len(index) == 298
+    assert index.deleted_count == 3
+    assert 5 not in index.search(vectors[5], 10, ef=100)[0]
+    labels, scores = index.search(vectors[0], 2, ef=100)
+    assert sorted(labels.tolist()) == [0, 7]
+    assert scores == pytest.approx([1.0, 1.0])
+
+    # Labels shift down past the removed ones, and mapping to -1 removes a label
+    new_labels = np.arange(300) - 2
+    new_labels[:2] = -1
+    index.relabel(new_labels)
+
+    assert len(index) == 296
+    assert index.search(vectors[9], 1, ef=100)[0].tolist() == [7]
+
+
+def test_save_and_load(tmp_path, index, vectors):
+    index.remove([3])
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+
+    loaded = HNSWIndex.load(path)
+
+    assert len(loaded) == len(index)
+    assert (loaded.m, loaded.ef_construction) == (8, 64)
+    for query in unit_vectors(10, seed=3):
+        assert loaded.search(query, 5)[0].tolist() == index.search(query, 5)[0].tolist()
+    index.add(vectors[[3]], [3])
+
+
+def test_prune_selects_like_select_neighbors(index):
+    nodes = np.arange(20)
+    candidates = np.random.default_rng(4).choice(
+        np.arange(20, 2000), size=(20, 30), replace=False
+    )
+
+    pruned = index._prune(nodes, candidates, 8)
+
+    for node, row, selected in zip(nodes, candidates, pruned.tolist()):
+        scores = index._vectors[row] @ index._vectors[node]
+        assert sorted(selected) == sorted(
+            index._select_neighbors(list(zip(scores.tolist(), row.tolist())), 8)
+        )
+
+
+def test_links_are_pruned_once_rows_are_full(index):
+    counts = index._counts[: index._size]
+
+    # Rows have room for more than m0 links, and are pruned back to m0 links once full
+    assert index._links.shape[1] > index.m0
+    assert counts.max() == index._links.shape[1]
+
+
+def test_load_rows_of_m0_links(index, vectors):
+    arrays = index.to_arrays()
+    arrays["links"] = arrays["links"][:, : index.m0]
+    arrays["counts"] = np.minimum(arrays["counts"], index.m0)
+
+    loaded = HNSWIndex.from_arrays(arrays)
+
+    assert recall(loaded, vectors, 10, ef=200) >= 0.9
+    loaded.add(vectors[:100], np.arange(2000, 2100))
+    assert loaded.search(vectors[0], 2)[0].tolist() in ([0, 2000], [2000, 0])
+
+
+def test_compact_drops_deleted_nodes():
+    vectors = unit_vectors(1000, seed=5)
+    index = HNSWIndex(DIM, m=8, ef_construction=64, seed=0)
+    index.add(vectors, np.arange(1000))
+    removed = np.random.default_rng(6).choice(1000, size=400, replace=False)
+    index.remove(removed)
+
+    index.compact()
+
+    assert len(index) == 600
+    assert index.deleted_count == 0
+    kept = np.setdiff1d(np.arange(1000), removed)
+    found = 0
+    for query in unit_vectors(50, seed=7):
+        labels = index.search(query, 10, ef=200)[0].tolist()
+        assert set(labels) <= set(kept.tolist())
+        found += len(set(labels) & set(exact_labels(vectors[kept], kept, query, 10)))
+    assert found / 500 >= 0.95
+
+    # The compacted index can be added to and removed from like any other
+    index.add(vectors[removed[:10]], removed[:10])
+    index.remove(kept[:5])
+    assert len(index) == 605
+    assert index.search(vectors[removed[0]], 1)[0].tolist() == [removed[0]]
+
+
+def test_compact_replaces_a_deleted_entry_point():
+    vectors = unit_vectors(300, seed=8)
+    index = HNSWIndex(DIM, m=4, seed=0)
+    index.add(vectors, np.arange(300))
+    index.remove([int(index._labels[index._entry_point])])
+    index.remove(range(0, 300, 2))
+
+    index.compact()
+
+    assert index._max_level == index._levels[: index._size].max()
+    assert index.search(vectors[101], 1, ef=100)[0].tolist() == [101]
+
+    index.remove(range(300))
+    index.compact()
+    assert len(index) == 0
+    index.add(vectors[:2], [0, 1])
+    assert index.search(vectors[1], 1)[0].tolist() == [1]
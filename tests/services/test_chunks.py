@@ -0,0 +1,73 @@
+import pytest
+
+import services.chunks
+from benchmarks.chunking import chunking_benchmark
+from benchmarks.chunking.chunking_benchmark import (
+    generate_document,
+    get_text_chunks_reference,
+)
+from models.models import Document, DocumentMetadata
+from services.chunks import get_document_chunks, get_text_chunks
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "   \n\t ",
+        "short",
+        "A sentence. Another one? Yes! " * 200,
+        "no punctuation at all " * 500,
+        "line\n" * 1000,
+        "multi-byte characters like 東京 and café split across tokens " * 300,
+        "\n\n\n" + "   " * 500 + "trailing text after whitespace. " * 100,
+    ],
+)
+@pytest.mark.parametrize("chunk_token_size", [None, 7, 50, 1000])
+def test_get_text_chunks_matches_previous_implementation(text, chunk_token_size):
+    assert get_text_chunks(text, chunk_token_size) == get_text_chunks_reference(
+        text, chunk_token_size
+    )
+
+
+def test_get_text_chunks_matches_previous_implementation_on_generated_document():
+    text = generate_document(200 * 1024, seed=1)
+    assert get_text_chunks(text, None) == get_text_chunks_reference(text, None)
+
+
+def test_get_text_chunks_keeps_remainder_after_max_num_chunks(monkeypatch):
+    monkeypatch.setattr(services.chunks, "MAX_NUM_CHUNKS", 3)
+    monkeypatch.setattr(chunking_benchmark, "MAX_NUM_CHUNKS", 3)
+    text = generate_document(50 * 1024, seed=2)
+
+    chunks = get_text_chunks(text, None)
+
+    assert len(chunks) == 4
+    assert chunks == get_text_chunks_reference(text, None)
+
+
+async def fake_embeddings(texts, batch_size):
+    return [[float(len(text))] for text in texts]
+
+
+@pytest.mark.asyncio
+async def test_parallel_chunking_matches_serial_chunking(monkeypatch):
+    monkeypatch.setattr(services.chunks, "aget_embeddings_batched", fake_embeddings)
+    documents = [
+        Document(
+            id=f"doc-{i}",
+            text=generate_document(20 * 1024, seed=i),
+            metadata=DocumentMetadata(author=f"author-{i}"),
+        )
+        for i in range(6)
+    ]
+
+    monkeypatch.setattr(services.chunks, "CHUNKING_PARALLEL_MIN_CHARS", 10**12)
+    serial = await get_document_chunks(documents, None)
+
+    monkeypatch.setattr(services.chunks, "CHUNKING_PARALLEL_MIN_CHARS", 0)
+    monkeypatch.setattr(services.chunks, "CHUNKING_MAX_WORKERS", 2)
+    parallel = await get_document_chunks(documents, None)
+
+    assert list(parallel.keys()) == [f"doc-{i}" for i in range(6)]
+    assert parallel == serial
@@ -0,0 +1,147 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from services.embedding_cache import (
+    EmbeddingCache,
+    InMemoryEmbeddingCache,
+    QueryEmbeddingCache,
+    SqliteEmbeddingCache,
+    embedding_cache_key,
+)
+
+
+class FakeEmbedder:
+    def __init__(self):
+        self.calls: List[List[str]] = []
+
+    async def __call__(self, texts: List[str]) -> List[List[float]]:
+        self.calls.append(texts)
+        return [[float(len(text)), 0.5] for text in texts]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path) -> EmbeddingCache:
+    if request.param == "memory":
+        return InMemoryEmbeddingCache(max_size=100)
+    return SqliteEmbeddingCache(path=str(tmp_path / "cache.sqlite3"))
+
+
+def test_cache_key_depends_on_model_and_normalized_text():
+    assert embedding_cache_key("hello  world", "model") == embedding_cache_key(
+        " hello world\n", "model"
+    )
+    assert embedding_cache_key("hello world", "model") != embedding_cache_key(
+        "hello world", "other-model"
+    )
+    assert embedding_cache_key("hello world", "model") != embedding_cache_key(
+        "hello there", "model"
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_or_embed_only_embeds_misses(cache: EmbeddingCache):
+    embed = FakeEmbedder()
+
+    first = await cache.get_or_embed(["a", "bb", "a"], embed)
+    assert first == [[1.0, 0.5], [2.0, 0.5], [1.0, 0.5]]
+    assert embed.calls == [["a", "bb"]]
+    assert cache.misses == 2
+    assert cache.hits == 1
+
+    second = await cache.get_or_embed(["bb", "ccc", "a"], embed)
+    assert second == [[2.0, 0.5], [3.0, 0.5], [1.0, 0.5]]
+    assert embed.calls == [["a", "bb"], ["ccc"]]
+    assert cache.stats() == {"hits": 3, "misses": 3, "hit_ratio": 0.5}
+
+
+@pytest.mark.asyncio
+async def test_in_memory_cache_evicts_least_recently_used():
+    cache = InMemoryEmbeddingCache(max_size=2)
+    embed = FakeEmbedder()
+
+    await cache.get_or_embed(["a", "bb"], embed)
+    await cache.get_or_embed(["a"], embed)
+    await cache.get_or_embed(["ccc"], embed)
+    await cache.get_or_embed(["a", "bb"], embed)
+
+    assert embed.calls == [["a", "bb"], ["ccc"], ["bb"]]
+
+
+@pytest.mark.asyncio
+async def test_sqlite_cache_persists_across_instances(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    embed = FakeEmbedder()
+
+    await SqliteEmbeddingCache(path=path).get_or_embed(["a", "bb"], embed)
+    embeddings = await SqliteEmbeddingCache(path=path).get_or_embed(["bb"], embed)
+
+    assert embeddings == [[2.0, 0.5]]
+    assert embed.calls == [["a", "bb"]]
+
+
+@pytest.mark.asyncio
+async def test_query_cache_expires_entries_after_ttl():
+    now = [0.0]
+    cache = QueryEmbeddingCache(max_size=10, ttl=60, clock=lambda: now[0])
+    embed = FakeEmbedder()
+
+    await cache.get_or_embed(["a"], embed)
+    now[0] = 59
+    await cache.get_or_embed(["a"], embed)
+    now[0] = 120
+    await cache.get_or_embed(["a"], embed)
+
+    assert embed.calls == [["a"], ["a"]]
+    assert cache.hits == 1
+    assert cache.misses == 2
+
+
+@pytest.mark.asyncio
+async def test_query_cache_coalesces_concurrent_misses():
+    cache = QueryEmbeddingCache(max_size=10, ttl=60)
+    release = asyncio.Event()
+    calls: List[List[str]] = []
+
+    async def slow_embed(texts: List[str]) -> List[List[float]]:
+        calls.append(texts)
+        await release.wait()
+        return [[float(len(text))] for text in texts]
+
+    first = asyncio.create_task(cache.get_or_embed(["a", "bb"], slow_embed))
+    second = asyncio.create_task(cache.get_or_embed(["bb", "a", "bb"], slow_embed))
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await first == [[1.0], [2.0]]
+    assert await second == [[2.0], [1.0], [2.0]]
+    assert calls == [["a", "bb"]]
+    stats = cache.stats()
+    assert stats["misses"] == 2
+    assert stats["coalesced"] == 3
+    assert stats["saved_seconds"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_query_cache_shares_failures_with_waiters():
+    cache = QueryEmbeddingCache(max_size=10, ttl=60)
+    release = asyncio.Event()
+
+    async def failing_embed(texts: List[str]) -> List[List[float]]:
+        await release.wait()
+        raise RuntimeError("embedding failed")
+
+    first = asyncio.create_task(cache.get_or_embed(["a"], failing_embed))
+    second = asyncio.create_task(cache.get_or_embed(["a"], failing_embed))
+    await asyncio.sleep(0)
+    release.set()
+
+    with pytest.raises(RuntimeError):
+        await first
+    with pytest.raises(RuntimeError):
+        await second
+
+    # the failed query is not cached, so it is embedded again next time
+    embed = FakeEmbedder()
+    assert await cache.get_or_embed(["a"], embed) == [[1.0, 0.5]]
@@ -0,0 +1,42 @@
+import asyncio
+from io import BytesIO
+
+import pytest
+from fastapi import UploadFile
+from starlette.datastructures import Headers
+
+import services.file
+from services.file import FileTooLargeError, extract_text_from_form_file
+
+
+def upload(content: bytes, filename: str, content_type: str = "") -> UploadFile:
+    headers = Headers({"content-type": content_type}) if content_type else None
+    return UploadFile(file=BytesIO(content), filename=filename, headers=headers)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_uploads_do_not_clobber_each_other():
+    files = [
+        upload(f"file number {i}".encode(), f"{i}.txt", "text/plain") for i in range(8)
+    ]
+
+    texts = await asyncio.gather(*[extract_text_from_form_file(f) for f in files])
+
+    assert texts == [f"file number {i}" for i in range(8)]
+
+
+@pytest.mark.asyncio
+async def test_mimetype_falls_back_to_the_filename():
+    text = await extract_text_from_form_file(upload(b"a,b\nc,d\n", "table.csv"))
+
+    assert text == "a b\nc d\n"
+
+
+@pytest.mark.asyncio
+async def test_files_over_the_size_limit_are_rejected(monkeypatch):
+    monkeypatch.setattr(services.file, "FILE_MAX_SIZE", 10)
+
+    with pytest.raises(FileTooLargeError):
+        await extract_text_from_form_file(upload(b"x" * 11, "big.txt", "text/plain"))
+    text = await extract_text_from_form_file(upload(b"x" * 10, "ok.txt", "text/plain"))
+    assert text == "x" * 10
@@ -0,0 +1,312 @@
+import asyncio
+import json
+from typing import Dict, List
+
+import pytest
+from tenacity import wait_none
+
+import datastore.datastore
+import services.chunks
+import services.ingestion
+from datastore.providers.local_datastore import LocalDataStore
+from models.models import Document, DocumentChunk
+from services.ingestion import (
+    Checkpoint,
+    DeadLetterQueue,
+    KeyedLocks,
+    Pipeline,
+    add_upsert_stages,
+)
+
+
+async def numbers(n: int, produced: List[int]):
+    for i in range(n):
+        produced.append(i)
+        yield i
+
+
+@pytest.mark.asyncio
+async def test_pipeline_runs_items_through_every_stage():
+    produced: List[int] = []
+
+    async def double(x: int) -> int:
+        await asyncio.sleep(0)
+        return x * 2
+
+    async def drop_multiples_of_four(x: int):
+        return None if x % 4 == 0 else x
+
+    collected: List[List[int]] = []
+
+    async def collect(batch: List[int]) -> List[int]:
+        collected.append(batch)
+        return batch
+
+    pipeline = (
+        Pipeline(queue_size=2)
+        .add_stage("double", double, concurrency=3)
+        .add_stage("drop", drop_multiples_of_four, concurrency=2)
+        .add_batch_stage("batch", 4)
+        .add_stage("collect", collect)
+    )
+    stats = await pipeline.run(numbers(20, produced))
+
+    assert sorted(x for batch in collected for x in batch) == [
+        x * 2 for x in range(20) if (x * 2) % 4
+    ]
+    assert [len(batch) for batch in collected] == [4, 4, 2]
+    assert stats.processed["read"] == 20
+    assert stats.processed["double"] == 20
+    assert stats.dropped["drop"] == 10
+    assert stats.processed["batch"] == 3
+
+
+@pytest.mark.asyncio
+async def test_pipeline_bounds_items_in_flight():
+    produced: List[int] = []
+    release = asyncio.Event()
+
+    async def blocked(x: int) -> int:
+        await release.wait()
+        return x
+
+    pipeline = Pipeline(queue_size=3).add_stage("blocked", blocked)
+    run = asyncio.create_task(pipeline.run(numbers(100, produced)))
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    # one item in the worker, three in its queue and one waiting to be put
+    assert len(produced) <= 5
+    release.set()
+    await run
+    assert len(produced) == 100
+
+
+@pytest.mark.asyncio
+async def test_pipeline_raises_stage_errors():
+    async def fail_on_three(x: int) -> int:
+        if x == 3:
+            raise ValueError("bad item")
+        return x
+
+    pipeline = Pipeline(queue_size=1).add_stage("fail", fail_on_three, 2)
+
+    with pytest.raises(ValueError):
+        await asyncio.wait_for(pipeline.run(numbers(100, [])), timeout=5)
+
+
+def test_checkpoint_tracks_processed_offsets_across_runs(tmp_path):
+    path = str(tmp_path / "state")
+    checkpoint = Checkpoint(path)
+    checkpoint.commit([2, 3], ["c", "d"])
+    checkpoint.skip([1])
+    checkpoint.commit([0], ["a"])
+    checkpoint.commit([6], ["g"])
+    checkpoint._file.write('{"offset": 9, "offs')  # cut short by a crash
+    checkpoint._file.close()
+
+    lines = open(path).read().splitlines()
+    assert json.loads(lines[1]) == {
+        "offset": 4,
+        "offsets": [1, 0],
+        "document_ids": ["a"],
+    }
+
+    resumed = Checkpoint(path, resume=True)
+    assert resumed.watermark == 4
+    assert resumed.resumed == 5
+    assert [offset for offset in range(8) if not resumed.is_done(offset)] == [4, 5, 7]
+    resumed.close()
+
+    assert Checkpoint(path).resumed == 0
+
+
+@pytest.mark.asyncio
+async def test_pipeline_resumes_from_checkpoint(tmp_path):
+    path = str(tmp_path / "state")
+    committed: List[int] = []
+
+    async def drop_odd(x: int):
+        return None if x % 2 else x
+
+    async def fail_after_first_batch(batch: List[int]) -> List[str]:
+        if committed:
+            raise RuntimeError("interrupted")
+        committed.extend(batch)
+        return [str(x) for x in batch]
+
+    pipeline = (
+        Pipeline()
+        .add_stage("drop", drop_odd)
+        .add_batch_stage("batch", 3)
+        .add_stage("upsert", fail_after_first_batch)
+    )
+    with pytest.raises(RuntimeError):
+        await pipeline.run(numbers(20, []), Checkpoint(path))
+    assert committed == [0, 2, 4]
+
+    async def upsert(batch: List[int]) -> List[str]:
+        committed.extend(batch)
+        return [str(x) for x in batch]
+
+    pipeline = (
+        Pipeline()
+        .add_stage("drop", drop_odd)
+        .add_batch_stage("batch", 3)
+        .add_stage("upsert", upsert)
+    )
+    stats = await pipeline.run(numbers(20, []), Checkpoint(path, resume=True))
+
+    assert sorted(committed) == list(range(0, 20, 2))
+    # the committed batch and the items dropped before the interruption are not read again
+    assert stats.units["resumed"] >= 5
+    assert stats.units["resumed"] + stats.processed["read"] == 20
+    assert Checkpoint(path, resume=True).resumed == 20
+
+
+@pytest.mark.asyncio
+async def test_keyed_locks_serialize_holders_of_the_same_key():
+    locks = KeyedLocks()
+    events: List[str] = []
+
+    async def hold(name: str, keys: List[str]):
+        async with locks.hold(keys):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    await asyncio.gather(
+        hold("a", ["x", "y"]), hold("b", ["y", "x"]), hold("c", ["z"])
+    )
+
+    assert events.index("a end") < events.index("b start")
+    assert events.index("c start") < events.index("a end")
+    assert locks._locks == {}
+
+
+class RecordingDataStore:
+    upserts_incrementally = False
+
+    def __init__(self):
+        self.writing: set = set()
+        self.upserted: List[List[str]] = []
+
+    async def upsert_chunks(
+        self, documents: List[Document], chunks: Dict[str, List[DocumentChunk]]
+    ) -> List[str]:
+        assert not self.writing & set(chunks)
+        self.writing |= set(chunks)
+        await asyncio.sleep(0.01)
+        self.writing -= set(chunks)
+        self.upserted.append(sorted(chunks))
+        return list(chunks)
+
+
+async def documents(ids: List[str]):
+    for id_ in ids:
+        yield Document(id=id_, text=f"Text of {id_}")
+
+
+@pytest.fixture
+def fake_embeddings(monkeypatch):
+    async def embeddings(texts, batch_size):
+        return [[1.0, 0.0] for _ in texts]
+
+    monkeypatch.setattr(services.chunks, "aget_embeddings_batched", embeddings)
+    monkeypatch.setattr(services.ingestion, "BATCH_RETRY_WAIT", wait_none())
+
+
+@pytest.mark.asyncio
+async def test_upsert_stages_write_each_document_once_at_a_time(fake_embeddings):
+    datastore = RecordingDataStore()
+    pipeline = add_upsert_stages(
+        Pipeline(), datastore, batch_size=2, upsert_concurrency=3  # type: ignore
+    )
+
+    stats = await pipeline.run(documents(["a", "b", "a", "c", "a", "b"]))
+
+    assert sorted(datastore.upserted) == [["a", "b"], ["a", "b"], ["a", "c"]]
+    assert stats.units["documents"] == 6
+
+
+class FailingDataStore:
+    upserts_incrementally = False
+
+    def __init__(self, failures: Dict[str, int]):
+        # The number of times each document fails to be upserted, before it succeeds
+        self.failures = failures
+        self.upserted: List[str] = []
+
+    async def upsert_chunks(
+        self, documents: List[Document], chunks: Dict[str, List[DocumentChunk]]
+    ) -> List[str]:
+        for id_ in chunks:
+            if self.failures.get(id_):
+                self.failures[id_] -= 1
+                raise RuntimeError(f"cannot write {id_}")
+        self.upserted += list(chunks)
+        return list(chunks)
+
+
+@pytest.mark.asyncio
+async def test_upsert_stages_retry_failed_batches_then_dead_letter_them(
+    tmp_path, fake_embeddings
+):
+    datastore = FailingDataStore({"b": 2, "c": 3})
+    dead_letters = DeadLetterQueue(str(tmp_path / "dead_letters.jsonl"))
+    path = str(tmp_path / "state")
+    pipeline = add_upsert_stages(
+        Pipeline(),
+        datastore,  # type: ignore
+        batch_size=2,
+        upsert_concurrency=1,
+        dead_letters=dead_letters,
+    )
+
+    stats = await pipeline.run(documents(["a", "b", "c", "d", "e"]), Checkpoint(path))
+    dead_letters.close()
+
+    # b failed twice and went through on the third attempt, c failed all three
+    assert datastore.upserted == ["a", "b", "e"]
+    assert stats.dropped["upsert"] == 1
+    letters = [json.loads(line) for line in open(dead_letters.path)]
+    assert [letter["item"]["id"] for letter in letters] == ["c", "d"]
+    assert letters[0]["reason"] == "Error in upsert after 3 attempts: cannot write c"
+    # The dead-lettered documents are not read again
+    assert Checkpoint(path, resume=True).resumed == 5
+
+
+@pytest.mark.asyncio
+async def test_upsert_stages_raise_errors_without_dead_letters(fake_embeddings):
+    pipeline = add_upsert_stages(
+        Pipeline(), FailingDataStore({"a": 1}), batch_size=1, max_attempts=1  # type: ignore
+    )
+
+    with pytest.raises(RuntimeError):
+        await pipeline.run(documents(["a", "b"]))
+
+
+@pytest.mark.asyncio
+async def test_upsert_stages_only_embed_changed_chunks_with_incremental_upsert(
+    monkeypatch, fake_embeddings
+):
+    embedded: List[str] = []
+
+    async def embeddings(texts, batch_size):
+        embedded.extend(texts)
+        return [[1.0, 0.0] for _ in texts]
+
+    monkeypatch.setattr(services.chunks, "aget_embeddings_batched", embeddings)
+    monkeypatch.setattr(datastore.datastore, "INCREMENTAL_UPSERT", True)
+    local = LocalDataStore(persistence_dir=None)
+
+    await add_upsert_stages(Pipeline(), local, batch_size=2).run(documents(["a", "b", "c"]))
+    assert sorted(embedded) == ["Text of a", "Text of b", "Text of c"]
+
+    async def changed_documents():
+        yield Document(id="a", text="Text of a")
+        yield Document(id="b", text="New text of b")
+
+    embedded.clear()
+    await add_upsert_stages(Pipeline(), local, batch_size=2).run(changed_documents())
+    assert embedded == ["New text of b"]
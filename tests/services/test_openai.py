@@ -0,0 +1,81 @@
+import asyncio
+import openai
+import pytest
+from aiohttp import web
+from tenacity import wait_none
+
+from services.openai import aget_embeddings, aget_embeddings_batched
+
+
+@pytest.fixture
+async def fake_embedding_server(monkeypatch):
+    state = {"requests": 0, "in_flight": 0, "max_in_flight": 0, "fail_next": 0}
+
+    async def embeddings(request: web.Request) -> web.Response:
+        body = await request.json()
+        state["requests"] += 1
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        try:
+            if state["fail_next"] > 0:
+                state["fail_next"] -= 1
+                return web.json_response(
+                    {"error": {"message": "overloaded", "type": "server_error"}},
+                    status=500,
+                )
+            # Yield so that concurrent batches overlap
+            await asyncio.sleep(0.01)
+            data = [
+                {"object": "embedding", "index": i, "embedding": [float(len(text))]}
+                for i, text in enumerate(body["input"])
+            ]
+            # Return the data out of order, the client must sort it by index
+            return web.json_response({"object": "list", "data": data[::-1]})
+        finally:
+            state["in_flight"] -= 1
+
+    app = web.Application()
+    app.router.add_post("/v1/embeddings", embeddings)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore
+
+    monkeypatch.setattr(openai, "api_base", f"http://127.0.0.1:{port}/v1")
+    monkeypatch.setattr(openai, "api_key", "test")
+    monkeypatch.setattr(openai, "api_type", "open_ai")
+    monkeypatch.delenv("OPENAI_EMBEDDINGMODEL_DEPLOYMENTID", raising=False)
+    monkeypatch.setattr(aget_embeddings.retry, "wait", wait_none())
+
+    yield state
+
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_aget_embeddings_keeps_input_order(fake_embedding_server):
+    texts = ["a", "bb", "ccc"]
+    embeddings = await aget_embeddings(texts)
+    assert embeddings == [[1.0], [2.0], [3.0]]
+
+
+@pytest.mark.asyncio
+async def test_batched_embeddings_are_bounded_and_ordered(fake_embedding_server):
+    texts = ["x" * (i + 1) for i in range(50)]
+    embeddings = await aget_embeddings_batched(texts, batch_size=4, max_concurrency=3)
+
+    assert embeddings == [[float(i + 1)] for i in range(50)]
+    assert fake_embedding_server["requests"] == 13
+    assert 1 < fake_embedding_server["max_in_flight"] <= 3
+
+
+@pytest.mark.asyncio
+async def test_batched_embeddings_retry_only_the_failed_batch(fake_embedding_server):
+    fake_embedding_server["fail_next"] = 1
+    texts = ["x" * (i + 1) for i in range(8)]
+    embeddings = await aget_embeddings_batched(texts, batch_size=4, max_concurrency=1)
+
+    assert embeddings == [[float(i + 1)] for i in range(8)]
+    # two batches plus a single retry
+    assert fake_embedding_server["requests"] == 3